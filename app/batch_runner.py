@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Batch mode for the RAG chat-bot.
+
+Runs a list of questions through the abstracts RAG chain with bounded
+concurrency and exports answers together with their retrieved sources.
+
+Headless usage (from the `app` directory):
+
+    python batch_runner.py questions.txt --out results --concurrency 8
+"""
+import io
+import json
+import argparse
+from typing import List
+from xml.sax.saxutils import escape
+
+from langchain_core.prompts import PromptTemplate
+from langchain_core.runnables import RunnableParallel, RunnablePassthrough
+from langchain_core.output_parsers import StrOutputParser
+
+from exports import save_pdf_paragraphs
+from resilience import FallbackRetriever, latency_report, traced_prompt
+from registry import get_database, get_index_path, load_index
+
+DEFAULT_TEMPLATE = (
+    "You are an expert research assistant."
+    "Your task is to answer questions based ONLY on the provided context from academic papers."
+    "Use the following pieces of context to answer the question at the end. "
+    "If you don't know the answer, just say that you don't know, don't try to make up an answer."
+    "Context: {context}\n"
+    "Question: {question}\n"
+    "Answer: "
+)
+
+
+def read_json(file_path):
+    with open(file_path) as file:
+        access_data = json.load(file)
+    return access_data
+
+
+def get_sources_chain(vectorestore, template, temperature, k_max, api_creds):
+    """
+    RAG chain that keeps the retrieved documents next to the answer.
+
+    Args:
+      :vectorestore: FAISS vectorstore to retrieve from
+      :template: prompt with {context} and {question}
+      :temperature:
+      :k_max: number of retrieved documents
+      :api_creds:
+
+    Returns:
+      Runnable returning dicts with `question`, `context` and `answer`
+    """
+    from indexing import get_llm
+
+    retriever = FallbackRetriever(vectorestore = vectorestore, k = k_max)
+    prompt = traced_prompt(PromptTemplate.from_template(template))
+    llm = get_llm(api_creds, temperature)
+    return (
+        RunnableParallel(context=retriever, question=RunnablePassthrough())
+        .assign(answer = prompt | llm | StrOutputParser())
+    )
+
+
+def load_questions(raw, file_name = ''):
+    """
+    Parse questions from an uploaded or local file.
+
+    `.json` files hold a list of strings, `.jsonl` files one object with a
+    `question` key (or a bare string) per line, anything else is read as
+    plain text with one question per line.
+    """
+    if isinstance(raw, bytes):
+        raw = raw.decode('utf-8')
+    if file_name.endswith('.jsonl'):
+        questions = []
+        for line in raw.splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            questions.append(item['question'] if isinstance(item, dict) else item)
+    elif file_name.endswith('.json'):
+        questions = json.loads(raw)
+    else:
+        questions = raw.splitlines()
+    return [q.strip() for q in questions if q and q.strip()]
+
+
+def _sources(docs):
+    sources = []
+    for doc in docs:
+        meta = doc.metadata
+        sources.append({
+            'title': meta.get('title', ''),
+            'url': meta.get('url', ''),
+            'source': meta.get('source', meta.get('soucre', '')),
+            'pdf_url': meta.get('pdf_url', '')
+        })
+    return sources
+
+
+def run_batch(chain, questions: List[str], max_concurrency = 4):
+    """
+    Run every question through `chain` with at most `max_concurrency`
+    requests in flight. A failing question does not stop the batch, its
+    error is kept in the result instead.
+    """
+    outputs = chain.batch(
+        questions,
+        config={"max_concurrency": max_concurrency},
+        return_exceptions=True
+    )
+    results = []
+    for question, output in zip(questions, outputs):
+        if isinstance(output, Exception):
+            results.append({
+                'question': question,
+                'answer': None,
+                'sources': [],
+                'error': repr(output)
+            })
+        else:
+            results.append({
+                'question': question,
+                'answer': output['answer'],
+                'sources': _sources(output['context']),
+                'error': None
+            })
+    return results
+
+
+def export_jsonl(results):
+    lines = [json.dumps(res, ensure_ascii=False) for res in results]
+    return io.BytesIO(('\n'.join(lines) + '\n').encode('utf-8'))
+
+
+def export_pdf(results, title = 'Batch answers'):
+    """PDF of the batch results; every field is escaped, only the questions are markup"""
+    blocks = []
+    for n, res in enumerate(results, 1):
+        blocks.append(f"<b>{n}. {escape(res['question'])}</b>")
+        if res['error']:
+            blocks.append(f"Error: {escape(res['error'])}")
+        else:
+            blocks.extend(escape(para) for para in res['answer'].split('\n'))
+        for src in res['sources']:
+            blocks.append(escape(f"- {src['title']} ({src['source']}) {src['url']}"))
+    return save_pdf_paragraphs(blocks, title, markup = True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a list of questions through the RAG chain')
+    parser.add_argument('questions', help='.txt (one per line), .json or .jsonl file with questions')
+    parser.add_argument('--out', default='batch_results', help='output path without extension')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--k', type=int, default=10, help='number of retrieved articles')
+    parser.add_argument('--temperature', type=float, default=0.)
+    parser.add_argument('--db', default='default', help='database name from config.json')
+    parser.add_argument('--index', help="index folder, the database's abstract index by default")
+    parser.add_argument('--no-pdf', action='store_true')
+    args = parser.parse_args()
+
+    with open(args.questions, encoding='utf-8') as file:
+        questions = load_questions(file.read(), args.questions)
+
+    from indexing import get_embedder
+
+    api_creds = read_json('apicreds.json')
+    index_path = args.index or get_index_path(get_database(args.db), 'abstract')
+    vectorestore = load_index(index_path, get_embedder(api_creds))
+    chain = get_sources_chain(vectorestore, DEFAULT_TEMPLATE, args.temperature, args.k, api_creds)
+
+    results = run_batch(chain, questions, max_concurrency = args.concurrency)
+    with open(f'{args.out}.jsonl', 'wb') as file:
+        file.write(export_jsonl(results).getvalue())
+    if not args.no_pdf:
+        with open(f'{args.out}.pdf', 'wb') as file:
+            file.write(export_pdf(results).getvalue())
+    failed = sum(1 for res in results if res['error'])
+    print(f'{len(results) - failed}/{len(results)} questions answered, saved to {args.out}.jsonl')
+    print(json.dumps(latency_report(), indent=2))
+
+
+if __name__ == '__main__':
+    main()
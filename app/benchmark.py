@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Offline benchmarks of harvesting, index building and answering.
+
+Harvests replay recorded HTTP fixtures (see stand_ins.Cassette), and
+embeddings and answers come from a local `FakeModelServer`, so no run
+touches nber.org, ssrn.com, arxiv.org or the Yandex APIs. The harvest
+pauses of econs_parsing are scaled by `--sleep-scale` (0 by default),
+leaving the parsing and merging work.
+
+Record fixtures from the live services, or make them up offline:
+
+    python benchmark.py record --keywords "trade war" tariffs --max-articles 100
+    python benchmark.py record --synthetic
+
+Run the suite, save the report and compare it with an earlier one; the
+exit code is 1 when a metric got worse by more than the tolerance:
+
+    python benchmark.py run --out bench.json
+    python benchmark.py run --baseline bench.json --tolerance 0.2
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import resource
+from contextlib import contextmanager
+
+from stand_ins import Cassette, FakeModelServer, synthetic_response
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURES_DIR = os.path.join(APP_DIR, 'bench_fixtures')
+CASSETTE_FILE = 'harvest.jsonl'
+SCENARIO_FILE = 'scenario.json'
+DEFAULT_SCENARIO = {'keywords': ['trade war', 'tariffs'], 'max_articles': 100}
+
+
+class _ScaledTime:
+    """`time` module whose `sleep` waits `scale` times as long"""
+    def __init__(self, scale):
+        self.scale = scale
+
+    def sleep(self, seconds):
+        if self.scale:
+            time.sleep(seconds * self.scale)
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+@contextmanager
+def scaled_sleeps(module, scale):
+    original = module.time
+    module.time = _ScaledTime(scale)
+    try:
+        yield
+    finally:
+        module.time = original
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process so far"""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(usage / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10), 1)
+
+
+def percentile(values, q):
+    """Nearest-rank q-th quantile"""
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, int(round(q * len(ordered))) - 1))]
+
+
+def harvest(scenario, fixtures_dir, db_path, synthetic = False):
+    """Run the harvest of `scenario` and record its exchanges"""
+    import econs_parsing
+
+    os.makedirs(fixtures_dir, exist_ok=True)
+    cassette = Cassette(os.path.join(fixtures_dir, CASSETTE_FILE))
+    cassette.entries.clear()
+    with cassette.record(synthetic_response if synthetic else None), \
+            scaled_sleeps(econs_parsing, 0 if synthetic else 1):
+        papers = econs_parsing.parse_all_articles(
+            scenario['keywords'], scenario['max_articles'], db_path, load_full_abstract = True
+        )
+    with open(os.path.join(fixtures_dir, SCENARIO_FILE), 'w', encoding='utf-8') as file:
+        json.dump(dict(scenario, synthetic = synthetic, recorded_at = time.time()), file, indent=2)
+    return {'articles': len(papers), 'exchanges': len(cassette.entries)}
+
+
+def bench_harvest(scenario, fixtures_dir, db_path, sleep_scale = 0.):
+    import econs_parsing
+    from corpus import sync
+
+    cassette = Cassette(os.path.join(fixtures_dir, CASSETTE_FILE))
+    random.seed(0)
+    start = time.perf_counter()
+    with cassette.replay(), scaled_sleeps(econs_parsing, sleep_scale):
+        papers = econs_parsing.parse_all_articles(
+            scenario['keywords'], scenario['max_articles'], db_path, load_full_abstract = True, save = True
+        )
+    harvest_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    sync(db_path)
+    return {
+        'articles': len(papers),
+        'seconds': round(harvest_seconds, 3),
+        'articles_per_s': round(len(papers) / harvest_seconds, 1),
+        'replayed_requests': cassette.hits,
+        'missing_requests': len(cassette.misses),
+        'corpus_sync_seconds': round(time.perf_counter() - start, 3),
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+
+def bench_index(db_path, api_creds, workers = 4):
+    from indexing import build_index
+
+    start = time.perf_counter()
+    result = build_index('abstract', db_path, api_creds, workers = workers)
+    seconds = time.perf_counter() - start
+    return {
+        'documents': result['documents'],
+        'seconds': round(seconds, 3),
+        'documents_per_s': round(result['documents'] / seconds, 1),
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+
+def bench_query(db_path, api_creds, queries, k = 10):
+    from batch_runner import DEFAULT_TEMPLATE, get_sources_chain
+    from indexing import get_embedder
+    from registry import get_index_path, index_size
+    from langchain_community.vectorstores import FAISS
+
+    start = time.perf_counter()
+    vectorestore = FAISS.load_local(
+        get_index_path(db_path, 'abstract'), get_embedder(api_creds), allow_dangerous_deserialization=True
+    )
+    load_seconds = time.perf_counter() - start
+    chain = get_sources_chain(vectorestore, DEFAULT_TEMPLATE, 0., k, api_creds)
+    search, answer = [], []
+    for query in queries:
+        start = time.perf_counter()
+        vectorestore.similarity_search(query, k = k)
+        search.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        chain.invoke(query)
+        answer.append(time.perf_counter() - start)
+    return {
+        'queries': len(queries),
+        'index_load_seconds': round(load_seconds, 3),
+        'index_mb': round(index_size(vectorestore) / 2 ** 20, 1),
+        'search_p50': round(percentile(search, .5), 4),
+        'search_p95': round(percentile(search, .95), 4),
+        'answer_p50': round(percentile(answer, .5), 4),
+        'answer_p95': round(percentile(answer, .95), 4),
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+
+def make_queries(db_path, n):
+    """Questions built from the harvested titles, the same on every run"""
+    from corpus import Corpus
+
+    titles = [paper['title'] for paper in Corpus(db_path)]
+    rng = random.Random(0)
+    return [f'What does the literature find about {rng.choice(titles).lower()}?' for _ in range(n)]
+
+
+def run(fixtures_dir, latency = .05, jitter = 0., sleep_scale = 0., queries = 30, embed_workers = 4):
+    with open(os.path.join(fixtures_dir, SCENARIO_FILE), encoding='utf-8') as file:
+        scenario = json.load(file)
+    db_path = tempfile.mkdtemp(prefix='bench_db_')
+    try:
+        with FakeModelServer(latency = latency, jitter = jitter) as server:
+            api_creds = {'endpoint': server.url}
+            report = {
+                'scenario': scenario,
+                'settings': {'latency': latency, 'jitter': jitter, 'sleep_scale': sleep_scale,
+                             'embed_workers': embed_workers},
+                'harvest': bench_harvest(scenario, fixtures_dir, db_path, sleep_scale),
+                'index': bench_index(db_path, api_creds, embed_workers),
+            }
+            report['query'] = bench_query(db_path, api_creds, make_queries(db_path, queries))
+    finally:
+        shutil.rmtree(db_path, ignore_errors=True)
+    return report
+
+
+def _metrics(report):
+    for stage in ('harvest', 'index', 'query'):
+        for name, value in report.get(stage, {}).items():
+            if name.endswith(('seconds', '_p50', '_p95', '_per_s', '_mb')):
+                yield f'{stage}.{name}', value
+
+
+def compare(report, baseline, tolerance = .2):
+    """
+    Metrics that got worse than `baseline` by more than `tolerance`.
+
+    Returns:
+      list of (metric, baseline value, new value)
+    """
+    old = dict(_metrics(baseline))
+    worse = []
+    for name, value in _metrics(report):
+        if name not in old or not old[name]:
+            continue
+        higher_is_better = name.endswith('_per_s')
+        change = (old[name] - value if higher_is_better else value - old[name]) / old[name]
+        if change > tolerance:
+            worse.append((name, old[name], value))
+    return worse
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks with recorded fixtures and local stand-ins')
+    parser.add_argument('--fixtures', default=FIXTURES_DIR)
+    commands = parser.add_subparsers(dest='command', required=True)
+    record = commands.add_parser('record', help='record the harvest fixtures')
+    record.add_argument('--keywords', nargs='+', default=DEFAULT_SCENARIO['keywords'])
+    record.add_argument('--max-articles', type=int, default=DEFAULT_SCENARIO['max_articles'])
+    record.add_argument('--synthetic', action='store_true', help='make up the responses instead of going online')
+    bench = commands.add_parser('run', help='run the benchmarks')
+    bench.add_argument('--latency', type=float, default=.05, help='seconds per model server request')
+    bench.add_argument('--jitter', type=float, default=0.)
+    bench.add_argument('--sleep-scale', type=float, default=0., help='scale of the harvest pauses')
+    bench.add_argument('--queries', type=int, default=30)
+    bench.add_argument('--embed-workers', type=int, default=4)
+    bench.add_argument('--out', help='save the report to this JSON file')
+    bench.add_argument('--baseline', help='report to compare with')
+    bench.add_argument('--tolerance', type=float, default=.2)
+    args = parser.parse_args()
+
+    scenario_path = os.path.join(args.fixtures, SCENARIO_FILE)
+    if args.command == 'record' or not os.path.exists(scenario_path):
+        synthetic = args.command != 'record' or args.synthetic
+        scenario = DEFAULT_SCENARIO
+        if args.command == 'record':
+            scenario = {'keywords': args.keywords, 'max_articles': args.max_articles}
+        db_path = tempfile.mkdtemp(prefix='bench_record_')
+        try:
+            result = harvest(scenario, args.fixtures, db_path, synthetic)
+        finally:
+            shutil.rmtree(db_path, ignore_errors=True)
+        print(f"Recorded {result['exchanges']} exchanges ({result['articles']} articles) to {args.fixtures}")
+        if args.command == 'record':
+            return 0
+
+    report = run(args.fixtures, args.latency, args.jitter, args.sleep_scale, args.queries, args.embed_workers)
+    print(json.dumps(report, indent=2))
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as file:
+            worse = compare(report, json.load(file), args.tolerance)
+        for name, old, new in worse:
+            print(f'REGRESSION {name}: {old} -> {new}')
+        return 1 if worse else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+SQLite catalog of the PDFs of a database.
+
+`scan` walks the database directory and only opens files whose size or
+mtime changed since the last scan. For each PDF the catalog keeps the page
+count, embedded title, content and text hashes, index status and the id
+of the matching record from the articles JSON. The gallery, downloader and
+indexers read the catalog instead of listing and parsing the directory.
+Pages that must stay responsive check `stale_files` (file stats only)
+and leave the parsing to `scan_in_background`.
+"""
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+import traceback
+from fnmatch import fnmatch
+from contextlib import closing
+
+from downloader import TitleIndex, normalize_title, record_id, file_sha256
+from corpus import Corpus, read_papers
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+CATALOG_FILE = 'catalog.sqlite3'
+# Notebook checkpoint copies and our own hidden stores are never ingested
+DEFAULT_IGNORE = ['.*', '*-checkpoint.pdf']
+# File names are only linked to a record when they say enough on their own
+STEM_MIN_WORDS = 3
+
+_scans = {}
+_scanned = {}
+_scans_lock = threading.Lock()
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS pdfs (
+    path TEXT PRIMARY KEY,
+    file_name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    created REAL NOT NULL,
+    page_count INTEGER,
+    embedded_title TEXT,
+    content_hash TEXT,
+    text_hash TEXT,
+    record_id TEXT,
+    record_title TEXT,
+    index_status TEXT NOT NULL DEFAULT 'new',
+    scanned_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pdfs_record ON pdfs (record_id);
+CREATE INDEX IF NOT EXISTS pdfs_created ON pdfs (created);
+CREATE INDEX IF NOT EXISTS pdfs_content ON pdfs (content_hash);
+"""
+
+
+def connect(db_path):
+    conn = sqlite3.connect(os.path.join(db_path, CATALOG_FILE), timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def load_ignore_patterns():
+    """`ingest_ignore` glob patterns from config.json, or the defaults"""
+    try:
+        with open(os.path.join(APP_DIR, 'config.json')) as file:
+            return json.load(file).get('ingest_ignore', DEFAULT_IGNORE)
+    except FileNotFoundError:
+        return DEFAULT_IGNORE
+
+
+def _ignored(name, rel_path, patterns):
+    return any(fnmatch(name, pat) or fnmatch(rel_path, pat) for pat in patterns)
+
+
+def _iter_pdf_files(db_path, patterns):
+    for root, dirs, files in os.walk(db_path):
+        rel_root = os.path.relpath(root, db_path)
+        rel = lambda name: os.path.normpath(os.path.join(rel_root, name))
+        dirs[:] = [d for d in dirs if not _ignored(d, rel(d), patterns)]
+        for f in files:
+            if f.lower().endswith('.pdf') and not _ignored(f, rel(f), patterns):
+                yield os.path.join(root, f)
+
+
+def inspect_pdf(file_path):
+    """Page count, embedded title and hashes of the bytes and the extracted text"""
+    import fitz
+
+    text_hash = hashlib.sha256()
+    with fitz.open(file_path) as pdf_document:
+        page_count = pdf_document.page_count
+        embedded_title = (pdf_document.metadata or {}).get('title') or None
+        for page in pdf_document:
+            text_hash.update(page.get_text().encode('utf-8'))
+    return {
+        'page_count': page_count,
+        'embedded_title': embedded_title,
+        'content_hash': file_sha256(file_path),
+        'text_hash': text_hash.hexdigest()
+    }
+
+
+def _match_record(index, file_path, embedded_title):
+    """
+    Record the PDF belongs to, by its embedded title or else its file name.
+    The file name must have several words and is compared with plain Dice,
+    never as a fragment of a longer title.
+    """
+    paper = index.resolve(embedded_title, threshold = 0.7) if embedded_title else None
+    if paper is None:
+        stem = os.path.splitext(os.path.basename(file_path))[0].replace('_', ' ')
+        if len(normalize_title(stem).split()) >= STEM_MIN_WORDS:
+            paper = index.resolve(stem, threshold = 0.7, fragments = False)
+    if paper is None:
+        return None, None
+    return record_id(paper), paper['title']
+
+
+def scan(db_path, records = None, ignore = None):
+    """
+    Bring the catalog of `db_path` up to date.
+
+    `records` are the paper dicts to link PDFs to; they are read from the
+    database JSON when needed and not given. Files and directories matching
+    the `ignore` glob patterns (default: `load_ignore_patterns()`) are left
+    out.
+
+    Returns:
+      dict with lists of `added`, `changed` and `removed` relative paths
+    """
+    diff = {'added': [], 'changed': [], 'removed': []}
+    with closing(connect(db_path)) as conn:
+        known = {
+            row['path']: (row['size'], row['mtime_ns'])
+            for row in conn.execute('SELECT path, size, mtime_ns FROM pdfs')
+        }
+        index = None
+        seen = set()
+        patterns = load_ignore_patterns() if ignore is None else ignore
+        for file_path in _iter_pdf_files(db_path, patterns):
+            rel_path = os.path.relpath(file_path, db_path)
+            seen.add(rel_path)
+            stat = os.stat(file_path)
+            if known.get(rel_path) == (stat.st_size, stat.st_mtime_ns):
+                continue
+            try:
+                info = inspect_pdf(file_path)
+            except Exception:
+                # Broken or half written file, try again on the next scan
+                continue
+            if index is None:
+                if records is None:
+                    try:
+                        records = read_papers(db_path)
+                    except FileNotFoundError:
+                        records = []
+                index = records.title_index() if isinstance(records, Corpus) else TitleIndex(records)
+            rec_id, rec_title = _match_record(index, file_path, info['embedded_title'])
+            previous = conn.execute(
+                'SELECT text_hash, index_status FROM pdfs WHERE path = ?', (rel_path,)
+            ).fetchone()
+            status = 'new'
+            if previous is not None and previous['text_hash'] == info['text_hash']:
+                status = previous['index_status']
+            conn.execute(
+                'INSERT OR REPLACE INTO pdfs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (rel_path, os.path.basename(file_path), stat.st_size, stat.st_mtime_ns,
+                 stat.st_ctime, info['page_count'], info['embedded_title'],
+                 info['content_hash'], info['text_hash'], rec_id, rec_title, status, time.time())
+            )
+            diff['changed' if rel_path in known else 'added'].append(rel_path)
+        for rel_path in set(known) - seen:
+            conn.execute('DELETE FROM pdfs WHERE path = ?', (rel_path,))
+            diff['removed'].append(rel_path)
+    return diff
+
+
+def stale_files(db_path, ignore = None):
+    """
+    Relative paths of PDFs that are new, changed or gone since the last
+    scan. Only the file stats are read, no PDF is opened.
+    """
+    patterns = load_ignore_patterns() if ignore is None else ignore
+    with closing(connect(db_path)) as conn:
+        known = {
+            row['path']: (row['size'], row['mtime_ns'])
+            for row in conn.execute('SELECT path, size, mtime_ns FROM pdfs')
+        }
+    stale = []
+    for file_path in _iter_pdf_files(db_path, patterns):
+        rel_path = os.path.relpath(file_path, db_path)
+        stat = os.stat(file_path)
+        if known.pop(rel_path, None) != (stat.st_size, stat.st_mtime_ns):
+            stale.append(rel_path)
+    return stale + list(known)
+
+
+def _scan_thread(db_path):
+    try:
+        scan(db_path)
+    except Exception:
+        traceback.print_exc()
+    finally:
+        with _scans_lock:
+            _scans.pop(db_path, None)
+
+
+def scan_in_background(db_path, stale = None):
+    """
+    Run `scan` for `db_path` in a daemon thread unless one is already
+    running. With the `stale` paths that prompted it, the scan is not run
+    again for the same paths, e.g. for broken files that never catalog.
+    """
+    with _scans_lock:
+        if stale is not None:
+            if _scanned.get(db_path) == frozenset(stale):
+                return
+            _scanned[db_path] = frozenset(stale)
+        if db_path not in _scans:
+            _scans[db_path] = threading.Thread(
+                target = _scan_thread, args = (db_path,), name = f'scan:{db_path}', daemon = True
+            )
+            _scans[db_path].start()
+
+
+def scanning(db_path):
+    with _scans_lock:
+        return db_path in _scans
+
+
+def _as_dict(db_path, row):
+    pdf = dict(row)
+    pdf['file_path'] = os.path.join(db_path, pdf['path'])
+    pdf['title'] = (
+        pdf['record_title'] or pdf['embedded_title']
+        or os.path.splitext(pdf['file_name'])[0].replace('_', ' ')
+    )
+    return pdf
+
+
+# One row per distinct content: the copy linked to a record, then the shortest path
+_UNIQUE = """
+    path = (
+        SELECT q.path FROM pdfs q WHERE q.content_hash = pdfs.content_hash
+        ORDER BY q.record_id IS NULL, length(q.path), q.path LIMIT 1
+    )
+"""
+
+
+def count_pdfs(db_path, unique = True):
+    query = 'SELECT COUNT(*) FROM pdfs' + (f' WHERE {_UNIQUE}' if unique else '')
+    with closing(connect(db_path)) as conn:
+        return conn.execute(query).fetchone()[0]
+
+
+def list_pdfs(db_path, limit = -1, offset = 0, status = None, unique = True):
+    """
+    Catalogued PDFs, newest first.
+
+    With `unique`, byte-identical copies are collapsed into one entry
+    whatever their names or folders, so their text is never extracted,
+    embedded or retrieved twice.
+    """
+    where = []
+    args = ()
+    if unique:
+        where.append(_UNIQUE)
+    if status:
+        where.append('index_status = ?')
+        args = (status,)
+    query = 'SELECT * FROM pdfs'
+    if where:
+        query += ' WHERE ' + ' AND '.join(where)
+    with closing(connect(db_path)) as conn:
+        rows = conn.execute(
+            query + ' ORDER BY created DESC LIMIT ? OFFSET ?', args + (limit, offset)
+        ).fetchall()
+    return [_as_dict(db_path, row) for row in rows]
+
+
+def duplicates(db_path):
+    """Groups of paths sharing the same content"""
+    with closing(connect(db_path)) as conn:
+        rows = conn.execute(
+            'SELECT content_hash, path FROM pdfs WHERE content_hash IN '
+            '(SELECT content_hash FROM pdfs GROUP BY content_hash HAVING COUNT(*) > 1) '
+            'ORDER BY content_hash, path'
+        ).fetchall()
+    groups = {}
+    for row in rows:
+        groups.setdefault(row['content_hash'], []).append(row['path'])
+    return list(groups.values())
+
+
+def get_pdf(db_path, rel_path):
+    with closing(connect(db_path)) as conn:
+        row = conn.execute('SELECT * FROM pdfs WHERE path = ?', (rel_path,)).fetchone()
+    return _as_dict(db_path, row) if row else None
+
+
+def record_paths(db_path):
+    """Mapping of record id to the absolute path of its PDF"""
+    with closing(connect(db_path)) as conn:
+        rows = conn.execute('SELECT record_id, path FROM pdfs WHERE record_id IS NOT NULL').fetchall()
+    return {row['record_id']: os.path.join(db_path, row['path']) for row in rows}
+
+
+def set_index_status(db_path, rel_paths, status):
+    with closing(connect(db_path)) as conn:
+        conn.executemany(
+            'UPDATE pdfs SET index_status = ? WHERE path = ?',
+            [(status, rel_path) for rel_path in rel_paths]
+        )
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Persistent chat history.
+
+Every chat page keeps its own conversation (a session row) in SQLite,
+so history survives restarts and pages only read the messages they show.
+"""
+import os
+import time
+import uuid
+import sqlite3
+from contextlib import closing
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+CONVERSATIONS_DB = os.path.join(APP_DIR, 'conversations.sqlite3')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    page TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id TEXT NOT NULL REFERENCES sessions (id),
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_session ON messages (session_id, id);
+"""
+
+
+def connect(db_file = None):
+    conn = sqlite3.connect(db_file or CONVERSATIONS_DB, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def create_session(page):
+    session_id = uuid.uuid4().hex
+    with closing(connect()) as conn:
+        conn.execute(
+            'INSERT INTO sessions (id, page, created_at) VALUES (?, ?, ?)',
+            (session_id, page, time.time())
+        )
+    return session_id
+
+
+def session_exists(session_id):
+    with closing(connect()) as conn:
+        row = conn.execute('SELECT 1 FROM sessions WHERE id = ?', (session_id,)).fetchone()
+    return row is not None
+
+
+def add_message(session_id, role, content):
+    """Append a message and return its id"""
+    with closing(connect()) as conn:
+        return conn.execute(
+            'INSERT INTO messages (session_id, role, content, created_at) VALUES (?, ?, ?, ?)',
+            (session_id, role, content, time.time())
+        ).lastrowid
+
+
+def count_messages(session_id):
+    with closing(connect()) as conn:
+        return conn.execute(
+            'SELECT COUNT(*) FROM messages WHERE session_id = ?', (session_id,)
+        ).fetchone()[0]
+
+
+def latest_messages(session_id, limit = 20):
+    """Newest `limit` messages of a session, oldest first"""
+    with closing(connect()) as conn:
+        rows = conn.execute(
+            'SELECT id, role, content FROM messages WHERE session_id = ? ORDER BY id DESC LIMIT ?',
+            (session_id, limit)
+        ).fetchall()
+    return [dict(row) for row in reversed(rows)]
+
+
+def iter_messages(session_id, batch_size = 200):
+    """Stream all messages of a session in order, `batch_size` rows at a time"""
+    last_id = 0
+    with closing(connect()) as conn:
+        while True:
+            rows = conn.execute(
+                'SELECT id, role, content FROM messages '
+                'WHERE session_id = ? AND id > ? ORDER BY id LIMIT ?',
+                (session_id, last_id, batch_size)
+            ).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield dict(row)
+            last_id = rows[-1]['id']
+
+
+def last_message_id(session_id):
+    with closing(connect()) as conn:
+        return conn.execute(
+            'SELECT MAX(id) FROM messages WHERE session_id = ?', (session_id,)
+        ).fetchone()[0]
+
+
+def resolve_session(page, state, query_params):
+    """
+    Conversation id of `page` for the current browser session.
+
+    The id is kept in `state` (st.session_state) and mirrored to
+    `query_params` (st.query_params), so reloading the page or restarting
+    the server reopens the same conversation.
+    """
+    key = f'chat_{page}'
+    if key not in state:
+        session_id = query_params.get(key)
+        if not session_id or not session_exists(session_id):
+            session_id = create_session(page)
+        state[key] = session_id
+        query_params[key] = session_id
+    return state[key]
@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+SQLite corpus of the paper records of a database.
+
+Every `*.json` file of the database is imported once into
+`corpus.sqlite3` and again only when it changes. Records of all files are
+merged by record id, so no file shadows another; a changed file replaces
+the records it brought in before. A record is deleted only once no file
+brings it in any more. NBER, arXiv and SSRN
+records share one schema: SSRN's old `soucre` key becomes `source`, and
+`full_abstract` falls back to the short abstract.
+
+`Corpus` iterates `Paper` records in harvest order. The records of a
+database are loaded once per process and shared by every session until
+the corpus changes. A `Paper` only holds its light fields (title,
+authors, urls, ...); abstracts, keywords and categories are read from
+SQLite when accessed.
+"""
+import os
+import sys
+import glob
+import json
+import time
+import sqlite3
+import threading
+from collections.abc import Mapping
+
+from downloader import TitleIndex, normalize_title, record_id
+
+CORPUS_FILE = 'corpus.sqlite3'
+SOURCES = {'nber': 'nber', 'arxiv': 'arXiv', 'ssrn': 'ssrn'}
+LIGHT_FIELDS = ('record_id', 'source', 'id', 'title', 'authors', 'publication_date', 'url', 'pdf_url', 'type')
+HEAVY_FIELDS = ('abstract', 'full_abstract', 'keywords', 'categories')
+JSON_FIELDS = ('authors', 'keywords', 'categories')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS papers (
+    record_id TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL,
+    source TEXT,
+    id TEXT,
+    title TEXT NOT NULL,
+    norm_title TEXT NOT NULL,
+    authors TEXT,
+    publication_date TEXT,
+    url TEXT,
+    pdf_url TEXT,
+    type TEXT,
+    abstract TEXT,
+    full_abstract TEXT,
+    keywords TEXT,
+    categories TEXT,
+    extra TEXT,
+    origin TEXT,
+    imported_at REAL
+);
+CREATE INDEX IF NOT EXISTS papers_title ON papers (norm_title);
+CREATE INDEX IF NOT EXISTS papers_seq ON papers (seq);
+CREATE TABLE IF NOT EXISTS origins (
+    record_id TEXT NOT NULL,
+    origin TEXT NOT NULL,
+    PRIMARY KEY (record_id, origin)
+);
+CREATE INDEX IF NOT EXISTS origins_origin ON origins (origin);
+CREATE TABLE IF NOT EXISTS imports (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    records INTEGER NOT NULL,
+    imported_at REAL NOT NULL
+);
+"""
+_COLUMNS = ('record_id', 'seq', 'source', 'id', 'title', 'norm_title') + LIGHT_FIELDS[4:] + HEAVY_FIELDS + ('extra',)
+_LIGHT_SELECT = (
+    'SELECT ' + ', '.join(LIGHT_FIELDS) + ', extra, '
+    + ', '.join(f'{name} IS NOT NULL AS has_{name}' for name in HEAVY_FIELDS)
+    + ' FROM papers'
+)
+
+_local = threading.local()
+
+
+def connect(db_path):
+    conn = sqlite3.connect(os.path.join(db_path, CORPUS_FILE), timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(_SCHEMA)
+    if conn.execute('SELECT NOT EXISTS (SELECT 1 FROM origins)').fetchone()[0]:
+        # Corpora from before the origins table kept one origin per record
+        conn.execute(
+            'INSERT OR IGNORE INTO origins SELECT record_id, origin FROM papers WHERE origin IS NOT NULL'
+        )
+    return conn
+
+
+def _shared(db_path):
+    """Connection of the current thread, reused for lazy field reads"""
+    connections = _local.__dict__.setdefault('connections', {})
+    if db_path not in connections:
+        connections[db_path] = connect(db_path)
+    return connections[db_path]
+
+
+def normalize_record(raw):
+    """Record of any source in the shared schema, as a row dict"""
+    raw = dict(raw)
+    raw.pop('structured_text', None)
+    if 'soucre' in raw:
+        raw.setdefault('source', raw.pop('soucre'))
+    row = {'record_id': record_id(raw)}
+    for name in LIGHT_FIELDS[1:] + HEAVY_FIELDS:
+        row[name] = raw.pop(name, None)
+    row['source'] = SOURCES.get(str(row['source'] or '').lower(), row['source'])
+    row['id'] = None if row['id'] is None else str(row['id'])
+    row['title'] = (row['title'] or '').strip()
+    row['norm_title'] = normalize_title(row['title'])
+    row['full_abstract'] = row['full_abstract'] or row['abstract']
+    for name in JSON_FIELDS:
+        if row[name] is not None:
+            row[name] = json.dumps(row[name], ensure_ascii=False)
+    row['extra'] = json.dumps(raw, ensure_ascii=False) if raw else None
+    return row
+
+
+def _drop_origin(conn, origin, keep = ()):
+    """
+    Forget that `origin` brings in its records except `keep`. Records no
+    other file brings in are deleted; files that still bring in one of
+    the others are imported again by the next sync, so the record gets
+    their values back.
+    """
+    conn.execute('CREATE TEMP TABLE IF NOT EXISTS kept (record_id TEXT PRIMARY KEY)')
+    conn.execute('DELETE FROM kept')
+    conn.executemany('INSERT OR IGNORE INTO kept VALUES (?)', [(rec_id,) for rec_id in keep])
+    dropped = [row[0] for row in conn.execute(
+        'SELECT record_id FROM origins WHERE origin = ? AND record_id NOT IN (SELECT record_id FROM kept)',
+        (origin,)
+    )]
+    conn.execute('DELETE FROM kept')
+    if not dropped:
+        return
+    conn.executemany('DELETE FROM origins WHERE record_id = ? AND origin = ?', [(r, origin) for r in dropped])
+    for rec_id in dropped:
+        others = [row[0] for row in conn.execute('SELECT origin FROM origins WHERE record_id = ?', (rec_id,))]
+        if others:
+            conn.executemany('DELETE FROM imports WHERE path = ?', [(other,) for other in others])
+        else:
+            conn.execute('DELETE FROM papers WHERE record_id = ?', (rec_id,))
+
+
+def _changed(db_path):
+    with _tables_lock:
+        _generations[db_path] = _generations.get(db_path, 0) + 1
+
+
+def add_papers(db_path, papers, origin = None):
+    """
+    Insert or update records; a known record keeps its place in the order.
+
+    With `origin` (a JSON file name), records that file brought in before
+    and that are missing from `papers` are dropped from it, and deleted
+    unless another file brings them in too, so a re-harvested file
+    replaces its previous records.
+    """
+    rows = [normalize_record(paper) for paper in papers]
+    names = [name for name in _COLUMNS if name != 'seq'] + ['origin', 'imported_at']
+    updates = ', '.join(f'{name} = excluded.{name}' for name in names if name != 'record_id')
+    stamp = time.time()
+    conn = _shared(db_path)
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        seq = conn.execute('SELECT COALESCE(MAX(seq), 0) FROM papers').fetchone()[0]
+        conn.executemany(
+            f"INSERT INTO papers (seq, {', '.join(names)}) VALUES (?, {', '.join('?' * len(names))}) "
+            f'ON CONFLICT (record_id) DO UPDATE SET {updates}',
+            [
+                (seq + i + 1,) + tuple(row[name] for name in names[:-2]) + (origin, stamp)
+                for i, row in enumerate(rows)
+            ]
+        )
+        if origin is not None:
+            conn.executemany(
+                'INSERT OR IGNORE INTO origins VALUES (?, ?)', [(row['record_id'], origin) for row in rows]
+            )
+            _drop_origin(conn, origin, keep = [row['record_id'] for row in rows])
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+    _changed(db_path)
+    return len(rows)
+
+
+def sync(db_path):
+    """
+    Import the JSON files of `db_path` that are new or changed since the
+    last import and drop the records of deleted files.
+
+    Returns:
+      number of imported records
+    """
+    conn = _shared(db_path)
+    imported = 0
+    json_files = sorted(glob.glob(os.path.join(db_path, '*.json')))
+    present = {os.path.basename(json_file) for json_file in json_files}
+    for row in conn.execute('SELECT path FROM imports').fetchall():
+        if row['path'] not in present:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                _drop_origin(conn, row['path'])
+                conn.execute('DELETE FROM imports WHERE path = ?', (row['path'],))
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+            _changed(db_path)
+    for json_file in json_files:
+        stat = os.stat(json_file)
+        known = conn.execute(
+            'SELECT size, mtime_ns FROM imports WHERE path = ?', (os.path.basename(json_file),)
+        ).fetchone()
+        if known is not None and tuple(known) == (stat.st_size, stat.st_mtime_ns):
+            continue
+        with open(json_file, 'r', encoding='utf-8') as file:
+            data = json.load(file)
+        # Anything but a list of records (e.g. a settings file) is skipped
+        count = add_papers(db_path, data, os.path.basename(json_file)) if isinstance(data, list) else 0
+        conn.execute(
+            'INSERT OR REPLACE INTO imports VALUES (?, ?, ?, ?, ?)',
+            (os.path.basename(json_file), stat.st_size, stat.st_mtime_ns, count, time.time())
+        )
+        imported += count
+    return imported
+
+
+class Paper(Mapping):
+    """
+    Read-only paper record shared by every session of the process.
+
+    Light fields live in a tuple aligned with `LIGHT_FIELDS`, sources,
+    types, dates and author names are interned. Heavy fields are read from
+    SQLite on each access and never kept on the record.
+    """
+    __slots__ = ('_db_path', '_values', '_extra', '_heavy')
+
+    def __init__(self, db_path, row):
+        values = []
+        for name in LIGHT_FIELDS:
+            value = row[name]
+            if value is not None and name == 'authors':
+                value = tuple(_intern(author) for author in json.loads(value))
+            elif name in _INTERNED:
+                value = _intern(value)
+            values.append(value)
+        self._db_path = db_path
+        self._values = tuple(values)
+        self._extra = json.loads(row['extra']) if row['extra'] else None
+        self._heavy = _heavy_names(tuple(name for name in HEAVY_FIELDS if row[f'has_{name}']))
+
+    @property
+    def record_id(self):
+        return self._values[0]
+
+    def _read(self, key):
+        row = _shared(self._db_path).execute(
+            f'SELECT {key} FROM papers WHERE record_id = ?', (self.record_id,)
+        ).fetchone()
+        value = row[0] if row is not None else None
+        return json.loads(value) if key in JSON_FIELDS and value else value
+
+    def __getitem__(self, key):
+        if key in _LIGHT_POSITIONS:
+            value = self._values[_LIGHT_POSITIONS[key]]
+            if value is not None:
+                return value
+        elif key in self._heavy:
+            return self._read(key)
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        if key in _LIGHT_POSITIONS and self._values[_LIGHT_POSITIONS[key]] is not None:
+            return True
+        return key in self._heavy or (self._extra is not None and key in self._extra)
+
+    def __iter__(self):
+        names = [name for name, value in zip(LIGHT_FIELDS, self._values) if value is not None]
+        names += self._heavy
+        if self._extra is not None:
+            names += [name for name in self._extra if name not in names]
+        return iter(names)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f"Paper({self.record_id!r}, {self._values[_LIGHT_POSITIONS['title']]!r})"
+
+
+_LIGHT_POSITIONS = {name: i for i, name in enumerate(LIGHT_FIELDS)}
+_INTERNED = ('source', 'publication_date', 'type')
+_heavy_sets = {}
+
+
+def _intern(value):
+    if isinstance(value, str):
+        return sys.intern(value)
+    return value
+
+
+def _heavy_names(names):
+    return _heavy_sets.setdefault(names, names)
+
+
+class _Table:
+    __slots__ = ('version', 'papers', 'by_id', 'title_index')
+
+    def __init__(self, version, papers):
+        self.version = version
+        self.papers = papers
+        self.by_id = {paper.record_id: paper for paper in papers}
+        self.title_index = None
+
+
+_tables = {}
+_tables_lock = threading.Lock()
+# Bumped on every write of this process, so `Corpus` objects know to re-check the version
+_generations = {}
+VERSION_TTL = 30
+
+
+def _version(conn):
+    """Changes whenever records are added, updated or deleted"""
+    return tuple(conn.execute('SELECT COUNT(*), MAX(seq), MAX(imported_at) FROM papers').fetchone())
+
+
+def corpus_version(db_path):
+    """`_version` of the corpus of `db_path`, as a JSON-friendly list"""
+    return list(_version(_shared(db_path)))
+
+
+def _table(db_path):
+    """Shared records of `db_path`, reloaded when the corpus has changed"""
+    conn = _shared(db_path)
+    version = _version(conn)
+    table = _tables.get(db_path)
+    if table is not None and table.version == version:
+        return table
+    with _tables_lock:
+        table = _tables.get(db_path)
+        if table is None or table.version != version:
+            rows = conn.execute(_LIGHT_SELECT + ' ORDER BY seq').fetchall()
+            table = _tables[db_path] = _Table(version, tuple(Paper(db_path, row) for row in rows))
+    return table
+
+
+class Corpus:
+    """
+    Papers of a database in harvest order; the records are shared by all
+    sessions.
+
+    The corpus version is checked when the `Corpus` is created, after
+    records were written by this process, and otherwise at most every
+    `VERSION_TTL` seconds (for writes of other processes, e.g. the job
+    worker). `read_papers` always returns a fresh `Corpus`.
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._table = _table(db_path)
+        self._checked = (_generations.get(db_path, 0), time.monotonic())
+
+    def _current(self):
+        generation = _generations.get(self.db_path, 0)
+        if self._checked[0] != generation or time.monotonic() - self._checked[1] > VERSION_TTL:
+            self._table = _table(self.db_path)
+            self._checked = (generation, time.monotonic())
+        return self._table
+
+    def __len__(self):
+        return len(self._current().papers)
+
+    def __iter__(self):
+        return iter(self._current().papers)
+
+    def get(self, rec_id):
+        """Paper by record id, or None"""
+        return self._current().by_id.get(rec_id)
+
+    def find_title(self, title):
+        """Papers whose normalized title equals the normalized `title`"""
+        table = self._current()
+        rows = _shared(self.db_path).execute(
+            'SELECT record_id FROM papers WHERE norm_title = ? ORDER BY seq', (normalize_title(title),)
+        ).fetchall()
+        return [table.by_id[row[0]] for row in rows if row[0] in table.by_id]
+
+    def title_index(self):
+        """`TitleIndex` over the current records, built once per corpus version"""
+        table = self._current()
+        if table.title_index is None:
+            table.title_index = TitleIndex(table.papers)
+        return table.title_index
+
+
+def read_papers(db_path):
+    """Corpus of `db_path`, synced with its JSON files"""
+    sync(db_path)
+    corpus = Corpus(db_path)
+    if not len(corpus):
+        raise FileNotFoundError(f"No JSON files found in {db_path}")
+    return corpus
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Full-text PDF downloads for the deep study mode.
+
+Titles are resolved through a `TitleIndex` (exact normalized match, then
+fuzzy trigram match). Files are fetched in parallel over a pooled
+session. Partial downloads resume with HTTP Range. A file is only moved
+into place once it is complete and looks like a PDF. Files that already
+exist and match their `.sha256` sidecar are skipped.
+"""
+import os
+import re
+import hashlib
+import unicodedata
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+CHUNK_SIZE = 64 * 1024
+TIMEOUT = (10, 60)  # connect, read
+# A query only counts as a fragment of a longer title when it is specific
+# enough on its own; a single common word would match half the corpus
+FRAGMENT_MIN_WORDS = 3
+FRAGMENT_MIN_CHARS = 20
+FRAGMENT_MIN_DICE = 0.3
+
+
+def normalize_title(title):
+    title = unicodedata.normalize('NFKD', title or '').encode('ascii', 'ignore').decode()
+    return ' '.join(re.findall(r'[a-z0-9]+', title.lower()))
+
+
+def record_id(paper):
+    """Stable id of a paper record across sources"""
+    return str(paper.get('id') or paper.get('url') or normalize_title(paper.get('title')))
+
+
+def _trigrams(text):
+    text = f'  {text} '
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class TitleIndex:
+    """Normalized-title lookup over the paper records with trigram fuzzy fallback"""
+    def __init__(self, papers):
+        self.papers = list(papers)
+        self.exact = {}
+        self.grams = []
+        self.postings = defaultdict(list)
+        for i, paper in enumerate(self.papers):
+            norm = normalize_title(paper.get('title'))
+            self.exact.setdefault(norm, i)
+            grams = _trigrams(norm)
+            self.grams.append(grams)
+            for gram in grams:
+                self.postings[gram].append(i)
+
+    def resolve(self, title, threshold = 0.5, fragments = True):
+        """
+        Best matching paper for `title`, or None. With `fragments`, a query
+        of several words that is part of a long title is accepted as well.
+        """
+        norm = normalize_title(title)
+        if not norm:
+            return None
+        if norm in self.exact:
+            return self.papers[self.exact[norm]]
+        fragments = fragments and (len(norm.split()) >= FRAGMENT_MIN_WORDS or len(norm) >= FRAGMENT_MIN_CHARS)
+        query = _trigrams(norm)
+        overlap = defaultdict(int)
+        for gram in query:
+            for i in self.postings.get(gram, ()):
+                overlap[i] += 1
+        best, best_score = None, 0.
+        for i, shared in overlap.items():
+            # Dice coefficient; a query that is a fragment of a long title
+            # is also accepted when most of its trigrams are covered
+            score = 2 * shared / (len(query) + len(self.grams[i]))
+            if fragments and score >= FRAGMENT_MIN_DICE:
+                score = max(score, shared / len(query) - 0.2)
+            if score > best_score:
+                best, best_score = i, score
+        if best is None or best_score < threshold:
+            return None
+        return self.papers[best]
+
+
+def create_session(workers = 8):
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    session = requests.Session()
+    retry_strategy = Retry(
+        total=3,
+        backoff_factor=1,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET"]
+    )
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers, max_retries=retry_strategy)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def pdf_request(paper):
+    """URL, query params and headers to fetch the full text of a paper"""
+    if 'pdf_url' in paper.keys():
+        return paper.get('pdf_url'), None, {'User-Agent': 'Mozilla/5.0'}
+    article_id = paper.get('id')
+    url = f"https://papers.ssrn.com/sol3/Delivery.cfm/SSRN_ID{article_id}_code459177.pdf"
+    params = {
+        'abstractid': article_id,
+        'mirid': '1',
+        'type': '2'
+    }
+    headers = {
+        'User-Agent': 'Mozilla/5.0',
+        'Referer': f'https://papers.ssrn.com/sol3/papers.cfm?abstract_id={article_id}',
+        'Accept': 'application/pdf,*/*'
+    }
+    return url, params, headers
+
+
+def pdf_file_name(title):
+    name = re.sub(r'[\\/:*?"<>|\x00-\x1f]', ' ', title).strip()
+    return re.sub(r'\s+', ' ', name)[:180] + '.pdf'
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _has_pdf_trailer(file):
+    """PDF header at the start and `%%EOF` in the last KB, where readers look for it"""
+    if file.read(5) != b'%PDF-':
+        return False
+    file.seek(max(0, os.fstat(file.fileno()).st_size - 1024))
+    return b'%%EOF' in file.read()
+
+
+def is_complete(path):
+    """
+    True if `path` exists and matches its checksum sidecar. A file without
+    a sidecar (e.g. from an older downloader) gets one if it is a whole PDF.
+    """
+    if not os.path.exists(path):
+        return False
+    sidecar = f'{path}.sha256'
+    if not os.path.exists(sidecar):
+        with open(path, 'rb') as file:
+            if not _has_pdf_trailer(file):
+                return False
+        with open(sidecar, 'w') as file:
+            file.write(file_sha256(path))
+        return True
+    with open(sidecar) as file:
+        return file.read().strip() == file_sha256(path)
+
+
+def fetch_pdf(session, paper, path, timeout = TIMEOUT):
+    """
+    Download one paper to `path`. Returns 'skipped', 'resumed' or 'downloaded'.
+
+    Data goes to `path + '.part'` first; an interrupted download continues
+    from the end of the part file on the next call.
+    """
+    if is_complete(path):
+        return 'skipped'
+    url, params, headers = pdf_request(paper)
+    part = f'{path}.part'
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    if offset:
+        headers = dict(headers, Range=f'bytes={offset}-')
+    with session.get(url, params=params, headers=headers, stream=True, timeout=timeout) as response:
+        # 416: the part file already holds everything the server has
+        if response.status_code != 416:
+            response.raise_for_status()
+            resumed = offset and response.status_code == 206
+            with open(part, 'ab' if resumed else 'wb') as file:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    file.write(chunk)
+            if not resumed:
+                offset = 0
+    with open(part, 'rb') as file:
+        if file.read(5) != b'%PDF-':
+            os.remove(part)
+            raise ValueError(f'{url} did not return a PDF')
+    checksum = file_sha256(part)
+    os.replace(part, path)
+    with open(f'{path}.sha256', 'w') as file:
+        file.write(checksum)
+    return 'resumed' if offset else 'downloaded'
+
+
+def download_papers(titles: List, papers: List, dir_path: str, workers = 8, index = None,
+                    existing = None, limiter = None):
+    """
+    Resolve `titles` against `papers` and download the matches in parallel.
+
+    `limiter` (a `resilience.RateLimiter`) spaces out the requests.
+
+    `existing` maps record ids to PDFs that are already in the database
+    (see `catalog.record_paths`); those papers are not fetched again even
+    if their file has a different name.
+
+    Returns:
+      list of dicts with the requested title, matched paper title, file
+      path, status (`downloaded`, `resumed`, `skipped`, `duplicate`,
+      `not_found` or `failed`) and error. `duplicate` titles resolve to a
+      file another title of the same call already downloads.
+    """
+    index = index or TitleIndex(papers)
+    results = []
+    jobs = {}
+    for title in titles:
+        paper = index.resolve(title)
+        if paper is None:
+            results.append({'title': title, 'paper': None, 'path': None, 'status': 'not_found', 'error': None})
+            continue
+        known_path = (existing or {}).get(record_id(paper))
+        if known_path and os.path.exists(known_path):
+            results.append({'title': title, 'paper': paper['title'], 'path': known_path,
+                            'status': 'skipped', 'error': None})
+            continue
+        path = os.path.join(dir_path, pdf_file_name(paper['title']))
+        if path in jobs:
+            results.append({'title': title, 'paper': paper['title'], 'path': path,
+                            'status': 'duplicate', 'error': None})
+            continue
+        jobs[path] = (title, paper)
+
+    session = create_session(workers)
+
+    def run(path):
+        title, paper = jobs[path]
+        result = {'title': title, 'paper': paper['title'], 'path': path, 'error': None}
+        try:
+            if limiter is not None and not is_complete(path):
+                limiter.wait()
+            result['status'] = fetch_pdf(session, paper, path)
+        except Exception as e:
+            result['status'] = 'failed'
+            result['error'] = repr(e)
+        return result
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results.extend(executor.map(run, jobs))
+    session.close()
+    return results
@@ -10,11 +10,93 @@ import xml.etree.ElementTree as et
 from tqdm import tqdm
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+
+from tracing import span
+from downloader import record_id
+
+# Reciprocal rank fusion constant: damps the weight of the very first
+# ranks so that agreement between keywords matters more than position
+RRF_K = 60
+MAX_PAGES = 20
+ARXIV_PAGE_SIZE = 50
+
+
+# Query planner
+def _round(executor, fetch_page, keywords, page):
+    futures = {kw: executor.submit(contextvars.copy_context().run, fetch_page, kw, page) for kw in keywords}
+    results = {}
+    for keyword, future in futures.items():
+        try:
+            results[keyword] = future.result()
+        except Exception as e:
+            print(f'Query "{keyword}" failed on page {page}: {e!r}')
+            results[keyword] = e
+    return results
+
+def _limited(fn, limiter):
+    def wrapper(*args):
+        limiter.wait()
+        return fn(*args)
+    return wrapper
+
+def fan_out(keywords, target, fetch_page, workers = 4, pause = None, progress = None, stage = None,
+            limiter = None):
+    """
+    Search one source with one query per keyword instead of one combined
+    query, and merge the results.
+
+    `fetch_page(keyword, page)` returns the articles of a result page in
+    the order of relevance of the source and whether there are more
+    pages. Every round requests the next page of each keyword that is not
+    exhausted, all at once, and rounds stop as soon as `target` distinct
+    articles are found. Articles are merged by record id and ranked by
+    reciprocal rank fusion, so papers found high up by several keywords
+    come first. A `limiter` (resilience.RateLimiter) paces the page
+    requests of all keywords together.
+
+    Returns:
+      up to `target` articles, most relevant first
+    """
+    if limiter is not None:
+        fetch_page = _limited(fetch_page, limiter)
+    active = list(dict.fromkeys(kw.strip() for kw in keywords if kw and kw.strip()))
+    found = {}
+    scores = defaultdict(float)
+    ranks = dict.fromkeys(active, 0)
+    error = None
+    page = 1
+    with ThreadPoolExecutor(max_workers = max(1, min(workers, len(active)))) as executor:
+        while active and len(found) < target and page <= MAX_PAGES:
+            results = _round(executor, fetch_page, active, page)
+            for keyword, result in results.items():
+                if isinstance(result, Exception):
+                    error = result
+                    active.remove(keyword)
+                    continue
+                articles, more = result
+                for article in articles:
+                    key = record_id(article)
+                    found.setdefault(key, article)
+                    ranks[keyword] += 1
+                    scores[key] += 1 / (RRF_K + ranks[keyword])
+                if not more:
+                    active.remove(keyword)
+            if progress:
+                progress(stage, min(len(found), target), target)
+            page += 1
+            if active and len(found) < target and pause:
+                time.sleep(pause())
+    if not found and error is not None:
+        raise error
+    ranked = sorted(found, key = lambda key: -scores[key])
+    return [found[key] for key in ranked[:target]]
 
 
 # ArXiv parser
-def load_arxiv_articles(max_results, keywords):
-    row_data = []
+def load_arxiv_articles(max_results, keywords, start = 0):
     temp = 'economics'
     
     keywords_with_field = [f'all:"{kw}"' for kw in keywords]
@@ -23,17 +105,30 @@ def load_arxiv_articles(max_results, keywords):
     
     params = {
         'search_query': query,
-        'start': 0,
+        'start': start,
         'max_results': max_results
     }
     query_string = parse.urlencode(params)
     
     url =  f'http://export.arxiv.org/api/query?{query_string}'
-    with request.urlopen(url) as response:
+    with span('http.fetch', source = 'arxiv') as s, request.urlopen(url) as response:
         raw_data = response.read().decode('utf-8')
+        s.set(bytes = len(raw_data))
     return raw_data
 
+def arxiv_page(keyword, page):
+    articles = parse_arxiv_articles(load_arxiv_articles(
+        ARXIV_PAGE_SIZE, [keyword], start = (page - 1) * ARXIV_PAGE_SIZE
+    ))
+    return articles, len(articles) == ARXIV_PAGE_SIZE
+
 def parse_arxiv_articles(raw_data):
+    with span('parse.xml', source = 'arxiv') as s:
+        articles = _parse_arxiv_entries(raw_data)
+        s.set(items = len(articles))
+    return articles
+
+def _parse_arxiv_entries(raw_data):
     articles = []
     root = et.fromstring(raw_data)
     namespace = '{http://www.w3.org/2005/Atom}'
@@ -82,85 +177,85 @@ def nber_full_summary(nber_url):
         'Accept-Encoding': 'gzip, deflate, br',
         'Connection': 'keep-alive',
     }
-    resp = requests.get(nber_url, headers = headers)
-    resp.raise_for_status()
-    soup = BeautifulSoup(resp.content)
-    summary = soup.find('div', class_ = 'page-header__intro-inner').find('p').text
-    summary = summary.replace('\n', '')
+    with span('http.fetch', source = 'nber') as s:
+        resp = requests.get(nber_url, headers = headers)
+        resp.raise_for_status()
+        s.set(bytes = len(resp.content))
+    with span('parse.html', source = 'nber'):
+        soup = BeautifulSoup(resp.content)
+        summary = soup.find('div', class_ = 'page-header__intro-inner').find('p').text
+        summary = summary.replace('\n', '')
     return summary
 
-def load_nber_articles(keywords, max_articles, load_full_abstract = False):
+def nber_page(keyword, page, per_page = 100):
     url = 'https://www.nber.org/api/v1/search'
     headers = {
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
     }
-    all_articles = []
-    
-    words = []
-    for k in keywords:
-        words.extend(k.split())
-    query = '+'.join(words)
-    
-    page = 1
-    while len(all_articles) < max_articles:
-        params = {
-        'q': query,
-        'page': page,
-        'perPage': 100,
-        'sort': 'relevance'
-        }
-    
+    params = {
+    'q': '+'.join(keyword.split()),
+    'page': page,
+    'perPage': per_page,
+    'sort': 'relevance'
+    }
+    with span('http.fetch', source = 'nber') as s:
         response = requests.get(url, params=params, headers=headers)
         response.raise_for_status()
+        s.set(bytes = len(response.content))
+    with span('parse.json', source = 'nber'):
         data = response.json()
-        results = data.get('results', [])
-        total_results = int(data.get('totalResults'))
-        if page == 1:
-                total_results = data.get('totalResults', 0)
-                print(f"Всего найдено статей: {total_results}")
-        if not results:
-            print(f'All available articles on {keywords} are parsed')
-            break
-    
-        for res in tqdm(results, desc = f"Page: {page}"):
-            if len(all_articles) >= max_articles:
-                        break
-            if res.get('type') == 'working_paper':
-                try:
-                    authors = []
-                    authors_html = res.get('authors')
-                    for aut in authors_html:
-                        soup = BeautifulSoup(aut)
-                        author = soup.find('a').text
-                        authors.append(author)
-                    nid = res.get('url', '').split('/')[-1]
-                    article = {
-                        'title': res.get('title', ''),
-                        'authors': authors,
-                        'type': res.get('type', ''),
-                        'id': nid,
-                        'abstract': res.get('abstract', ''),
-                        'publication_date': res.get('displaydate', ''),
-                        'url': f"https://www.nber.org{res.get('url', '')}",
-                        'pdf_url' : f"https://www.nber.org/system/files/working_papers/{nid}/{nid}.pdf",
-                        'source' : 'nber'
-                     }
-                    if load_full_abstract:
-                        abstract = nber_full_summary(article['url'])
-                        article['full_abstract'] = abstract
-                        time.sleep(random.uniform(1,3))
-                    all_articles.append(article)
-            
-                        
-                except Exception as e:
-                    pass
-    
-        
-        progress = len(all_articles) / min(total_results, max_articles) * 100
-        print(f'{round(len(all_articles)/  min(total_results, max_articles) *100,2 )}% are loaded')
-    
-        page += 1
-        time.sleep(random.uniform(0.2, 0.5))
+    results = data.get('results', [])
+    total_results = int(data.get('totalResults') or 0)
+
+    articles = []
+    for res in results:
+        if res.get('type') == 'working_paper':
+            try:
+                authors = []
+                authors_html = res.get('authors')
+                for aut in authors_html:
+                    soup = BeautifulSoup(aut)
+                    author = soup.find('a').text
+                    authors.append(author)
+                nid = res.get('url', '').split('/')[-1]
+                articles.append({
+                    'title': res.get('title', ''),
+                    'authors': authors,
+                    'type': res.get('type', ''),
+                    'id': nid,
+                    'abstract': res.get('abstract', ''),
+                    'publication_date': res.get('displaydate', ''),
+                    'url': f"https://www.nber.org{res.get('url', '')}",
+                    'pdf_url' : f"https://www.nber.org/system/files/working_papers/{nid}/{nid}.pdf",
+                    'source' : 'nber'
+                 })
+            except Exception as e:
+                print(f'Skipped an NBER result for "{keyword}": {e!r}')
+    return articles, bool(results) and page * per_page < total_results
+
+def load_nber_articles(keywords, max_articles, load_full_abstract = False, progress = None, workers = 4,
+                       limiter = None):
+    all_articles = fan_out(
+        keywords, max_articles, nber_page,
+        workers = workers,
+        pause = lambda: random.uniform(0.2, 0.5),
+        progress = progress,
+        stage = 'nber search',
+        limiter = limiter
+    )
+    print(f'{len(all_articles)} NBER articles found for {keywords}')
+    if load_full_abstract:
+        for i, article in enumerate(tqdm(all_articles, desc = 'NBER abstracts'), 1):
+            if limiter is not None:
+                limiter.wait()
+            try:
+                article['full_abstract'] = nber_full_summary(article['url'])
+            except Exception as e:
+                # The short abstract stands in, the enrich stage retries it
+                print(f"No full abstract for {article['url']}: {e!r}")
+            time.sleep(random.uniform(1,3))
+            if progress:
+                progress('nber abstracts', i, len(all_articles))
     return all_articles
 
 # SSRN parser
@@ -191,23 +286,26 @@ def ssrn_article_abstract(article_id, session=None):
     }
     time.sleep(random.uniform(2,6))
     try:
-        resp = session.get(
-            f'https://papers.ssrn.com/sol3/papers.cfm?abstract_id={article_id}',
-            headers=headers,
-            timeout=30
-        )
-        resp.raise_for_status()
-        soup = BeautifulSoup(resp.content)
-        abstract = soup.find('div', class_ = 'abstract-text').find('p').text
-        
-        keywords = []
-        for k in soup.find_all('p'):
-            if 'keywords' in k.text.lower():
-                kw_text = k.text
-                if 'Keywords:' in kw_text:
-                    kw_text = kw_text.split('Keywords:', 1)[1]
-                keywords = [kw.strip() for kw in kw_text.split(',')]
-                break
+        with span('http.fetch', source = 'ssrn') as s:
+            resp = session.get(
+                f'https://papers.ssrn.com/sol3/papers.cfm?abstract_id={article_id}',
+                headers=headers,
+                timeout=30
+            )
+            resp.raise_for_status()
+            s.set(bytes = len(resp.content))
+        with span('parse.html', source = 'ssrn'):
+            soup = BeautifulSoup(resp.content)
+            abstract = soup.find('div', class_ = 'abstract-text').find('p').text
+
+            keywords = []
+            for k in soup.find_all('p'):
+                if 'keywords' in k.text.lower():
+                    kw_text = k.text
+                    if 'Keywords:' in kw_text:
+                        kw_text = kw_text.split('Keywords:', 1)[1]
+                    keywords = [kw.strip() for kw in kw_text.split(',')]
+                    break
         metadata = {
             'full_abstract' : abstract,
             'keywords' : keywords        
@@ -221,15 +319,8 @@ def ssrn_article_abstract(article_id, session=None):
             return None
         raise e
 
-def load_ssrn_articles(keywords, max_articles, load_full_abstract = False):
+def ssrn_page(keyword, page):
     url = "https://api.ssrn.com/papers/v1/papers/search/advanced"
-    all_articles = []
-
-    words = []
-    for k in keywords:
-        words.extend(k.split())
-    query = '+'.join(words)
-    
     headers = {
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
         'Accept': 'application/json, text/plain, */*',
@@ -239,73 +330,101 @@ def load_ssrn_articles(keywords, max_articles, load_full_abstract = False):
         'Referer': 'https://www.ssrn.com/',
         'Origin': 'https://www.ssrn.com',
     }
-    page = 1
-    while len(all_articles) < max_articles: 
-        params = {
-        'text': query,
-        'text_fields': 'title-abstract-keywords',
-        'search_mode': 'fuzzy',
-        'sort_by': '',
-        'page': page,
-        'authors': '',
-        'date': 'all_time'
-        }
+    params = {
+    'text': '+'.join(keyword.split()),
+    'text_fields': 'title-abstract-keywords',
+    'search_mode': 'fuzzy',
+    'sort_by': '',
+    'page': page,
+    'authors': '',
+    'date': 'all_time'
+    }
+    with span('http.fetch', source = 'ssrn') as s:
         response = requests.get(url, params=params, headers=headers)
-        time.sleep(1)
-        response.raise_for_status()
+        s.set(bytes = len(response.content))
+    response.raise_for_status()
+    with span('parse.json', source = 'ssrn'):
         data = response.json()
-        results = data['papers']
-        if not results:
-            print("Больше нет результатов (пустая страница)")
-            break
-        
-        for res in tqdm(results):
-            if len(all_articles) >= max_articles:
-                break
-            snippets_list = res.get('snippets', [])  
-            snippets = ' '.join(snippets_list) if snippets_list else ''
-            authors = res.get('authors')
-            clean_authors = []
-            for a in authors:
-                clean_authors.append(a['full_name'])
-            article = {
-                'title' : res.get('title', '').replace('<em>', '').replace('</em>', ''),
-                'id' : res.get('id'),
-                'authors' : clean_authors,
-                'abstract' : snippets.replace('<em>', '').replace('</em>', ''),
-                'publication_date' : res.get('approved_date', ''),
-                'soucre' : 'ssrn'
-            }
-            if load_full_abstract:
-                meta_data = ssrn_article_abstract(article['id'])
+    results = data['papers']
+
+    articles = []
+    for res in results:
+        snippets_list = res.get('snippets', [])  
+        snippets = ' '.join(snippets_list) if snippets_list else ''
+        authors = res.get('authors')
+        clean_authors = []
+        for a in authors:
+            clean_authors.append(a['full_name'])
+        articles.append({
+            'title' : res.get('title', '').replace('<em>', '').replace('</em>', ''),
+            'id' : res.get('id'),
+            'authors' : clean_authors,
+            'abstract' : snippets.replace('<em>', '').replace('</em>', ''),
+            'publication_date' : res.get('approved_date', ''),
+            'source' : 'ssrn'
+        })
+    return articles, bool(results)
+
+def load_ssrn_articles(keywords, max_articles, load_full_abstract = False, progress = None, workers = 4,
+                       limiter = None):
+    all_articles = fan_out(
+        keywords, max_articles, ssrn_page,
+        workers = workers,
+        pause = lambda: 1,
+        progress = progress,
+        stage = 'ssrn search',
+        limiter = limiter
+    )
+    print(f'{len(all_articles)} SSRN articles found for {keywords}')
+    if load_full_abstract:
+        session = create_session()
+        for i, article in enumerate(tqdm(all_articles, desc = 'SSRN abstracts'), 1):
+            if limiter is not None:
+                limiter.wait()
+            meta_data = ssrn_article_abstract(article['id'], session)
+            # None when SSRN throttles us, the enrich stage retries it
+            if meta_data:
                 article['full_abstract'] = meta_data['full_abstract']
                 article['keywords'] = meta_data['keywords']
-            
-            all_articles.append(article)
-        
-        print(f'Pages loaded {page}')
-        print(f'Articles loaded {len(all_articles)}')
-        page += 1
-        time.sleep(1)
-        
+            if progress:
+                progress('ssrn abstracts', i, len(all_articles))
+        session.close()
     return all_articles
 
 # All articles
-def parse_all_articles(keywords, max_articles, saving_path, load_full_abstract = False, save = False):
+def parse_all_articles(keywords, max_articles, saving_path, load_full_abstract = False, save = False,
+                       progress = None, workers = 4, limiter = None):
+    """
+    Harvest NBER, arXiv and SSRN articles for `keywords`.
+
+    Each source is searched with one query per keyword (see `fan_out`),
+    `workers` queries at a time, all requests paced by `limiter`.
+    `progress(stage, done, total)` is called as articles of each source
+    are loaded.
+    """
 
     nber_articles = int(max_articles * 0.5)
-    nber_papers = load_nber_articles(keywords, max_articles = nber_articles, 
-                                     load_full_abstract = load_full_abstract)
+    with span('harvest', source = 'nber') as s:
+        nber_papers = load_nber_articles(keywords, max_articles = nber_articles, 
+                                         load_full_abstract = load_full_abstract,
+                                         progress = progress, workers = workers, limiter = limiter)
+        s.set(items = len(nber_papers))
     print('==' * 40)
     print(f'{len(nber_papers)} NBER articles are parsed')
 
     arxiv_articles = int(max_articles * 0.1)
-    arxiv_papers = parse_arxiv_articles(load_arxiv_articles(max_results = arxiv_articles, keywords = keywords))
+    with span('harvest', source = 'arxiv') as s:
+        arxiv_papers = fan_out(keywords, arxiv_articles, arxiv_page, workers = workers, pause = lambda: 3,
+                              progress = progress, stage = 'arxiv search', limiter = limiter)
+        s.set(items = len(arxiv_papers))
     print('\n', '==' * 20)
     print(f'{len(arxiv_papers)} arXiv articles are parsed')
 
     ssrn_articles = int(max_articles * 0.4)
-    ssrn_papers = load_ssrn_articles(keywords, ssrn_articles, load_full_abstract = load_full_abstract)
+    with span('harvest', source = 'ssrn') as s:
+        ssrn_papers = load_ssrn_articles(keywords, ssrn_articles, load_full_abstract = load_full_abstract,
+                                         progress = progress, workers = workers, limiter = limiter)
+        s.set(items = len(ssrn_papers))
     print('\n', '==' * 20)
     print(f'{len(ssrn_papers)} SSRN articles are parsed')
     
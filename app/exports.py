@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+PDF, Markdown and HTML exports of answers and conversations.
+
+Rendered files are cached on disk by content hash, so asking for the same
+export twice costs one file read. Markdown and HTML conversations are
+rendered in segments of `SEGMENT_SIZE` messages; finished segments are
+never rendered again and only the last one changes while a conversation
+grows. PDFs are typeset as one flowing document, so segment boundaries
+don't force page breaks; the price is that a PDF of a growing
+conversation is typeset again in full on every new message.
+"""
+import io
+import os
+import html
+import hashlib
+from functools import lru_cache
+from itertools import islice
+from xml.sax.saxutils import escape
+
+from tracing import span
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+EXPORT_CACHE = os.path.join(APP_DIR, 'export_cache')
+CACHE_MAX_FILES = 500
+SEGMENT_SIZE = 50
+
+EXPORT_FORMATS = {
+    'pdf': 'application/pdf',
+    'md': 'text/markdown',
+    'html': 'text/html'
+}
+
+
+@lru_cache(maxsize=1)
+def _pdf_styles():
+    from reportlab.lib.enums import TA_CENTER, TA_JUSTIFY
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+
+    styles = getSampleStyleSheet()
+    title_style = ParagraphStyle(
+        'CustomTitle',
+        parent=styles['Heading1'],
+        fontSize=18,
+        alignment=TA_CENTER,
+        spaceAfter=24,
+        fontName='Helvetica-Bold'
+    )
+    text_style = ParagraphStyle(
+        'CustomText',
+        parent=styles['Normal'],
+        fontSize=12,
+        alignment=TA_JUSTIFY,
+        leading=14.5,
+        wordWrap='LTR',  # Перенос слов
+        fontName='Helvetica'
+    )
+    return title_style, text_style
+
+
+def save_pdf(text, title):
+    return save_pdf_paragraphs(text.split('\n'), title)
+
+
+def save_pdf_paragraphs(paragraphs, title, markup = False):
+    """
+    PDF from an iterable of paragraphs, consumed lazily while the story is
+    built. Paragraphs are plain text and escaped for reportlab unless
+    `markup` says they already are paragraph markup.
+    """
+    from reportlab.lib.pagesizes import letter
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
+    from reportlab.lib.units import inch
+
+    buffer = io.BytesIO()
+
+    margins = {
+        'leftMargin': 1*inch,
+        'rightMargin': 1*inch,
+        'topMargin': 1*inch,
+        'bottomMargin': 1*inch
+    }
+    doc = SimpleDocTemplate(
+        buffer,
+        pagesize=letter,
+        **margins,
+        title=title,
+        author="Generated by Streamlit App",
+        subject="Document",
+        creator="Streamlit PDF Generator"
+    )
+    title_style, text_style = _pdf_styles()
+    story = []
+    if title:
+        story.append(Paragraph(escape(title), title_style))
+        story.append(Spacer(1, 0.25*inch))
+    for para in paragraphs:
+        if para.strip():  # Пропускаем пустые строки
+            story.append(Paragraph(para if markup else escape(para), text_style))
+            story.append(Spacer(1, 0.12*inch))
+    doc.build(story)
+
+    buffer.seek(0)
+
+    return buffer
+
+
+def _markdown(paragraphs, title):
+    parts = [f'# {title}\n'] if title else []
+    parts.extend(para for para in paragraphs if para.strip())
+    return ('\n\n'.join(parts) + '\n').encode('utf-8')
+
+
+def _html_body(paragraphs, title):
+    parts = [f'<h1>{html.escape(title)}</h1>'] if title else []
+    parts.extend(f'<p>{html.escape(para)}</p>' for para in paragraphs if para.strip())
+    return '\n'.join(parts) + '\n'
+
+
+def _html_page(body, title):
+    return (
+        '<!DOCTYPE html>\n<html><head><meta charset="utf-8">'
+        f'<title>{html.escape(title)}</title></head><body>\n{body}</body></html>\n'
+    ).encode('utf-8')
+
+
+def render(fmt, paragraphs, title):
+    """Render paragraphs to `fmt` bytes without caching"""
+    if fmt == 'pdf':
+        with span('pdf.render', paragraphs = len(paragraphs)) as s:
+            data = save_pdf_paragraphs(paragraphs, title).getvalue()
+            s.set(bytes = len(data))
+        return data
+    if fmt == 'md':
+        return _markdown(paragraphs, title)
+    if fmt == 'html':
+        return _html_page(_html_body(paragraphs, title), title)
+    raise ValueError(f'Unknown export format: {fmt}')
+
+
+def content_hash(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def _cached(key, build):
+    path = os.path.join(EXPORT_CACHE, key)
+    if os.path.exists(path):
+        with open(path, 'rb') as file:
+            return file.read()
+    data = build()
+    os.makedirs(EXPORT_CACHE, exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(data)
+    os.replace(tmp_path, path)
+    _prune()
+    return data
+
+
+def _prune():
+    files = [os.path.join(EXPORT_CACHE, f) for f in os.listdir(EXPORT_CACHE)]
+    if len(files) <= CACHE_MAX_FILES:
+        return
+    files.sort(key=os.path.getmtime)
+    for path in files[:len(files) - CACHE_MAX_FILES]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def export(fmt, paragraphs, title):
+    """Cached export of a list of paragraphs"""
+    paragraphs = list(paragraphs)
+    key = content_hash(fmt, title, *paragraphs) + f'.{fmt}'
+    return _cached(key, lambda: render(fmt, paragraphs, title))
+
+
+def export_conversation(fmt, messages, title = 'Full conversation', segment_size = SEGMENT_SIZE):
+    """
+    Export a conversation from an iterable of messages (dicts with `content`).
+
+    Messages are consumed `segment_size` at a time. For Markdown and HTML
+    every segment is rendered and cached on its own; a PDF is typeset from
+    all messages as one document and cached as a whole.
+    """
+    if fmt == 'pdf':
+        paragraphs = [line for mes in messages for line in mes['content'].split('\n')]
+        return export('pdf', paragraphs, title)
+    messages = iter(messages)
+    segments = []
+    while batch := list(islice(messages, segment_size)):
+        paragraphs = [line for mes in batch for line in mes['content'].split('\n')]
+        segment_title = title if not segments else ''
+        if fmt == 'html':
+            key = content_hash('html-body', segment_title, *paragraphs) + '.html'
+            build = lambda: _html_body(paragraphs, segment_title).encode('utf-8')
+        else:
+            key = content_hash(fmt, segment_title, *paragraphs) + f'.{fmt}'
+            build = lambda: render(fmt, paragraphs, segment_title)
+        segments.append(_cached(key, build))
+    if not segments:
+        return render(fmt, [], title)
+    if fmt == 'html':
+        return _html_page(b''.join(segments).decode('utf-8'), title)
+    return b'\n'.join(segments)
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Headless FAISS index building shared by the pages and the job worker.
+"""
+import os
+import glob
+import time
+import shutil
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from resilience import ResilientEmbeddings, guard_llm
+from downloader import record_id
+from catalog import list_pdfs, set_index_status, scan
+from corpus import read_papers, corpus_version
+from text_store import DEFAULT_SPLITTER, iter_chunked_pdfs, chunk_stats
+from paper_scope import save_paper_ranges, stored_documents
+from registry import get_index_path, write_manifest
+
+DOCUMENT_FIELDS = ('title', 'source', 'url', 'pdf_url')
+# Index versions kept on disk: the live one and the one before it, which
+# sessions or the worker may still be loading
+KEEP_VERSIONS = 2
+
+
+def create_documents(papers: List):
+    from langchain_core.documents import Document
+
+    documents = []
+    for paper in papers:
+        structured_text = f"""
+        ECONOMIC RESEARCH PAPER
+        TITLE: {paper['title']}
+        ABSTRACT: {paper['full_abstract']}
+        """
+        # The record itself stays in the corpus, documents only keep its id
+        # and what is shown next to an answer
+        metadata = {key: paper[key] for key in DOCUMENT_FIELDS if paper.get(key)}
+        metadata['record_id'] = record_id(paper)
+        doc = Document(
+            page_content = structured_text,
+            metadata = metadata
+        )
+        documents.append(doc)
+    return documents
+
+
+def load_full_documents(db_path, settings = DEFAULT_SPLITTER):
+    """
+    Chunks of all catalogued PDFs under `db_path`.
+
+    Text and chunk boundaries come from the text store, so PDFs that were
+    seen before with the same splitter settings are not parsed again.
+    """
+    documents = []
+    pdfs = []
+    for pdf, chunks in iter_chunked_pdfs(db_path, settings):
+        documents.extend(chunks)
+        pdfs.append(pdf)
+    if settings['kind'] == 'sections':
+        stats = chunk_stats(db_path, pdfs, settings)
+        print(f'{stats.chunks} chunks instead of {stats.baseline_chunks}, '
+              f'{stats.vectors_saved} vectors saved; dropped blocks: {dict(stats.dropped)}')
+    return documents
+
+
+def get_embedder(api_creds):
+    """
+    Guarded Yandex embeddings client; with an `endpoint` in `api_creds`,
+    a client of a local stand-in server instead (see stand_ins.py)
+    """
+    if api_creds.get('endpoint'):
+        from stand_ins import ServerEmbeddings
+
+        return ResilientEmbeddings(ServerEmbeddings(endpoint = api_creds['endpoint']))
+
+    from langchain_community.embeddings.yandex import YandexGPTEmbeddings
+
+    return ResilientEmbeddings(YandexGPTEmbeddings(
+        api_key = api_creds['api_key'],
+        folder_id = api_creds['folder_id'],
+        sleep_interval = .1
+    ))
+
+
+def get_llm(api_creds, temperature = 0.):
+    """Guarded YandexGPT runnable, or the stand-in server's LLM like `get_embedder`"""
+    if api_creds.get('endpoint'):
+        from stand_ins import ServerLLM
+
+        return guard_llm(ServerLLM(endpoint = api_creds['endpoint'], temperature = temperature))
+
+    from langchain_community.llms import YandexGPT
+
+    return guard_llm(YandexGPT(
+        name="yandexgpt",
+        api_key = api_creds['api_key'],
+        folder_id = api_creds['folder_id'],
+        temperature = temperature
+    ))
+
+
+def embed_texts(documents, embedder, progress = None, batch_size = 64, workers = 1):
+    """
+    (text, vector) pairs of `documents`, embedded in batches by up to
+    `workers` threads.
+
+    `progress(stage, done, total)` is called after every batch.
+    """
+    texts = [doc.page_content for doc in documents]
+    batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+    # Every batch runs in a copy of the caller's context, so its spans keep the session
+    contexts = [contextvars.copy_context() for _ in batches]
+    vectors = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch_vectors in executor.map(lambda context, batch: context.run(embedder.embed_documents, batch),
+                                          contexts, batches):
+            vectors.extend(batch_vectors)
+            if progress:
+                progress('embed', len(vectors), len(texts))
+    return list(zip(texts, vectors))
+
+
+def embed_documents(documents, embedder, progress = None, batch_size = 64, workers = 1):
+    """Build a FAISS store from `documents`, embedding them in batches"""
+    from langchain_community.vectorstores import FAISS
+
+    return FAISS.from_embeddings(
+        embed_texts(documents, embedder, progress, batch_size, workers),
+        embedder,
+        metadatas = [doc.metadata for doc in documents]
+    )
+
+
+def build_index(state, db_path, api_creds, index_path = None, progress = None, workers = 1):
+    """
+    Build and save the `abstract` or `full` FAISS index for a database.
+
+    Returns:
+      dict with the index path, the number of indexed documents and, for
+      the full-text index, the chunking stats
+    """
+    index_path = index_path or get_index_path(db_path, state)
+    if progress:
+        progress('load', 0, 1)
+    info = {}
+    if state == 'abstract':
+        papers = read_papers(db_path)
+        # Taken right after the sync, so records synced later trigger the next build
+        info['corpus_version'] = corpus_version(db_path)
+        documents = create_documents(papers)
+    else:
+        documents = load_full_documents(db_path)
+    if progress:
+        progress('load', 1, 1)
+    vectorestore = embed_documents(documents, get_embedder(api_creds), progress = progress, workers = workers)
+    save_index(vectorestore, index_path, state, db_path, **info)
+    result = {'index_path': index_path, 'documents': len(documents)}
+    if state == 'full':
+        indexed = {os.path.relpath(doc.metadata['source'], db_path) for doc in documents}
+        set_index_status(db_path, indexed, 'indexed')
+        stats = chunk_stats(db_path, [pdf for pdf in list_pdfs(db_path) if pdf['path'] in indexed])
+        result['chunk_stats'] = stats.as_dict()
+    return result
+
+
+def save_index(vectorestore, index_path, kind, db_path, **info):
+    """
+    Save an index into a new versioned folder next to the live one and
+    swap it in. `info` goes to the manifest.
+
+    `index_path` is a symlink to the current version, replaced with a
+    single `os.replace`, so readers never load a half written index nor
+    find the path missing. Where symlinks are not available the folder
+    itself is swapped, with a short window without an index. Versions
+    older than the last `KEEP_VERSIONS` are removed.
+    """
+    version_path = f'{index_path}.v{time.time_ns()}'
+    link_path = f'{index_path}.{os.getpid()}.link'
+    old_path = f'{index_path}.{os.getpid()}.old'
+    vectorestore.save_local(version_path)
+    save_paper_ranges(version_path, stored_documents(vectorestore))
+    write_manifest(
+        version_path,
+        kind = kind,
+        db_path = db_path,
+        documents = vectorestore.index.ntotal,
+        splitter = DEFAULT_SPLITTER if kind == 'full' else None,
+        **info
+    )
+    try:
+        # Relative, so the database folder can be moved
+        os.symlink(os.path.basename(version_path), link_path)
+    except (OSError, NotImplementedError):
+        link_path = None
+    if link_path is None or (os.path.isdir(index_path) and not os.path.islink(index_path)):
+        # No symlinks, or an index saved before versioned folders
+        if os.path.lexists(index_path):
+            os.replace(index_path, old_path)
+        if link_path is None:
+            os.replace(version_path, index_path)
+    if link_path is not None:
+        os.replace(link_path, index_path)
+    shutil.rmtree(old_path, ignore_errors=True)
+    _prune_versions(index_path)
+
+
+def _prune_versions(index_path, keep = KEEP_VERSIONS):
+    live = os.path.realpath(index_path)
+    versions = [path for path in glob.glob(glob.escape(index_path) + '.v*') if path.rsplit('.v', 1)[1].isdigit()]
+    versions.sort(key = lambda path: int(path.rsplit('.v', 1)[1]), reverse = True)
+    for path in versions[keep:]:
+        if os.path.realpath(path) != live:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def update_index(db_path, api_creds, index_path = None, progress = None, workers = 1):
+    """
+    Bring the full-text index in line with the PDFs of a database.
+
+    Only PDFs whose content is not indexed yet are chunked and embedded;
+    chunks of removed or changed PDFs are deleted. Builds the index from
+    scratch when it does not exist.
+
+    Returns:
+      dict with the index path and the numbers of added and removed papers
+      and chunks
+    """
+    from langchain_community.vectorstores import FAISS
+
+    index_path = index_path or get_index_path(db_path, 'full')
+    if not os.path.exists(index_path):
+        return dict(build_index('full', db_path, api_creds, index_path, progress, workers), rebuilt = True)
+    if progress:
+        progress('scan', 0, 1)
+    scan(db_path)
+    pdfs = {pdf['content_hash']: pdf for pdf in list_pdfs(db_path)}
+    embedder = get_embedder(api_creds)
+    # A private copy, not the registry's: the store is changed in place
+    vectorestore = FAISS.load_local(index_path, embedder, allow_dangerous_deserialization=True)
+    indexed = {}
+    for doc_id, doc in vectorestore.docstore._dict.items():
+        indexed.setdefault(doc.metadata.get('content_hash'), []).append(doc_id)
+    stale = [content_hash for content_hash in indexed if content_hash not in pdfs]
+    # PDFs that failed to chunk are retried once their text changes
+    new = [
+        pdf for content_hash, pdf in pdfs.items()
+        if content_hash not in indexed and pdf['index_status'] != 'error'
+    ]
+    if progress:
+        progress('scan', 1, 1)
+    if stale:
+        vectorestore.delete([doc_id for content_hash in stale for doc_id in indexed[content_hash]])
+    documents = []
+    added = []
+    for pdf, chunks in iter_chunked_pdfs(db_path, pdfs = new):
+        documents.extend(chunks)
+        added.append(pdf)
+    if documents:
+        # Appended chunks of a paper stay contiguous, so paper ranges keep working
+        vectorestore.add_embeddings(
+            embed_texts(documents, embedder, progress, workers = workers),
+            metadatas = [doc.metadata for doc in documents]
+        )
+    if stale or documents:
+        save_index(vectorestore, index_path, 'full', db_path)
+    set_index_status(db_path, [pdf['path'] for pdf in added], 'indexed')
+    return {
+        'index_path': index_path,
+        'added_papers': len(added),
+        'failed_papers': len(new) - len(added),
+        'added_chunks': len(documents),
+        'removed_papers': len(stale),
+        'removed_chunks': sum(len(indexed[content_hash]) for content_hash in stale)
+    }
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Local job queue for long running work (article harvesting, index builds
+and updates).
+
+Jobs live in a SQLite table and are executed by a separate worker
+process, so they keep running across Streamlit reruns and closed tabs.
+Pages submit jobs with `submit_job` and poll them with `get_job`. Spans
+traced while a job runs (see tracing.py) come back in its result under
+`spans`, tagged with the `trace_session` param when the job has one.
+
+Start a worker by hand with:
+
+    python jobs.py worker
+"""
+import os
+import sys
+import json
+import time
+import sqlite3
+import threading
+import traceback
+import subprocess
+from contextlib import closing
+
+from tracing import bind, clear, get_spans
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+JOBS_DB = os.path.join(APP_DIR, 'jobs.sqlite3')
+API_CREDS_FILE = os.path.join(APP_DIR, 'apicreds.json')
+HEARTBEAT_TIMEOUT = 15
+POLL_INTERVAL = 1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    params TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    stage TEXT,
+    done INTEGER DEFAULT 0,
+    total INTEGER DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id);
+CREATE TABLE IF NOT EXISTS workers (
+    pid INTEGER PRIMARY KEY,
+    heartbeat REAL NOT NULL
+);
+"""
+
+
+def connect(db_file = None):
+    conn = sqlite3.connect(db_file or JOBS_DB, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def _as_dict(row):
+    if row is None:
+        return None
+    job = dict(row)
+    job['params'] = json.loads(job['params'])
+    job['result'] = json.loads(job['result']) if job['result'] else None
+    job['progress'] = job['done'] / job['total'] if job['total'] else 0.
+    return job
+
+
+def _job_key(params):
+    # The tracing session says who asked, not what to do
+    return json.dumps({k: v for k, v in params.items() if k != 'trace_session'}, sort_keys=True)
+
+
+def submit_job(kind, params, start_worker = True):
+    """
+    Queue a job and make sure a worker is alive. Returns the job id.
+
+    While an identical job is queued or running its id is returned
+    instead, so sessions asking for the same build at once share it.
+    """
+    now = time.time()
+    key = _job_key(params)
+    with closing(connect()) as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        rows = conn.execute(
+            "SELECT id, params FROM jobs WHERE kind = ? AND status IN ('queued', 'running')", (kind,)
+        ).fetchall()
+        job_id = next((row['id'] for row in rows if _job_key(json.loads(row['params'])) == key), None)
+        if job_id is None:
+            job_id = conn.execute(
+                'INSERT INTO jobs (kind, params, created_at, updated_at) VALUES (?, ?, ?, ?)',
+                (kind, json.dumps(params), now, now)
+            ).lastrowid
+        conn.execute('COMMIT')
+    if start_worker:
+        ensure_worker()
+    return job_id
+
+
+def get_job(job_id):
+    with closing(connect()) as conn:
+        return _as_dict(conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone())
+
+
+def list_jobs(kind = None, limit = 20):
+    query = 'SELECT * FROM jobs'
+    args = ()
+    if kind:
+        query += ' WHERE kind = ?'
+        args = (kind,)
+    with closing(connect()) as conn:
+        rows = conn.execute(query + ' ORDER BY id DESC LIMIT ?', args + (limit,)).fetchall()
+    return [_as_dict(row) for row in rows]
+
+
+def latest_job(kind, statuses = ('queued', 'running'), db_path = None):
+    """Newest job of `kind` in one of `statuses`, for one database if `db_path` is given"""
+    marks = ','.join('?' * len(statuses))
+    query = f'SELECT * FROM jobs WHERE kind = ? AND status IN ({marks})'
+    args = (kind, *statuses)
+    if db_path is not None:
+        query += " AND json_extract(params, '$.db_path') = ?"
+        args += (db_path,)
+    with closing(connect()) as conn:
+        row = conn.execute(query + ' ORDER BY id DESC LIMIT 1', args).fetchone()
+    return _as_dict(row)
+
+
+def report_progress(job_id, stage, done, total):
+    with closing(connect()) as conn:
+        conn.execute(
+            'UPDATE jobs SET stage = ?, done = ?, total = ?, updated_at = ? WHERE id = ?',
+            (stage, done, total, time.time(), job_id)
+        )
+
+
+def worker_alive():
+    with closing(connect()) as conn:
+        row = conn.execute('SELECT MAX(heartbeat) FROM workers').fetchone()
+    return row[0] is not None and time.time() - row[0] < HEARTBEAT_TIMEOUT
+
+
+def ensure_worker():
+    """Start a detached worker process unless one is already running"""
+    if worker_alive():
+        return
+    log = open(os.path.join(APP_DIR, 'jobs_worker.log'), 'ab')
+    subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), 'worker'],
+        cwd = APP_DIR,
+        stdout = log,
+        stderr = log,
+        start_new_session = True
+    )
+    # Register right away so that concurrent submits don't spawn twins
+    with closing(connect()) as conn:
+        conn.execute('INSERT OR REPLACE INTO workers VALUES (?, ?)', (-1, time.time()))
+
+
+def _claim(conn):
+    conn.execute('BEGIN IMMEDIATE')
+    row = conn.execute(
+        "SELECT * FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1"
+    ).fetchone()
+    if row is not None:
+        conn.execute(
+            "UPDATE jobs SET status = 'running', updated_at = ? WHERE id = ?",
+            (time.time(), row['id'])
+        )
+    conn.execute('COMMIT')
+    return _as_dict(row)
+
+
+def run_harvest(job_id, params):
+    from econs_parsing import parse_all_articles
+    from corpus import sync
+
+    papers = parse_all_articles(
+        keywords = params['keywords'],
+        max_articles = params['max_articles'],
+        saving_path = params['db_path'],
+        load_full_abstract = params.get('load_full_abstract', True),
+        save = True,
+        progress = lambda stage, done, total: report_progress(job_id, stage, done, total)
+    )
+    sync(params['db_path'])
+    return {
+        'articles': len(papers),
+        'path': os.path.join(params['db_path'], 'articles.json')
+    }
+
+
+def run_index_build(job_id, params):
+    from indexing import build_index
+
+    with open(API_CREDS_FILE) as file:
+        api_creds = json.load(file)
+    return build_index(
+        params['state'],
+        params['db_path'],
+        api_creds,
+        index_path = params.get('index_path'),
+        progress = lambda stage, done, total: report_progress(job_id, stage, done, total)
+    )
+
+
+def run_index_update(job_id, params):
+    from indexing import update_index
+
+    with open(API_CREDS_FILE) as file:
+        api_creds = json.load(file)
+    return update_index(
+        params['db_path'],
+        api_creds,
+        index_path = params.get('index_path'),
+        progress = lambda stage, done, total: report_progress(job_id, stage, done, total)
+    )
+
+
+HANDLERS = {
+    'harvest': run_harvest,
+    'index_build': run_index_build,
+    'index_update': run_index_update
+}
+
+
+def _heartbeat(pid, stop):
+    with closing(connect()) as conn:
+        while not stop.wait(HEARTBEAT_TIMEOUT / 3):
+            conn.execute('INSERT OR REPLACE INTO workers VALUES (?, ?)', (pid, time.time()))
+
+
+def work(idle_exit = 300):
+    """Run queued jobs one by one; exit after `idle_exit` seconds without work"""
+    conn = connect()
+    pid = os.getpid()
+    conn.execute('DELETE FROM workers WHERE pid = -1')
+    conn.execute('DELETE FROM workers WHERE heartbeat < ?', (time.time() - HEARTBEAT_TIMEOUT,))
+    if not worker_alive():
+        # Jobs left running by a dead worker are picked up again
+        conn.execute("UPDATE jobs SET status = 'queued' WHERE status = 'running'")
+    conn.execute('INSERT OR REPLACE INTO workers VALUES (?, ?)', (pid, time.time()))
+    stop = threading.Event()
+    threading.Thread(target=_heartbeat, args=(pid, stop), daemon=True).start()
+    idle_since = time.time()
+    while time.time() - idle_since < idle_exit:
+        job = _claim(conn)
+        if job is None:
+            time.sleep(POLL_INTERVAL)
+            continue
+        session = job['params'].get('trace_session') or f"job-{job['id']}"
+        bind(session)
+        try:
+            result = HANDLERS[job['kind']](job['id'], job['params'])
+            if isinstance(result, dict):
+                result['spans'] = get_spans(session)
+            conn.execute(
+                "UPDATE jobs SET status = 'done', result = ?, updated_at = ? WHERE id = ?",
+                (json.dumps(result), time.time(), job['id'])
+            )
+        except Exception:
+            conn.execute(
+                "UPDATE jobs SET status = 'failed', error = ?, updated_at = ? WHERE id = ?",
+                (traceback.format_exc(), time.time(), job['id'])
+            )
+        clear(session)
+        idle_since = time.time()
+    stop.set()
+    conn.execute('DELETE FROM workers WHERE pid = ?', (pid,))
+    conn.close()
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['worker']:
+        work()
+    else:
+        print(__doc__)
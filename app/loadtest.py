@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Load test of the pages with many concurrent simulated sessions.
+
+A throwaway database is built once. Its records are replayed from the
+benchmark fixtures, its PDFs are typeset from their abstracts, and both
+indexes are embedded by a local `FakeModelServer`. Every concurrency
+level then runs in a fresh process, so the memory numbers belong to that
+level alone. Each simulated analyst is a Streamlit `AppTest` session in
+its own thread, and walks through one of the flows:
+
+    chat     Texts search: load the database, ask questions over abstracts
+    deep     Articles analysis: ask questions over the full texts
+    gallery  Articles database: open the gallery and page through it
+
+For every level the report has the interactions per second, the p50, p95
+and p99 latency of a rerun, the errors, and the process memory: resident
+size before and after the sessions, and the growth per session. The
+efficiency column is the throughput divided by the single-session
+throughput times the number of sessions. A drop there is a scaling
+cliff.
+
+    python loadtest.py --concurrency 1 5 10 20 --flows chat deep gallery --turns 3
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from benchmark import FIXTURES_DIR, SCENARIO_FILE, DEFAULT_SCENARIO, harvest, bench_harvest, percentile, peak_rss_mb
+from stand_ins import FakeModelServer
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+PAGES = {
+    'chat': os.path.join(APP_DIR, 'pages', '3_Texts_search.py'),
+    'deep': os.path.join(APP_DIR, 'pages', '4_Articles_analysis.py'),
+    'gallery': os.path.join(APP_DIR, 'pages', '7_Articles_database.py')
+}
+DB_NAME = 'loadtest'
+QUESTIONS = (
+    'What are the effects of tariffs on prices?',
+    'How does trade policy uncertainty affect investment?',
+    'Which firms gain from export subsidies?',
+    'What do we know about exchange rate pass-through?'
+)
+
+
+def rss_mb():
+    """Current resident memory of this process"""
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmRSS:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return peak_rss_mb()
+
+
+def prepare_database(db_path, endpoint, n_pdfs = 40):
+    """Corpus from the benchmark fixtures, typeset PDFs and both indexes"""
+    from corpus import Corpus
+    from catalog import scan
+    from exports import render
+    from downloader import pdf_file_name
+    from indexing import build_index
+
+    if not os.path.exists(os.path.join(FIXTURES_DIR, SCENARIO_FILE)):
+        record_path = tempfile.mkdtemp(prefix='loadtest_record_')
+        harvest(DEFAULT_SCENARIO, FIXTURES_DIR, record_path, synthetic = True)
+        shutil.rmtree(record_path, ignore_errors=True)
+    with open(os.path.join(FIXTURES_DIR, SCENARIO_FILE), encoding='utf-8') as file:
+        scenario = json.load(file)
+    bench_harvest(scenario, FIXTURES_DIR, db_path)
+    for paper in list(Corpus(db_path))[:n_pdfs]:
+        paragraphs = [paper['title']] + [paper.get('full_abstract') or ''] * 6
+        with open(os.path.join(db_path, pdf_file_name(paper['title'])), 'wb') as file:
+            file.write(render('pdf', paragraphs, paper['title']))
+    scan(db_path)
+    api_creds = {'endpoint': endpoint}
+    build_index('abstract', db_path, api_creds)
+    build_index('full', db_path, api_creds)
+
+
+def _isolate(db_path, work_dir, endpoint):
+    """
+    Point the app's stores at `work_dir` and register the test database in
+    this process only. Jobs queued by the pages run in a worker thread of
+    this process against the stand-in `endpoint`, never in the detached
+    production worker.
+    """
+    import jobs
+    import registry
+    import startup
+    import thumbnails
+    import conversations
+
+    read_config = registry.read_config
+    registry.read_config = lambda: dict(read_config(), databases = {DB_NAME: db_path})
+    conversations.CONVERSATIONS_DB = os.path.join(work_dir, 'conversations.sqlite3')
+    thumbnails.THUMBNAIL_CACHE = os.path.join(work_dir, 'thumbnails')
+    jobs.JOBS_DB = os.path.join(work_dir, 'jobs.sqlite3')
+    jobs.API_CREDS_FILE = os.path.join(work_dir, 'apicreds.json')
+    with open(jobs.API_CREDS_FILE, 'w', encoding='utf-8') as file:
+        json.dump({'endpoint': endpoint}, file)
+    worker = []
+    lock = threading.Lock()
+
+    def ensure_worker():
+        with lock:
+            if not worker:
+                worker.append(threading.Thread(target=jobs.work, name='loadtest-jobs', daemon=True))
+                worker[0].start()
+
+    jobs.ensure_worker = ensure_worker
+    # Prewarming would load the indexes with the production embeddings client
+    startup._started.add(db_path)
+
+
+def _button(at, label):
+    return next(button for button in at.button if button.label == label)
+
+
+def _session(flow, endpoint, turns, timeout):
+    """Interactions of one simulated analyst: list of (seconds, error)"""
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(PAGES[flow], default_timeout = timeout)
+    at.session_state['api_creds'] = {'endpoint': endpoint}
+    at.session_state['db_name'] = DB_NAME
+    steps = [lambda: at.run()]
+    if flow == 'chat':
+        steps.append(lambda: _button(at, 'I already have a database').click().run())
+    if flow in ('chat', 'deep'):
+        steps += [
+            lambda i=i: at.chat_input[0].set_value(QUESTIONS[i % len(QUESTIONS)]).run()
+            for i in range(turns)
+        ]
+    else:
+        steps += [lambda i=i: at.number_input[0].set_value(i % 2 + 1).run() for i in range(turns)]
+    timings = []
+    for step in steps:
+        start = time.perf_counter()
+        try:
+            step()
+            error = repr(at.exception[0].value) if at.exception else None
+        except Exception as e:
+            error = repr(e)
+        timings.append((time.perf_counter() - start, error))
+    return timings
+
+
+def run_level(db_path, endpoint, flows, sessions, turns, timeout = 120):
+    """One concurrency level, meant to run in a fresh process"""
+    work_dir = tempfile.mkdtemp(prefix='loadtest_state_')
+    try:
+        _isolate(db_path, work_dir, endpoint)
+        base_rss = rss_mb()
+        results = [None] * sessions
+
+        def analyst(i):
+            results[i] = (flows[i % len(flows)], _session(flows[i % len(flows)], endpoint, turns, timeout))
+
+        threads = [threading.Thread(target=analyst, args=(i,)) for i in range(sessions)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        seconds = time.perf_counter() - start
+        end_rss = rss_mb()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    latencies = {}
+    errors = []
+    for flow, timings in results:
+        latencies.setdefault(flow, []).extend(t for t, _ in timings)
+        errors += [error for _, error in timings if error]
+    every = [t for values in latencies.values() for t in values]
+    return {
+        'sessions': sessions,
+        'seconds': round(seconds, 2),
+        'interactions': len(every),
+        'throughput': round(len(every) / seconds, 2),
+        'p50': round(percentile(every, .5), 3),
+        'p95': round(percentile(every, .95), 3),
+        'p99': round(percentile(every, .99), 3),
+        'flows': {
+            flow: {'p50': round(percentile(values, .5), 3), 'p95': round(percentile(values, .95), 3)}
+            for flow, values in latencies.items()
+        },
+        'errors': len(errors),
+        'first_errors': errors[:3],
+        'base_rss_mb': base_rss,
+        'end_rss_mb': end_rss,
+        'rss_per_session_mb': round((end_rss - base_rss) / sessions, 1),
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+
+def print_table(levels):
+    print(f"{'sessions':>8} {'req/s':>7} {'eff':>5} {'p50 s':>7} {'p95 s':>7} {'p99 s':>7} "
+          f"{'errors':>6} {'rss MB':>8} {'MB/sess':>8}")
+    for level in levels:
+        print(f"{level['sessions']:>8} {level['throughput']:>7} {level['efficiency']:>5} {level['p50']:>7} "
+              f"{level['p95']:>7} {level['p99']:>7} {level['errors']:>6} {level['end_rss_mb']:>8} "
+              f"{level['rss_per_session_mb']:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Drive concurrent simulated sessions through the pages')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 5, 10, 20])
+    parser.add_argument('--flows', nargs='+', choices=list(PAGES), default=list(PAGES))
+    parser.add_argument('--turns', type=int, default=3, help='questions or page flips per session')
+    parser.add_argument('--latency', type=float, default=.2, help='seconds per model server request')
+    parser.add_argument('--jitter', type=float, default=.1)
+    parser.add_argument('--pdfs', type=int, default=40, help='PDFs in the test database')
+    parser.add_argument('--db', help='reuse a test database kept by an earlier run')
+    parser.add_argument('--keep', action='store_true', help='keep the test database for later runs')
+    parser.add_argument('--out', help='save the report to this JSON file')
+    args = parser.parse_args()
+
+    db_path = args.db or tempfile.mkdtemp(prefix='loadtest_db_')
+    levels = []
+    try:
+        with FakeModelServer(latency = args.latency, jitter = args.jitter) as server:
+            if not args.db:
+                print(f'Preparing the test database in {db_path} ...', flush=True)
+                prepare_database(db_path, server.url, args.pdfs)
+            context = multiprocessing.get_context('spawn')
+            for sessions in args.concurrency:
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    level = executor.submit(
+                        run_level, db_path, server.url, args.flows, sessions, args.turns
+                    ).result()
+                base = levels[0] if levels else level
+                level['efficiency'] = round(
+                    level['throughput'] * base['sessions'] / (base['throughput'] * sessions), 2
+                )
+                levels.append(level)
+                print(f"{sessions} sessions: {level['throughput']} interactions/s, "
+                      f"p95 {level['p95']} s, {level['errors']} errors", flush=True)
+    finally:
+        if args.keep:
+            print(f'Test database kept in {db_path}')
+        elif not args.db:
+            shutil.rmtree(db_path, ignore_errors=True)
+    print()
+    print_table(levels)
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as file:
+            json.dump({'settings': vars(args), 'levels': levels}, file, indent=2)
+    return 1 if any(level['errors'] for level in levels) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,40 +2,30 @@
 # coding: utf-8
 
 import os
-import io
+import re
 import json
-import datetime
+import uuid
 import streamlit as st
-import urllib.request
-from pathlib import Path
-
-from langchain_community.embeddings.yandex import YandexGPTEmbeddings
-from langchain_community.chat_models import ChatYandexGPT
-from langchain_community.llms import YandexGPT
-from langchain_community.vectorstores import FAISS
-from langchain_core.documents import Document
+
 from langchain_core.prompts import PromptTemplate
 from langchain_core.runnables import RunnablePassthrough
 from langchain_core.output_parsers import StrOutputParser
-from langchain_community.document_loaders import DirectoryLoader, PyMuPDFLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-
-from econs_parsing import parse_all_articles
-
-import os
-import random
-import requests
-import json
-import glob
-import re
-from typing import List
 
-from reportlab.lib.pagesizes import letter
-from reportlab.pdfgen import canvas
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
-from reportlab.lib.enums import TA_CENTER, TA_JUSTIFY
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import inch
+from exports import EXPORT_FORMATS, export, export_conversation
+from batch_runner import get_sources_chain, load_questions, run_batch, export_jsonl, export_pdf
+from resilience import FallbackRetriever, UpstreamError, latency_report, traced_prompt
+from indexing import read_papers, get_embedder
+from jobs import submit_job, get_job, latest_job
+from watcher import start_watcher
+from startup import prewarm, import_report
+from registry import list_databases, resolve_database, set_database, get_index_path, load_index
+from downloader import download_papers
+from catalog import record_paths, scan as scan_catalog
+from conversations import resolve_session, add_message, count_messages, latest_messages, iter_messages
+from tracing import bind, span, add_spans
+from perf_panel import show_performance
+
+HISTORY_PAGE = 20
 
 ########## Funtions block
 def read_json(file_path):
@@ -44,87 +34,64 @@ def read_json(file_path):
     return access_data
 
 
-def create_documents(papers: List):
-    documents = []
-    for paper in papers:
-        structured_text = f"""
-        ECONOMIC RESEARCH PAPER
-        TITLE: {paper['title']}
-        ABSTRACT: {paper['full_abstract']}
-        """
-        paper['structured_text'] = structured_text
-        content = paper.get('structured_text')
-        metadata = paper.copy()
-        metadata.pop('full_abstract')
-        if 'abstract' in paper.keys():
-            metadata.pop('abstract')
-        metadata.pop('structured_text')
-        doc = Document(
-            page_content = content,
-            metadata = metadata
-        )
-        documents.append(doc)
-    return documents
-
 @st.cache_resource
 def upload_database(db_path):
-    json_files = glob.glob(os.path.join(db_path, "*.json"))
-    if not json_files:
-        raise FileNotFoundError(f"No JSON files found in {db_path}")
-    json_file = json_files[0]
-    with open(json_file, 'r', encoding='utf-8') as file:
-        data = json.load(file)
-    return data
+    return read_papers(db_path)
 
-@st.cache_resource
-def initialize_faiss_vectorstore(state = 'abstract'):
-    DB_PATH = st.session_state.db_path
-
-    text_splitter = RecursiveCharacterTextSplitter(
-                chunk_size=1000,  
-                chunk_overlap=200  
-            )
-    
-    embedder  = YandexGPTEmbeddings(
-        api_key = st.session_state.api_creds['api_key'],
-        folder_id = st.session_state.api_creds['folder_id'],
-        sleep_interval = .1
-    )
-    FAISS_INDEX_PATH = "./faiss_index_abstract" if state == "abstract" else "./faiss_index_full"
-    if os.path.exists(FAISS_INDEX_PATH):
-       with st.spinner('Loading FAISS index...'):
-            vectorestore = FAISS.load_local(
-                FAISS_INDEX_PATH, 
-                embedder, 
-                allow_dangerous_deserialization=True
-            )
-            st.success("FAISS index has been successfully loaded")
-            return vectorestore
-    elif state == "abstract":
-        papers = st.session_state.papers
-        documents = create_documents(papers)
-        
+def initialize_faiss_vectorstore(index_path):
+    """
+    Load the abstract index. It is built by a background job (see
+    `index_build_status`), so a rerun or a closed tab doesn't stop the build.
+    """
+    embedder  = get_embedder(st.session_state.api_creds)
+    with st.spinner('Loading FAISS index...'):
+        vectorestore = load_index(index_path, embedder)
+        st.success("FAISS index has been successfully loaded")
+        return vectorestore
+
+@st.fragment(run_every=2)
+def index_build_status(job_id):
+    """Progress of the background abstract index build"""
+    job = get_job(job_id)
+    if job['status'] in ('queued', 'running'):
+        stage = job['stage'] or 'waiting for worker'
+        st.progress(
+            job['progress'],
+            text=f"Building the abstract index in background ({stage}: {job['done']}/{job['total']})"
+        )
+    elif job['status'] == 'failed':
+        st.error("Index build failed")
+        st.code(job['error'])
+        if st.button("Build the index again"):
+            st.session_state.pop('index_build_job', None)
+            st.rerun()
     else:
-        loader = DirectoryLoader(
-            DOCS_PATH, 
-            glob="**/*.pdf", 
-            loader_cls=PyMuPDFLoader,
-            show_progress=True, 
-            use_multithreading=True
+        st.rerun()
+
+@st.fragment(run_every=2)
+def harvest_status(job_id):
+    """Progress of a background harvest job, refreshed every 2 seconds"""
+    job = get_job(job_id)
+    if job is None:
+        st.session_state.harvest_job = None
+    elif job['status'] in ('queued', 'running'):
+        stage = job['stage'] or 'waiting for worker'
+        st.progress(
+            job['progress'],
+            text=f"Parsing the articles in background ({stage}: {job['done']}/{job['total']}). "
+                 "You can leave this page, the job keeps running."
         )
-        articles = loader.load()
-        documents = f
-        st.info(f"Loaded {len(articles)} PDFs, split into {len(documents)} chunks")
-        os.makedirs(os.path.dirname(FAISS_INDEX_PATH) or ".", exist_ok=True)
-        
-    with st.spinner('Creating embeddings'):
-            vectorestore = FAISS.from_documents(
-                documents = documents,
-                embedding = embedder
-                )
-            vectorestore.save_local(FAISS_INDEX_PATH)
-            st.success("FAISS index created and saved")
-            return vectorestore 
+    elif job['status'] == 'failed':
+        st.session_state.harvest_job = None
+        st.error("Parsing failed")
+        st.code(job['error'])
+    else:
+        st.session_state.harvest_job = None
+        add_spans(job['result'].pop('spans', []))
+        st.session_state.harvest_result = job['result']
+        upload_database.clear()
+        st.session_state.papers = upload_database(st.session_state.db_path)
+        st.rerun()
                 
 
 def get_rag_chain(template, temperature, api_creds, vectorestore = None,  k_max = None):
@@ -142,19 +109,13 @@ def get_rag_chain(template, temperature, api_creds, vectorestore = None,  k_max
       RAG chain instance
     
     """
-    system_prompt = PromptTemplate.from_template(template) 
-    llm = YandexGPT(
-        name="yandexgpt",
-        api_key=api_creds['api_key'], 
-        folder_id=api_creds['folder_id'],
-        temperature = temperature
-    )
+    from indexing import get_llm
+
+    system_prompt = traced_prompt(PromptTemplate.from_template(template))
+    llm = get_llm(api_creds, temperature)
         
     if vectorestore:
-        retriever = vectorestore.as_retriever(
-            search_type = 'similarity',
-            search_kwargs={"k": k_max}
-        )
+        retriever = FallbackRetriever(vectorestore = vectorestore, k = k_max)
         rag_chain =  (
             {"context": retriever, "question": RunnablePassthrough()}
             | system_prompt
@@ -172,106 +133,35 @@ def get_rag_chain(template, temperature, api_creds, vectorestore = None,  k_max
     
     return rag_chain
     
-def save_pdf(text, title):
-    buffer = io.BytesIO()
-
-    margins = {
-        'leftMargin': 1*inch,
-        'rightMargin': 1*inch,
-        'topMargin': 1*inch,
-        'bottomMargin': 1*inch
-    }
-    doc = SimpleDocTemplate(
-        buffer, 
-        pagesize=letter,
-        **margins,
-        title=title,
-        author="Generated by Streamlit App",
-        subject="Document",
-        creator="Streamlit PDF Generator"
-    )
-    styles = getSampleStyleSheet()
-    title_style = ParagraphStyle(
-        'CustomTitle',
-        parent=styles['Heading1'],
-        fontSize=18,
-        alignment=TA_CENTER,
-        spaceAfter=24,
-        fontName='Helvetica-Bold'
-    )
-    text_style = ParagraphStyle(
-        'CustomText',
-        parent=styles['Normal'],
-        fontSize=12,
-        alignment=TA_JUSTIFY,  
-        leading=14.5, 
-        wordWrap='LTR',  # Перенос слов
-        fontName='Helvetica'
-    )
-    story = []
-    story.append(Paragraph(title, title_style))
-    story.append(Spacer(1, 0.25*inch))
-    paragraphs = text.split('\n')
-    for para in paragraphs:
-        if para.strip():  # Пропускаем пустые строки
-            story.append(Paragraph(para, text_style))
-            story.append(Spacer(1, 0.12*inch))
-    doc.build(story)
-    
-    buffer.seek(0)
-
-    return buffer
-
-def download_full_articles(titles: List, papers: List, dir_path : str):
-    for title in titles:
-        for paper in papers:
-            if title.lower() in paper.get('title').lower():
-                download_path = os.path.join(dir_path, title)
-                if 'pdf_url' in paper.keys():
-                    response = requests.get(paper.get('pdf_url'))
-                    response.raise_for_status()
-                    
-                else:
-                    article_id = paper.get('id')
-                    url = f"https://papers.ssrn.com/sol3/Delivery.cfm/SSRN_ID{article_id}_code459177.pdf"
-                    params = {
-                        'abstractid': article_id,
-                        'mirid': '1',
-                        'type': '2'
-                    }
-                    
-                    headers = {
-                        'User-Agent': 'Mozilla/5.0',
-                        'Referer': f'https://papers.ssrn.com/sol3/papers.cfm?abstract_id={article_id}',
-                        'Accept': 'application/pdf,*/*'
-                    }
-                    
-                    response = requests.get(url, params=params, headers=headers, stream=True)
-                    response.raise_for_status()
-                # if response.status_code == 200:
-                with open(f'{download_path}.pdf', 'wb') as f:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        f.write(chunk)
-
 ############################################################ End of fucntions block     
 
 if "api_creds" not in st.session_state:
     st.session_state.api_creds = read_json('apicreds.json')
-if "db_path" not in st.session_state:
-    st.session_state.db_path = read_json('config.json')['docs_db_path']
-
 
-llm  = YandexGPT(
-        name="yandexgpt",
-        api_key = st.session_state.api_creds['api_key'], 
-        folder_id =st.session_state.api_creds['folder_id']
-    )
 
 st.set_page_config(
     page_title="AI search with chat",
     page_icon="💬"
 )
 st.sidebar.header('Chat-bot with LLM')
+bind(st.session_state.setdefault('trace_session', uuid.uuid4().hex))
+db_names = list(list_databases())
+db_name = st.sidebar.selectbox(
+    'Database',
+    db_names,
+    index = db_names.index(resolve_database(st.session_state, st.query_params))
+)
+db_path = set_database(db_name, st.session_state, st.query_params)
+if st.session_state.get('db_path') != db_path:
+    # Papers, index and title lookup belong to the previous database
+    for key in ('papers', 'vectorestore_abstracts', 'harvest_job', 'index_build_job'):
+        st.session_state.pop(key, None)
+    st.session_state.db_path = db_path
+prewarm(db_path)
+with st.sidebar.expander("Upstream latency"):
+    st.json(latency_report())
+with st.sidebar.expander("Startup"):
+    st.json(import_report())
 st.header('AI assitant for RAG-based economic litrature search and review', divider='rainbow')
 
 st.markdown("""
@@ -352,9 +242,12 @@ if st.session_state.get('mode') == "create_new":
         )
     
         if gpt_input:
-            answer = rag_topic.invoke(gpt_input)
-            keywords = [word.strip() for word in answer.split(',')]
-            st.info("Keywords: " + ', '.join(keywords))
+            try:
+                answer = rag_topic.invoke(gpt_input)
+                keywords = [word.strip() for word in answer.split(',')]
+                st.info("Keywords: " + ', '.join(keywords))
+            except UpstreamError as e:
+                st.error(f"YandexGPT is not available right now: {e}. Enter keywords manually.")
     if gpt_input or input_text:
         num_articles = st.slider(
         "Number of articles to download:",
@@ -380,33 +273,52 @@ if st.session_state.get('mode') == "create_new":
             
 
             if st.button("Begin parsing", type="primary"):
-                with st.spinner("Parsing the articles. It may take up to 20 minutes"):
-                    papers = parse_all_articles(
-                        keywords = keywords, 
-                        max_articles = num_articles,
-                        saving_path = st.session_state.db_path,
-                        load_full_abstract = True, 
-                        save = True)
-                    st.success(f"""
-                    ✅ **Parsing Completed Successfully!**
-                    
-                    **Results:**
-                    - Articles parsed: **{len(papers)}**
-                    - Keywords used: **{len(keywords)}**
-                    - Saved to: `{st.session_state.db_path}`
-                    
-                    **Next steps:**
-                    1. Articles are saved and ready for search
-                    2. You can now use the search functionality
-                    3. Database has been updated
-                    """)
-                    st.session_state.papers = papers
+                st.session_state.harvest_job = submit_job('harvest', {
+                    'keywords': keywords,
+                    'max_articles': num_articles,
+                    'db_path': st.session_state.db_path,
+                    'load_full_abstract': True,
+                    'trace_session': st.session_state.trace_session
+                })
+                st.session_state.harvest_keywords = keywords
+
+# A harvest started earlier (also from another session) is picked up here
+if "harvest_job" not in st.session_state:
+    running_job = latest_job('harvest', db_path = st.session_state.db_path)
+    st.session_state.harvest_job = running_job['id'] if running_job else None
+if st.session_state.harvest_job is not None:
+    harvest_status(st.session_state.harvest_job)
+if harvest_result := st.session_state.pop('harvest_result', None):
+    st.success(f"""
+    ✅ **Parsing Completed Successfully!**
+    
+    **Results:**
+    - Articles parsed: **{harvest_result['articles']}**
+    - Keywords used: **{len(st.session_state.get('harvest_keywords', []))}**
+    - Saved to: `{st.session_state.db_path}`
+    
+    **Next steps:**
+    1. Articles are saved and ready for search
+    2. You can now use the search functionality
+    3. Database has been updated
+    """)
 #####################################################################End of articles parsing
 #####################################################################Abstracts querieng
 if "papers" in st.session_state and st.session_state.papers is not None:
     st.divider()
     if "vectorestore_abstracts" not in st.session_state:
-        st.session_state.vectorestore_abstracts = initialize_faiss_vectorstore()
+        index_path = get_index_path(st.session_state.db_path, 'abstract')
+        if not os.path.exists(index_path):
+            # Sessions asking at the same time share one queued job
+            if st.session_state.get('index_build_job') is None:
+                st.session_state.index_build_job = submit_job('index_build', {
+                    'state': 'abstract',
+                    'db_path': st.session_state.db_path
+                })
+            index_build_status(st.session_state.index_build_job)
+            st.stop()
+        st.session_state.index_build_job = None
+        st.session_state.vectorestore_abstracts = initialize_faiss_vectorstore(index_path)
     st.write('#### Temperature for bot')
     st.write(
         """
@@ -453,30 +365,79 @@ if "papers" in st.session_state and st.session_state.papers is not None:
         k_max = k_max, 
         api_creds = st.session_state.api_creds)
 
+    with st.expander("📋 Batch questions"):
+        st.markdown("""
+        Upload a list of questions (`.txt` with one question per line, `.json` list
+        or `.jsonl`) to run them all at once with the settings above.
+        """)
+        questions_file = st.file_uploader("Questions file", type=["txt", "json", "jsonl"])
+        concurrency = st.slider("Parallel requests", 1, 16, 4)
+        if questions_file and st.button("▶️ Run batch"):
+            questions = load_questions(questions_file.getvalue(), questions_file.name)
+            sources_chain = get_sources_chain(
+                st.session_state.vectorestore_abstracts,
+                system_prompt,
+                temperature,
+                k_max,
+                st.session_state.api_creds
+            )
+            with st.spinner(f"Answering {len(questions)} questions..."):
+                st.session_state.batch_results = run_batch(
+                    sources_chain, questions, max_concurrency = concurrency
+                )
+            st.session_state.batch_pdf_file = None
+            try:
+                st.session_state.batch_pdf_file = export_pdf(st.session_state.batch_results)
+            except Exception as e:
+                st.session_state.batch_pdf_error = repr(e)
+        if st.session_state.get("batch_results"):
+            results = st.session_state.batch_results
+            failed = sum(1 for res in results if res['error'])
+            st.success(f"✅ {len(results) - failed} of {len(results)} questions answered")
+            bcol1, bcol2 = st.columns(2)
+            with bcol1:
+                st.download_button(
+                    label="⬇️ Download JSONL",
+                    data=export_jsonl(results),
+                    file_name="batch_answers.jsonl",
+                    mime="application/jsonl"
+                )
+            with bcol2:
+                if st.session_state.get("batch_pdf_file") is not None:
+                    st.download_button(
+                        label="⬇️ Download PDF",
+                        data=st.session_state.batch_pdf_file,
+                        file_name="batch_answers.pdf",
+                        mime="application/pdf",
+                        key="batch_pdf"
+                    )
+                else:
+                    st.warning(f"PDF export failed: {st.session_state.get('batch_pdf_error')}")
+
     st.write('#### Ask chat-bot your questions')
-    if 'messages' not in st.session_state:
-        st.session_state.messages = []
-    for message in st.session_state.messages:
+    chat_id = resolve_session('search', st.session_state, st.query_params)
+    st.session_state.setdefault('search_history_size', HISTORY_PAGE)
+    hidden = count_messages(chat_id) - st.session_state.search_history_size
+    if hidden > 0 and st.button(f"⬆️ Show earlier messages ({hidden} more)"):
+        st.session_state.search_history_size += HISTORY_PAGE
+    for message in latest_messages(chat_id, st.session_state.search_history_size):
         with st.chat_message(message['role']):
             st.markdown(message['content'])
     if query := st.chat_input('Enter your message'):
         st.chat_message('user').markdown(query)
-        st.session_state.messages.append(
-            {
-                'role': 'user',
-                'content': query
-            }
-        )
-        answer = rag_chain.invoke(query)
-        with st.chat_message('assistant'):
-            st.markdown(answer)
-        st.session_state.messages.append(
-            {
-                'role': 'assistant',
-                'content': answer
-            }
-        )
-        st.session_state.answer = answer
+        add_message(chat_id, 'user', query)
+        try:
+            answer = rag_chain.invoke(query)
+        except UpstreamError as e:
+            answer = None
+            st.error(f"YandexGPT is not available right now: {e}")
+        if answer is not None:
+            with span('render', chars = len(answer)), st.chat_message('assistant'):
+                st.markdown(answer)
+            add_message(chat_id, 'assistant', answer)
+            st.session_state.answer = answer
+            st.session_state.pop("pdf_data", None)
+            st.session_state.pop("conversation_data", None)
     
     if "answer" in st.session_state:
         col1, col2, col3 = st.columns([2,2, 2])
@@ -488,14 +449,22 @@ if "papers" in st.session_state and st.session_state.papers is not None:
         if st.session_state.get("generate_pdf"):
             pdf_title = st.text_input("Type in the file name", key="pdf_title")
         if st.session_state.get("pdf_title"):
-            st.session_state.pdf_data = save_pdf(st.session_state.answer, st.session_state.get("pdf_title"))
+            answer_format = st.radio("Format", list(EXPORT_FORMATS), horizontal=True, key="answer_format")
+            # The file is typeset only on request; repeated requests hit the export cache
+            if st.button("Prepare file", key="prepare_answer"):
+                st.session_state.pdf_data = export(
+                    answer_format,
+                    st.session_state.answer.split('\n'),
+                    st.session_state.pdf_title
+                )
+                st.session_state.pdf_format = answer_format
         
         if st.session_state.get("pdf_data") and st.session_state.get("pdf_title"):
             st.download_button(
-                label="⬇️ Download PDF",
+                label=f"⬇️ Download {st.session_state.pdf_format.upper()}",
                 data=st.session_state.pdf_data,
-                file_name=f"{st.session_state.pdf_title}.pdf",
-                mime="application/pdf"
+                file_name=f"{st.session_state.pdf_title}.{st.session_state.pdf_format}",
+                mime=EXPORT_FORMATS[st.session_state.pdf_format]
             )
                 
         with col2:
@@ -525,15 +494,27 @@ if "papers" in st.session_state and st.session_state.papers is not None:
                 papers_to_load = [paper.strip() for paper in papers_to_load if paper.strip()]
                 if st.button("Download full articles"):
                     with st.spinner("Loading the papers ..."):
-                        download_full_articles(
+                        results = download_papers(
                             papers_to_load,
                             st.session_state.papers, 
-                            st.session_state.db_path
+                            st.session_state.db_path,
+                            index = st.session_state.papers.title_index(),
+                            existing = record_paths(st.session_state.db_path)
                     )
-                
-                    st.session_state.downloaded_titles = papers_to_load
+                    scan_catalog(st.session_state.db_path, st.session_state.papers)
+                    # New PDFs are embedded into the full-text index in background
+                    start_watcher(st.session_state.db_path)
+                    loaded = [res for res in results if res['status'] in ('downloaded', 'resumed', 'skipped')]
+                    st.session_state.downloaded_titles = [res['paper'] for res in loaded]
                     st.session_state.download_complete = True
-                    st.success(f'✅ Downloaded {len(papers_to_load)} papers')
+                    st.success(f'✅ Downloaded {len(loaded)} of {len(papers_to_load)} papers')
+                    for res in results:
+                        if res['status'] == 'not_found':
+                            st.warning(f"No paper matches '{res['title']}'")
+                        elif res['status'] == 'failed':
+                            st.warning(f"Could not download '{res['paper']}': {res['error']}")
+                        elif res['status'] == 'duplicate':
+                            st.info(f"'{res['title']}' is the same file as another title: {os.path.basename(res['path'])}")
                     st.info("Switch to 'Articles analysis' tab to configure analysis")
 
             
@@ -542,19 +523,25 @@ if "papers" in st.session_state and st.session_state.papers is not None:
     
             if download_conversation:
                 st.session_state.full_conversation = not st.session_state.get("full_conversation", False)
-        if st.session_state.get("download_conversation"):
-            messages = []
-            for mes in st.session_state.messages:
-                messages.append(mes.get("content"))
-            conversation = save_pdf("\n".join(messages), title = "Full conversation")
-            st.success("Pdf generated")
-            st.download_button(
-                label="⬇️ Download Conversation",
-                data=conversation,
-                file_name=f"{"full_conversation"}.pdf",
-                mime="application/pdf"
+        if st.session_state.get("full_conversation"):
+            conversation_format = st.radio(
+                "Conversation format", list(EXPORT_FORMATS), horizontal=True, key="conversation_format"
             )
-        
+            if st.button("Prepare conversation", key="prepare_conversation"):
+                st.session_state.conversation_data = export_conversation(
+                    conversation_format, iter_messages(chat_id), title = "Full conversation"
+                )
+                st.session_state.conversation_file = f"full_conversation.{conversation_format}"
+                st.session_state.conversation_mime = EXPORT_FORMATS[conversation_format]
+            if st.session_state.get("conversation_data"):
+                st.download_button(
+                    label="⬇️ Download Conversation",
+                    data=st.session_state.conversation_data,
+                    file_name=st.session_state.conversation_file,
+                    mime=st.session_state.conversation_mime
+                )
+
+show_performance(st.sidebar.expander("Performance"), st.session_state.trace_session)
         
     
                 
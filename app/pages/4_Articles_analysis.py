@@ -3,85 +3,85 @@
 import streamlit as st
 import json
 import os
-import io
-import datetime
-import urllib.request
-from pathlib import Path
-
-from langchain_community.document_loaders import DirectoryLoader, PyMuPDFLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.embeddings.yandex import YandexGPTEmbeddings
-from langchain_community.chat_models import ChatYandexGPT
-from langchain_community.llms import YandexGPT
+import uuid
+
 from langchain_core.prompts import PromptTemplate
 from langchain_core.runnables import RunnablePassthrough
 from langchain_core.output_parsers import StrOutputParser
-from langchain_community.vectorstores import FAISS
+
+from resilience import FallbackRetriever, UpstreamError, latency_report, traced_prompt
+from indexing import get_embedder
+from paper_scope import ScopedRetriever, TwoTierRetriever, load_paper_ranges
+from jobs import submit_job, get_job, latest_job
+from watcher import start_watcher
+from startup import prewarm, import_report
+from registry import list_databases, resolve_database, set_database, get_index_path, load_index, cache_report
+from conversations import resolve_session, add_message, count_messages, latest_messages
+from tracing import bind, span
+from perf_panel import show_performance
+
+HISTORY_PAGE = 20
 
 def read_json(file_path):
     with open(file_path) as file:
         access_data = json.load(file)
     return access_data
 
-@st.cache_resource
-def initialize_faiss_vectorstore():
+def initialize_faiss_vectorstore(index_path):
     """
     Vectorstore database initialization.
     
     We use FAISS instead of Chroma in this application.
+    The index itself is built by a background job (see `index_build_status`)
+    and kept up to date by the folder watcher. Loaded indexes of all
+    databases are shared through the registry's LRU, a swapped index is
+    loaded again.
     
     """
-    API_CREDS = read_json(file_path='apicreds.json')
-    APP_CONFIG = read_json(file_path='config.json')
-    DATA_PATH = f"{APP_CONFIG['docs_db_path']}"
-    FAISS_INDEX_PATH = "./faiss_index_full"
-    
-    embeddings = YandexGPTEmbeddings(
-            api_key = API_CREDS['api_key'],
-            folder_id = API_CREDS['folder_id'],
-            sleep_interval = .1
-        )
-    
-    # If index exists...
-    if os.path.exists(FAISS_INDEX_PATH):
-        with st.spinner('Loading FAISS index...'):
-            vectorstore = FAISS.load_local(
-                FAISS_INDEX_PATH, 
-                embeddings, 
-                allow_dangerous_deserialization=True
-            )
-            st.success("FAISS index loaded")
-            return vectorstore, API_CREDS
-    
-    # ...or create new index
-    with st.spinner('Documents are loading...'):
-
-        loader = DirectoryLoader(
-            DATA_PATH, 
-            glob="**/*.pdf", 
-            loader_cls=PyMuPDFLoader,
-            show_progress=True, 
-            use_multithreading=True
+    if 'api_creds' not in st.session_state:
+        st.session_state.api_creds = read_json(file_path='apicreds.json')
+    if 'embeddings' not in st.session_state:
+        st.session_state.embeddings = get_embedder(st.session_state.api_creds)
+    with st.spinner('Loading FAISS index...'):
+        vectorstore = load_index(index_path, st.session_state.embeddings)
+    key = (index_path, os.path.getmtime(index_path))
+    if st.session_state.get('paper_ranges_key') != key:
+        st.session_state.paper_ranges = load_paper_ranges(vectorstore, index_path)
+        st.session_state.paper_ranges_key = key
+    return vectorstore
+
+@st.cache_resource
+def start_index_watcher(db_path):
+    """Folder watcher that queues incremental updates of the full-text index"""
+    return start_watcher(db_path)
+
+@st.fragment(run_every=5)
+def index_update_status(db_path, index_path, index_mtime):
+    """Background indexing of new papers; reloads the page once the index is swapped"""
+    job = latest_job('index_update', db_path = db_path)
+    if job is not None and job['status'] == 'running':
+        st.caption(f"Indexing new papers in background ({job['stage']}: {job['done']}/{job['total']})")
+    if os.path.getmtime(index_path) != index_mtime:
+        st.rerun()
+
+@st.fragment(run_every=2)
+def index_build_status(job_id):
+    """Progress of the background full-text index build"""
+    job = get_job(job_id)
+    if job['status'] in ('queued', 'running'):
+        stage = job['stage'] or 'waiting for worker'
+        st.progress(
+            job['progress'],
+            text=f"Building the full-text index in background ({stage}: {job['done']}/{job['total']})"
         )
-        docs = loader.load()
-    
-    
-    with st.spinner('Processing documents...'):
-        
-        text_splitter = RecursiveCharacterTextSplitter(
-                chunk_size=1000,  
-                chunk_overlap=200  
-            )
-        splits = text_splitter.split_documents(docs)
-    
-    with st.spinner('Creating FAISS index...'):
-        vectorstore = FAISS.from_documents(splits, embeddings)
-        vectorstore.save_local(FAISS_INDEX_PATH)
-        st.success("FAISS index created and saved")
-    
-    return vectorstore, API_CREDS
+    elif job['status'] == 'failed':
+        st.error("Index build failed")
+        st.code(job['error'])
+    else:
+        st.rerun()
 
-def get_rag_chain(vectorstore, template, temperature, k_max, api_creds):
+def get_rag_chain(vectorstore, template, temperature, k_max, api_creds, paper_ranges = None, papers = None,
+                  abstract_store = None, n_papers = 5):
     """
     RAG initialization with input parameters.
     
@@ -91,23 +91,32 @@ def get_rag_chain(vectorstore, template, temperature, k_max, api_creds):
       :temperature:
       :k_max:
       :api_creds:
+      :paper_ranges: vector id ranges of the indexed papers
+      :papers: keys of the papers to search in, all papers if empty
+      :abstract_store: abstract index to pick `n_papers` candidate papers
+        from when no papers are chosen
+      :n_papers:
 
     Returns:
       RAG chain instance
     
     """
-    
-    retriever = vectorstore.as_retriever(
-            search_type = 'similarity',
-            search_kwargs={"k": k_max}
+    from indexing import get_llm
+
+    if papers:
+        retriever = ScopedRetriever(vectorestore = vectorstore, ranges = paper_ranges, keys = papers, k = k_max)
+    elif abstract_store is not None:
+        retriever = TwoTierRetriever(
+            abstract_store = abstract_store,
+            vectorestore = vectorstore,
+            ranges = paper_ranges,
+            n_papers = n_papers,
+            k = k_max
         )
-    prompt = PromptTemplate.from_template(template) 
-    llm =  YandexGPT(
-        name="yandexgpt",
-        api_key = api_creds['api_key'], 
-        folder_id = api_creds['folder_id'],
-        temperature = temperature
-    )
+    else:
+        retriever = FallbackRetriever(vectorestore = vectorstore, k = k_max)
+    prompt = traced_prompt(PromptTemplate.from_template(template))
+    llm = get_llm(api_creds, temperature)
     rag_chain = rag_chain =  (
             {"context": retriever, "question": RunnablePassthrough()}
             | prompt
@@ -117,15 +126,49 @@ def get_rag_chain(vectorstore, template, temperature, k_max, api_creds):
 
     return rag_chain
 
-if 'vectorstore_full' not in st.session_state:
-    st.session_state.vectorstore_full, st.session_state.api_creds = initialize_faiss_vectorstore()
-
 st.set_page_config(
     page_title="Articles analysis with AI",
     page_icon="💬"
 )
 st.sidebar.header('Chat-bot with LLM')
+bind(st.session_state.setdefault('trace_session', uuid.uuid4().hex))
+db_names = list(list_databases())
+db_name = st.sidebar.selectbox(
+    'Database',
+    db_names,
+    index = db_names.index(resolve_database(st.session_state, st.query_params))
+)
+db_path = set_database(db_name, st.session_state, st.query_params)
+FAISS_INDEX_PATH = get_index_path(db_path, 'full')
+ABSTRACT_INDEX_PATH = get_index_path(db_path, 'abstract')
+prewarm(db_path)
+with st.sidebar.expander("Upstream latency"):
+    st.json(latency_report())
+with st.sidebar.expander("Startup"):
+    st.json(import_report())
+with st.sidebar.expander("Loaded indexes"):
+    st.json(cache_report())
 st.header('AI assitant for RAG-based economic litrature search and review', divider='rainbow')
+
+if not os.path.exists(FAISS_INDEX_PATH):
+    build_job = (
+        latest_job('index_build', db_path = db_path)
+        or latest_job('index_build', ('failed',), db_path = db_path)
+    )
+    if st.button("Build full-text index") or (build_job is None and st.session_state.get('download_complete')):
+        build_job = get_job(submit_job('index_build', {
+            'state': 'full',
+            'db_path': db_path
+        }))
+    if build_job is None:
+        st.info("Full-text index is not built yet. Download papers on the search page or build it now.")
+    else:
+        index_build_status(build_job['id'])
+    st.stop()
+start_index_watcher(db_path)
+index_mtime = os.path.getmtime(FAISS_INDEX_PATH)
+st.session_state.vectorstore_full = initialize_faiss_vectorstore(FAISS_INDEX_PATH)
+index_update_status(db_path, FAISS_INDEX_PATH, index_mtime)
 st.write("#### Documents analysis")
 st.markdown("""
 In this secion can study the selected papers from the database in more detail. 
@@ -176,38 +219,69 @@ st.write(
 )
 k_max = st.slider('Enter the number of documents', 1, 5, 3)
 
+st.write('#### Papers to search in')
+st.write(
+    """
+    Restrict the search to chosen papers, so that focused questions are
+    answered from them only. By default these are the papers downloaded
+    in "Deep study". Leave empty to search the whole library.
+    """
+)
+paper_titles = {r['key']: r['title'] or os.path.basename(r['source'] or r['key']) for r in st.session_state.paper_ranges}
+downloaded = set(st.session_state.get('downloaded_titles', []))
+scope = st.multiselect(
+    'Papers',
+    list(paper_titles),
+    default = [key for key, title in paper_titles.items() if title in downloaded],
+    format_func = paper_titles.get
+)
+abstract_store = None
+if os.path.exists(ABSTRACT_INDEX_PATH):
+    abstract_store = load_index(ABSTRACT_INDEX_PATH, st.session_state.embeddings)
+n_papers = 5
+if not scope and abstract_store is not None:
+    n_papers = st.slider(
+        'Candidate papers picked by their abstracts',
+        1, 20, 5,
+        help = "Without chosen papers, the question is first matched against the abstracts "
+               "and only the full texts of the best matching papers are searched"
+    )
+
 rag_chain = get_rag_chain(
     st.session_state.vectorstore_full, 
     template, 
     temperature, 
     k_max, 
-    st.session_state.api_creds
+    st.session_state.api_creds,
+    st.session_state.paper_ranges,
+    scope,
+    abstract_store,
+    n_papers
 )
 
 st.write('#### Ask chat-bot your questions')
 
-if 'messages' not in st.session_state:
-    st.session_state.messages = []
-
-for message in st.session_state.messages:
+chat_id = resolve_session('analysis', st.session_state, st.query_params)
+st.session_state.setdefault('analysis_history_size', HISTORY_PAGE)
+hidden = count_messages(chat_id) - st.session_state.analysis_history_size
+if hidden > 0 and st.button(f"⬆️ Show earlier messages ({hidden} more)"):
+    st.session_state.analysis_history_size += HISTORY_PAGE
+for message in latest_messages(chat_id, st.session_state.analysis_history_size):
     with st.chat_message(message['role']):
         st.markdown(message['content'])
 
 if query := st.chat_input('Enter your message'):
     st.chat_message('user').markdown(query)
-    st.session_state.messages.append(
-        {
-            'role': 'user',
-            'content': query
-        }
-    )
+    add_message(chat_id, 'user', query)
     
-    answer = rag_chain.invoke(query)
-    with st.chat_message('assistant'):
-        st.markdown(answer)
-    st.session_state.messages.append(
-        {
-            'role': 'assistant',
-            'content': answer
-        }
-    )
+    try:
+        answer = rag_chain.invoke(query)
+    except UpstreamError as e:
+        answer = None
+        st.error(f"YandexGPT is not available right now: {e}")
+    if answer is not None:
+        with span('render', chars = len(answer)), st.chat_message('assistant'):
+            st.markdown(answer)
+        add_message(chat_id, 'assistant', answer)
+
+show_performance(st.sidebar.expander("Performance"), st.session_state.trace_session)
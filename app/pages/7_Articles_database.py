@@ -1,19 +1,12 @@
 #!/usr/bin/env python
 # coding: utf-8
 
-import os
-import io
-import json
 import datetime
 import streamlit as st
-from pathlib import Path
-import fitz
-from PIL import Image
 
-def read_json(file_path):
-    with open(file_path) as file:
-        access_data = json.load(file)
-    return access_data
+from thumbnails import get_thumbnail, pending_count
+from catalog import stale_files, scan_in_background, scanning, count_pdfs, list_pdfs
+from registry import list_databases, resolve_database, set_database
 
 # Page configuration
 st.set_page_config(
@@ -21,83 +14,96 @@ st.set_page_config(
     page_icon='📚'
 )
 st.sidebar.header('Articles Database')
+db_names = list(list_databases())
+db_name = st.sidebar.selectbox(
+    'Database',
+    db_names,
+    index = db_names.index(resolve_database(st.session_state, st.query_params))
+)
 st.header('Database contains downloaded research articles', divider='rainbow')
 
 st.markdown(
-    f"""
+    """
     Here you can view all downloaded articles (PDF files) 
     and manage your research library.
     """
 )
 st.divider()
 
-APP_CONFIG = read_json(file_path='config.json')
-ARTICLES_PATH  = APP_CONFIG.get('docs_db_path')
+ARTICLES_PATH  = set_database(db_name, st.session_state, st.query_params)
 st.write(ARTICLES_PATH)
 
-@st.cache_data
-def get_articles_data(path):
-    """Get all PDF files from the articles directory"""
-    pdf_files = [
-        f for f in os.listdir(path) 
-        if f.lower().endswith('.pdf')
-    ]
-    
+def get_articles_data(path, limit, offset):
+    """Page of catalogued PDFs (newest first) in the gallery's card format"""
     articles = []
-    for f in pdf_files:
-        file_path = os.path.join(path, f)
-        file_size = os.path.getsize(file_path) / (1024 * 1024)  # Size in MB
-        created_time = datetime.datetime.fromtimestamp(os.path.getctime(file_path))
-        
+    for pdf in list_pdfs(path, limit = limit, offset = offset):
         articles.append({
-            'file_name': f,
-            'title': f.replace('.pdf', '').replace('_', ' '),
-            'file_path': file_path,
-            'size_mb': round(file_size, 2),
-            'created': created_time.strftime('%Y-%m-%d %H:%M:%S'),
-            'file_size_bytes': os.path.getsize(file_path)
+            'file_name': pdf['file_name'],
+            'title': pdf['title'],
+            'file_path': pdf['file_path'],
+            'size_mb': round(pdf['size'] / (1024 * 1024), 2),
+            'created': datetime.datetime.fromtimestamp(pdf['created']).strftime('%Y-%m-%d %H:%M:%S'),
+            'file_size_bytes': pdf['size'],
+            'page_count': pdf['page_count']
         })
-    
-    # Sort by creation date (newest first)
-    articles.sort(key=lambda x: x['created'], reverse=True)
     return articles
 
 # Display articles gallery
 st.write('#### Articles Library')
 
-# Get articles
-articles_list = get_articles_data(path=ARTICLES_PATH)
+# New or modified files are parsed in background, the gallery shows the catalog as it is
+stale = stale_files(ARTICLES_PATH)
+if stale:
+    scan_in_background(ARTICLES_PATH, stale)
+n_articles = count_pdfs(ARTICLES_PATH)
 N_COLS = 3
+PAGE_SIZES = [12, 24, 48]
 n_cols = st.slider('Width:', min_value=1, max_value=5, value=N_COLS)
-cols = st.columns(n_cols)
-for i, doc in enumerate(articles_list):
-    with cols[i % n_cols]:
-        pdf_document = fitz.open(doc['file_path'])
-        
-        # Конвертируем первую страницу в изображение
-        page = pdf_document[0]
-        pix = page.get_pixmap(matrix=fitz.Matrix(2, 2))  # Увеличиваем разрешение
-        
-        # Конвертируем в PIL Image
-        img_data = pix.tobytes("ppm")
-        img = Image.open(io.BytesIO(img_data))
-        
-        # Показываем изображение
-        st.image(
-            img,
-            caption=f"{doc['title']}\n📅 {doc['created']} | 📦 {doc['size_mb']} MB",
-            use_container_width=True
-        )
-        with open(doc['file_path'], 'rb') as f:
-            pdf_bytes = f.read()
-        
-        st.download_button(
-            label="⬇️ Download PDF",
-            data=pdf_bytes,
-            file_name=doc['file_name'],
-            mime="application/pdf",
-            key=f"dl_{i}"
-        )
-        
-        pdf_document.close()
-st.divider()
\ No newline at end of file
+
+pcol1, pcol2 = st.columns(2)
+with pcol1:
+    page_size = st.selectbox('Articles per page', PAGE_SIZES)
+n_pages = max(1, -(-n_articles // page_size))
+with pcol2:
+    page_number = st.number_input(f'Page (of {n_pages})', min_value=1, max_value=n_pages, value=1)
+page_articles = get_articles_data(ARTICLES_PATH, limit = page_size, offset = (page_number - 1) * page_size)
+
+def render_gallery(articles, n_cols, refreshing = False):
+    cols = st.columns(n_cols)
+    for i, doc in enumerate(articles):
+        with cols[i % n_cols]:
+            thumbnail = get_thumbnail(doc['file_path'], schedule=False)
+            caption = f"{doc['title']}\n📅 {doc['created']} | 📄 {doc['page_count']} p. | 📦 {doc['size_mb']} MB"
+            if thumbnail:
+                st.image(thumbnail, caption=caption, use_container_width=True)
+            else:
+                st.caption(f"⏳ Preparing preview...\n\n{caption}")
+            # The file is read only for the card the user asked for
+            if st.session_state.get('prepared_download') == doc['file_path']:
+                with open(doc['file_path'], 'rb') as f:
+                    pdf_bytes = f.read()
+                st.download_button(
+                    label="⬇️ Download PDF",
+                    data=pdf_bytes,
+                    file_name=doc['file_name'],
+                    mime="application/pdf",
+                    key=f"dl_{doc['file_path']}"
+                )
+            elif st.button("📄 Get PDF", key=f"prep_{doc['file_path']}"):
+                st.session_state.prepared_download = doc['file_path']
+                st.rerun(scope='fragment')
+    if refreshing and not pending_count() and not scanning(ARTICLES_PATH):
+        # Everything is rendered (or failed) and catalogued, stop the auto refresh
+        st.rerun()
+
+# Missing previews of this page are queued in display order, so the first cards are rendered first
+for doc in page_articles:
+    get_thumbnail(doc['file_path'])
+# Refresh the gallery while previews are rendered or new files are catalogued in background
+refreshing = pending_count() > 0 or scanning(ARTICLES_PATH)
+st.fragment(render_gallery, run_every=2 if refreshing else None)(page_articles, n_cols, refreshing)
+if scanning(ARTICLES_PATH):
+    st.caption("Cataloguing new or changed PDFs in background")
+if pending_count():
+    st.caption(f"Rendering {pending_count()} previews in background")
+st.divider()
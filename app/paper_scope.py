@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Retrieval restricted to chosen papers of a FAISS index.
+
+The chunks of a paper are embedded one after another, so every paper owns
+a contiguous range of vector ids. `build_index` saves these ranges next
+to the index in `papers.json`. A scoped search reconstructs only the
+vectors of the chosen papers and ranks them exactly. It never touches the
+rest of the index.
+
+`TwoTierRetriever` picks the papers itself: it ranks them on the small
+abstract index first and then searches the full-text chunks of the top
+papers only. Both indexes carry the same paper id (`record_id`).
+"""
+import os
+import json
+from typing import Any, List
+
+from langchain_core.retrievers import BaseRetriever
+
+from resilience import UpstreamError, lexical_search
+from tracing import span
+from singleflight import coalesce
+from downloader import record_id
+
+PAPERS_FILE = 'papers.json'
+
+
+def paper_key(metadata):
+    """Id of the paper a chunk belongs to: its record id, else the PDF content hash"""
+    return metadata.get('record_id') or metadata.get('content_hash') or metadata.get('source')
+
+
+def paper_ranges(documents):
+    """
+    Vector id ranges of every paper in `documents`, in index order.
+
+    Returns:
+      list of dicts with `key`, `title`, `source`, `start` and `end`
+    """
+    ranges = []
+    for position, doc in enumerate(documents):
+        key = paper_key(doc.metadata)
+        if ranges and ranges[-1]['key'] == key:
+            ranges[-1]['end'] = position + 1
+        else:
+            ranges.append({
+                'key': key,
+                'title': doc.metadata.get('title'),
+                'source': doc.metadata.get('source'),
+                'start': position,
+                'end': position + 1
+            })
+    return ranges
+
+
+def save_paper_ranges(index_path, documents):
+    with open(os.path.join(index_path, PAPERS_FILE), 'w', encoding='utf-8') as file:
+        json.dump(paper_ranges(documents), file, ensure_ascii=False)
+
+
+def stored_documents(vectorestore):
+    """Documents of a FAISS store in vector id order"""
+    for position in range(vectorestore.index.ntotal):
+        yield vectorestore.docstore.search(vectorestore.index_to_docstore_id[position])
+
+
+def load_paper_ranges(vectorestore, index_path = None):
+    """
+    Paper ranges of a loaded index.
+
+    They are read from `papers.json` when it matches the index and rebuilt
+    from the docstore otherwise (older indexes, or an index changed since).
+    """
+    if index_path:
+        path = os.path.join(index_path, PAPERS_FILE)
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as file:
+                ranges = json.load(file)
+            if ranges and ranges[-1]['end'] == vectorestore.index.ntotal:
+                return ranges
+    return paper_ranges(stored_documents(vectorestore))
+
+
+def scope_spans(ranges, keys):
+    """(start, end) vector id spans of the papers with the given keys"""
+    keys = set(keys)
+    return [(r['start'], r['end']) for r in ranges if r['key'] in keys]
+
+
+def _span_positions(spans):
+    return [position for start, end in spans for position in range(start, end)]
+
+
+def scoped_search(vectorestore, query_vector, spans, k = 4):
+    """
+    Exact search among the vectors of `spans` only.
+
+    Returns:
+      list of (Document, score) with the same score convention as the index
+    """
+    import numpy as np
+    from langchain_community.vectorstores.utils import DistanceStrategy
+
+    if not spans:
+        return []
+    positions = _span_positions(spans)
+    with span('faiss.search', k = k, scoped = len(positions)):
+        vectors = np.vstack([vectorestore.index.reconstruct_n(start, end - start) for start, end in spans])
+        query = np.asarray(query_vector, dtype='float32')
+        if getattr(vectorestore, '_normalize_L2', False):
+            query = query / np.linalg.norm(query)
+        if vectorestore.distance_strategy == DistanceStrategy.MAX_INNER_PRODUCT:
+            scores = vectors @ query
+            order = np.argsort(-scores)[:k]
+        else:
+            scores = ((vectors - query) ** 2).sum(axis=1)
+            order = np.argsort(scores)[:k]
+    return [
+        (vectorestore.docstore.search(vectorestore.index_to_docstore_id[positions[i]]), float(scores[i]))
+        for i in order
+    ]
+
+
+class ScopedRetriever(BaseRetriever):
+    """Similarity search within chosen papers, lexical within them while embeddings are down"""
+    vectorestore: Any
+    ranges: List[dict]
+    keys: List[str]
+    k: int = 4
+
+    def _get_relevant_documents(self, query, *, run_manager = None):
+        key = ('retrieve', id(self.vectorestore), query, self.k, tuple(sorted(self.keys)))
+        return list(coalesce(key, self._search, query))
+
+    def _search(self, query):
+        spans = scope_spans(self.ranges, self.keys)
+        try:
+            query_vector = self.vectorestore.embeddings.embed_query(query)
+        except UpstreamError:
+            documents = [
+                self.vectorestore.docstore.search(self.vectorestore.index_to_docstore_id[p])
+                for p in _span_positions(spans)
+            ]
+            return lexical_search(self.vectorestore, query, self.k, documents = documents)
+        return [doc for doc, _ in scoped_search(self.vectorestore, query_vector, spans, self.k)]
+
+
+class TwoTierRetriever(BaseRetriever):
+    """
+    Coarse-to-fine retrieval: papers from the abstract index, then chunks
+    of those papers from the full-text index.
+
+    Falls back to the whole full-text index when none of the top papers has
+    its full text indexed.
+    """
+    abstract_store: Any
+    vectorestore: Any
+    ranges: List[dict]
+    n_papers: int = 5
+    k: int = 4
+
+    def _get_relevant_documents(self, query, *, run_manager = None):
+        key = ('retrieve', id(self.abstract_store), id(self.vectorestore), query, self.n_papers, self.k)
+        return list(coalesce(key, self._search, query))
+
+    def _search(self, query):
+        try:
+            query_vector = self.vectorestore.embeddings.embed_query(query)
+        except UpstreamError:
+            papers = lexical_search(self.abstract_store, query, self.n_papers)
+            spans = scope_spans(self.ranges, [self._paper_id(doc) for doc in papers])
+            documents = None
+            if spans:
+                documents = [
+                    self.vectorestore.docstore.search(self.vectorestore.index_to_docstore_id[p])
+                    for p in _span_positions(spans)
+                ]
+            return lexical_search(self.vectorestore, query, self.k, documents = documents)
+        with span('faiss.search', k = self.n_papers, index = 'abstract'):
+            papers = self.abstract_store.similarity_search_by_vector(query_vector, k = self.n_papers)
+        spans = scope_spans(self.ranges, [self._paper_id(doc) for doc in papers])
+        if not spans:
+            with span('faiss.search', k = self.k):
+                return self.vectorestore.similarity_search_by_vector(query_vector, k = self.k)
+        return [doc for doc, _ in scoped_search(self.vectorestore, query_vector, spans, self.k)]
+
+    @staticmethod
+    def _paper_id(doc):
+        # Abstract indexes built before the id was stored keep the raw record
+        return doc.metadata.get('record_id') or record_id(doc.metadata)
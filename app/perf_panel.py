@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Sidebar performance panel shared by the chat pages.
+"""
+import streamlit as st
+
+import tracing
+from singleflight import coalesce_report
+
+
+def show_performance(container, session):
+    """Stage timings of this session's traced work, with JSONL and OpenMetrics downloads"""
+    spans = tracing.get_spans(session)
+    with container:
+        st.caption("Work shared between concurrent sessions")
+        st.json(coalesce_report(), expanded=False)
+        if not spans:
+            st.caption("Nothing traced in this session yet")
+            return
+        st.dataframe(tracing.summarize(spans), hide_index=True)
+        col1, col2 = st.columns(2)
+        col1.download_button("JSONL", tracing.export_jsonl(spans), file_name="spans.jsonl", mime="application/jsonl")
+        col2.download_button("OpenMetrics", tracing.export_openmetrics(spans), file_name="spans.prom", mime="text/plain")
+        if st.button("Clear", key="clear_spans"):
+            tracing.clear(session)
@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Headless build of a research database, without Streamlit.
+
+Runs the stages the pages trigger one button at a time:
+
+    harvest   NBER, arXiv and SSRN search results into articles.json
+    enrich    full abstracts and keywords of the harvested records
+    download  PDFs of the records, skipping the ones already in the database
+    extract   page texts and chunks of the PDFs into the text store
+    embed     the abstract index and the full-text index
+
+Harvested records are merged by record id into articles.json, keeping
+the full abstracts of earlier runs, and identical PDFs are collapsed by
+the catalog, so a stage can be run again on a database that already has
+data and only does the missing work. The abstract index is only rebuilt
+when the corpus changed since it was built. Each stage runs its own work
+in parallel; the network stages (harvest, enrich, download) share the
+`--rate` limit. The result is a database folder the app loads as is,
+e.g.:
+
+    python pipeline.py --db-path /data/rag/tariffs --register tariffs \\
+        --keywords "trade war" tariffs --max-articles 500 --workers 8 --rate 2
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+from resilience import RateLimiter
+from tracing import export_jsonl, get_spans
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+STAGES = ('harvest', 'enrich', 'download', 'extract', 'embed')
+ARTICLES_FILE = 'articles.json'
+
+
+def read_json(file_path):
+    with open(file_path, encoding='utf-8') as file:
+        return json.load(file)
+
+
+def write_json(file_path, data):
+    """Write `data` next to `file_path` first, so readers never see a partial file"""
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump(data, file, indent=2)
+    os.replace(tmp_path, file_path)
+
+
+def print_progress(stage, done, total):
+    print(f'  {stage}: {done}/{total}', flush=True)
+
+
+def merge_articles(articles, harvested):
+    """
+    `articles` updated with the `harvested` records, matched by record id.
+    Fields a new record leaves empty keep their old value, so enriched
+    full abstracts and keywords survive a new harvest.
+    """
+    from downloader import record_id
+
+    merged = {record_id(article): article for article in articles}
+    for article in harvested:
+        key = record_id(article)
+        fresh = {name: value for name, value in article.items() if value not in (None, '', [])}
+        merged[key] = dict(merged.get(key, {}), **fresh)
+    return list(merged.values())
+
+
+def harvest(db_path, keywords, max_articles, workers = 4, limiter = None, progress = None):
+    from econs_parsing import parse_all_articles
+    from corpus import sync
+
+    papers = parse_all_articles(
+        keywords = keywords,
+        max_articles = max_articles,
+        saving_path = db_path,
+        load_full_abstract = False,
+        save = False,
+        progress = progress,
+        workers = workers,
+        limiter = limiter
+    )
+    path = os.path.join(db_path, ARTICLES_FILE)
+    articles = read_json(path) if os.path.exists(path) else []
+    merged = merge_articles(articles, papers)
+    write_json(path, merged)
+    sync(db_path)
+    return {'articles': len(papers), 'new': len(merged) - len(articles), 'total': len(merged)}
+
+
+def _full_abstract(article, session):
+    from econs_parsing import nber_full_summary, ssrn_article_abstract
+
+    if article.get('source') == 'nber':
+        return {'full_abstract': nber_full_summary(article['url'])}
+    if article.get('source', article.get('soucre')) == 'ssrn':
+        # None when SSRN throttles us, the record is tried again next run
+        return ssrn_article_abstract(article['id'], session)
+    return None
+
+
+def enrich(db_path, workers = 4, limiter = None, progress = None):
+    """
+    Fetch the full abstract (and SSRN keywords) of every record of
+    articles.json that doesn't have one yet.
+    """
+    from econs_parsing import create_session
+    from corpus import sync
+
+    path = os.path.join(db_path, ARTICLES_FILE)
+    articles = read_json(path)
+    todo = [
+        article for article in articles
+        if not article.get('full_abstract') and article.get('source', article.get('soucre')) in ('nber', 'ssrn')
+    ]
+    session = create_session()
+
+    def run(article):
+        if limiter is not None:
+            limiter.wait()
+        return _full_abstract(article, session)
+
+    enriched = failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run, article): article for article in todo}
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                fields = future.result()
+            except Exception:
+                fields = None
+            if fields:
+                futures[future].update(fields)
+                enriched += 1
+            else:
+                failed += 1
+            if progress:
+                progress('enrich', done, len(todo))
+    session.close()
+    if enriched:
+        write_json(path, articles)
+        sync(db_path)
+    return {'enriched': enriched, 'failed': failed}
+
+
+def download(db_path, workers = 8, limiter = None, max_downloads = None):
+    from corpus import read_papers
+    from catalog import record_paths, scan
+    from downloader import download_papers
+
+    papers = read_papers(db_path)
+    titles = [paper['title'] for paper in papers][:max_downloads]
+    results = download_papers(
+        titles,
+        papers,
+        db_path,
+        workers = workers,
+        index = papers.title_index(),
+        existing = record_paths(db_path),
+        limiter = limiter
+    )
+    scan(db_path, papers)
+    summary = {}
+    for res in results:
+        summary[res['status']] = summary.get(res['status'], 0) + 1
+    return summary
+
+
+def _extract_one(db_path, pdf):
+    from text_store import get_chunks
+
+    return len(get_chunks(db_path, pdf))
+
+
+def extract(db_path, workers = None, progress = None):
+    """Extract and chunk every catalogued PDF in worker processes"""
+    from catalog import list_pdfs, scan
+
+    scan(db_path)
+    pdfs = list_pdfs(db_path)
+    chunks = failed = 0
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        futures = [executor.submit(_extract_one, db_path, pdf) for pdf in pdfs]
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                chunks += future.result()
+            except Exception:
+                failed += 1
+            if progress:
+                progress('extract', done, len(pdfs))
+    return {'pdfs': len(pdfs), 'chunks': chunks, 'failed': failed}
+
+
+def embed(db_path, api_creds, workers = 1, progress = None):
+    """Abstract index, unless it was built from the current corpus, and full-text index update"""
+    from corpus import sync, corpus_version
+    from indexing import build_index, update_index
+    from registry import get_index_path, read_manifest
+
+    sync(db_path)
+    index_path = get_index_path(db_path, 'abstract')
+    manifest = read_manifest(index_path) if os.path.exists(index_path) else {}
+    if manifest.get('corpus_version') == corpus_version(db_path):
+        abstract = {'index_path': index_path, 'documents': manifest.get('documents'), 'skipped': True}
+    else:
+        abstract = build_index('abstract', db_path, api_creds, progress = progress, workers = workers)
+    return {
+        'abstract': abstract,
+        'full': update_index(db_path, api_creds, progress = progress, workers = workers)
+    }
+
+
+def register_database(name, db_path):
+    """Add `db_path` to the databases of config.json under `name`"""
+    path = os.path.join(APP_DIR, 'config.json')
+    config = read_json(path)
+    config.setdefault('databases', {})[name] = os.path.abspath(db_path)
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write(json.dumps(config, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build a research database without the app')
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--db', help='database name from config.json')
+    target.add_argument('--db-path', help='database folder, created if missing')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES))
+    parser.add_argument('--keywords', nargs='+', help='search keywords for the harvest stage')
+    parser.add_argument('--max-articles', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=8,
+                        help='threads of the harvest, enrich and download stages')
+    parser.add_argument('--extract-workers', type=int, help='processes of the extract stage, one per CPU by default')
+    parser.add_argument('--embed-workers', type=int, default=2, help='concurrent embedding batches')
+    parser.add_argument('--rate', type=float, help='max requests per second of the network stages')
+    parser.add_argument('--max-downloads', type=int, help='download at most this many papers')
+    parser.add_argument('--register', metavar='NAME', help='add the database to config.json under NAME')
+    parser.add_argument('--api-creds', default=os.path.join(APP_DIR, 'apicreds.json'))
+    parser.add_argument('--trace', metavar='PATH', help='save the timing spans of the run as JSONL')
+    args = parser.parse_args()
+
+    if 'harvest' in args.stages and not args.keywords:
+        parser.error('--keywords is required for the harvest stage')
+    if args.db:
+        from registry import get_database
+
+        db_path = get_database(args.db)
+    else:
+        db_path = args.db_path
+        os.makedirs(db_path, exist_ok=True)
+    if args.register:
+        register_database(args.register, db_path)
+    limiter = RateLimiter(args.rate)
+
+    for stage in STAGES:
+        if stage not in args.stages:
+            continue
+        print(f'{stage} ...', flush=True)
+        start = time.perf_counter()
+        if stage == 'harvest':
+            result = harvest(db_path, args.keywords, args.max_articles, args.workers, limiter, print_progress)
+        elif stage == 'enrich':
+            result = enrich(db_path, args.workers, limiter, print_progress)
+        elif stage == 'download':
+            result = download(db_path, args.workers, limiter, args.max_downloads)
+        elif stage == 'extract':
+            result = extract(db_path, args.extract_workers, print_progress)
+        else:
+            result = embed(db_path, read_json(args.api_creds), args.embed_workers, print_progress)
+        print(f'{stage} done in {time.perf_counter() - start:.1f} s: {json.dumps(result, default=str)}', flush=True)
+    if args.trace:
+        with open(args.trace, 'w', encoding='utf-8') as file:
+            file.write(export_jsonl(get_spans()))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
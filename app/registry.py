@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Registry of named research databases and an LRU of their loaded indexes.
+
+Databases are listed under `databases` in config.json (name -> folder);
+`docs_db_path` is registered as `default`. Each database keeps its corpus,
+catalog, text store and FAISS indexes in its own folder:
+
+    <db_path>/indexes/abstract/   index.faiss, index.pkl, papers.json, manifest.json
+    <db_path>/indexes/full/
+
+`load_index` keeps recently used indexes in memory, so switching between
+databases doesn't reload them, and evicts the least recently used ones
+once their estimated size exceeds `index_cache_mb` from config.json.
+"""
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+
+from singleflight import coalesce
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+INDEX_DIR = 'indexes'
+MANIFEST_FILE = 'manifest.json'
+DEFAULT_CACHE_MB = 1024
+# Index folders used before indexes moved into the databases
+LEGACY_INDEX_PATHS = {
+    'abstract': os.path.join(APP_DIR, 'faiss_index_abstract'),
+    'full': os.path.join(APP_DIR, 'faiss_index_full')
+}
+
+_cache = OrderedDict()
+_lock = threading.RLock()
+
+
+def read_config():
+    with open(os.path.join(APP_DIR, 'config.json')) as file:
+        return json.load(file)
+
+
+def list_databases():
+    """Mapping of database name to folder, `default` first"""
+    config = read_config()
+    databases = {}
+    if config.get('docs_db_path'):
+        databases['default'] = config['docs_db_path']
+    databases.update(config.get('databases', {}))
+    return databases
+
+
+def get_database(name):
+    databases = list_databases()
+    if name not in databases:
+        raise KeyError(f"Unknown database: {name}")
+    return databases[name]
+
+
+def resolve_database(state, query_params):
+    """
+    Name of the database of this session: the one chosen before, else the
+    `db` query parameter (a shared link), else the first registered one.
+    """
+    databases = list_databases()
+    for name in (state.get('db_name'), query_params.get('db')):
+        if name in databases:
+            return name
+    return next(iter(databases))
+
+
+def set_database(name, state, query_params):
+    """Remember the chosen database in the session and the URL; returns its folder"""
+    state['db_name'] = name
+    query_params['db'] = name
+    return get_database(name)
+
+
+def get_index_path(db_path, kind):
+    """
+    Folder of the `abstract` or `full` index of a database.
+
+    The index of the default database is moved here from its old location
+    next to the app the first time it is asked for.
+    """
+    path = os.path.join(db_path, INDEX_DIR, kind)
+    legacy = LEGACY_INDEX_PATHS[kind]
+    if not os.path.exists(path) and os.path.exists(legacy) and db_path == read_config().get('docs_db_path'):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(legacy, path)
+    return path
+
+
+def write_manifest(path, **info):
+    """Describe the index saved in `path` (documents, settings, build time)"""
+    info.setdefault('built_at', time.time())
+    with open(os.path.join(path, MANIFEST_FILE), 'w', encoding='utf-8') as file:
+        json.dump(info, file, ensure_ascii=False, indent=2)
+
+
+def read_manifest(path):
+    try:
+        with open(os.path.join(path, MANIFEST_FILE), encoding='utf-8') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def index_size(vectorestore):
+    """Rough resident size of a FAISS store in bytes: vectors plus texts"""
+    vectors = vectorestore.index.ntotal * vectorestore.index.d * 4
+    texts = sum(len(doc.page_content) * 2 for doc in vectorestore.docstore._dict.values())
+    return vectors + texts
+
+
+def cache_limit():
+    return read_config().get('index_cache_mb', DEFAULT_CACHE_MB) * 2 ** 20
+
+
+def load_index(path, embeddings):
+    """
+    FAISS store saved in `path`, from the LRU when it is already loaded.
+
+    Entries are keyed by path and mtime, so an index swapped in by a
+    build or update is loaded again. Sessions asking for the same index
+    while it loads wait for that one load.
+    """
+    key = (os.path.abspath(path), os.path.getmtime(path))
+    with _lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key][0]
+    return coalesce(('index_load',) + key, _load, key, embeddings)
+
+
+def _load(key, embeddings):
+    from langchain_community.vectorstores import FAISS
+
+    vectorestore = FAISS.load_local(key[0], embeddings, allow_dangerous_deserialization=True)
+    with _lock:
+        for old_key in [k for k in _cache if k[0] == key[0]]:
+            del _cache[old_key]
+        _cache[key] = (vectorestore, index_size(vectorestore))
+        limit = cache_limit()
+        # The index just asked for always stays, even alone above the limit
+        while len(_cache) > 1 and sum(size for _, size in _cache.values()) > limit:
+            _cache.popitem(last=False)
+    return vectorestore
+
+
+def cache_report():
+    """Loaded indexes, least recently used first, with their size in MB"""
+    with _lock:
+        return [
+            {'path': path, 'size_mb': round(size / 2 ** 20, 1)}
+            for (path, _), (_, size) in _cache.items()
+        ]
@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Resilience helpers for the Yandex API calls.
+
+Every remote call goes through `guarded_call`, which adds a per-call
+deadline, jittered retries for idempotent calls, a per-upstream circuit
+breaker, a cap on the calls in flight per upstream and latency/error
+histograms (see `latency_report`).
+"""
+import re
+import json
+import time
+import random
+import threading
+import contextvars
+from collections import Counter
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeout
+from typing import Any, List
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.runnables import RunnableLambda
+
+from tracing import span
+from singleflight import coalesce
+
+# Upper bounds of the latency buckets, seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+# Attempts of one upstream running at once, abandoned (timed out) ones included
+MAX_IN_FLIGHT = 8
+
+_lock = threading.Lock()
+_breakers = {}
+_histograms = {}
+_slots = {}
+
+
+class UpstreamError(Exception):
+    """Remote service failed, timed out or is switched off by the breaker"""
+
+
+class UpstreamTimeout(UpstreamError):
+    pass
+
+
+class CircuitOpenError(UpstreamError):
+    pass
+
+
+class UpstreamBusy(UpstreamError):
+    """All in-flight slots of the upstream are taken, e.g. by hung calls"""
+
+
+class CircuitBreaker:
+    """
+    Fails fast after `failure_threshold` consecutive failures. After
+    `reset_timeout` seconds a single trial call is let through: success
+    closes the breaker, failure opens it again.
+    """
+    def __init__(self, name, failure_threshold = 5, reset_timeout = 30.):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half_open'
+        return 'open'
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half_open' and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._trial = False
+
+
+class Histogram:
+    """Fixed-bucket latency histogram with error counts by exception type"""
+    def __init__(self):
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.total = 0.
+        self.errors = Counter()
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, error = None):
+        with self._lock:
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    self.buckets[i] += 1
+                    break
+            self.count += 1
+            self.total += seconds
+            if error is not None:
+                self.errors[type(error).__name__] += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(LATENCY_BUCKETS, self.buckets):
+            seen += n
+            if seen >= rank:
+                return bound
+        return LATENCY_BUCKETS[-1]
+
+
+class RateLimiter:
+    """At most `rate` calls per second across all threads; no limit when `rate` is falsy"""
+    def __init__(self, rate = None):
+        self.interval = 1. / rate if rate else 0.
+        self._next = 0.
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def get_breaker(name):
+    with _lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name)
+        return _breakers[name]
+
+
+def get_histogram(name):
+    with _lock:
+        if name not in _histograms:
+            _histograms[name] = Histogram()
+        return _histograms[name]
+
+
+def get_slots(name):
+    with _lock:
+        if name not in _slots:
+            _slots[name] = threading.BoundedSemaphore(MAX_IN_FLIGHT)
+        return _slots[name]
+
+
+def _start(name, fn, args, kwargs, slots):
+    """
+    Run `fn` in its own daemon thread, in a copy of the caller's context.
+    The in-flight slot is only given back when `fn` really returns.
+    """
+    future = Future()
+    context = contextvars.copy_context()
+
+    def run():
+        try:
+            future.set_result(context.run(fn, *args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            slots.release()
+
+    threading.Thread(target=run, name=f'upstream:{name}', daemon=True).start()
+    return future
+
+
+def latency_report():
+    """Per-upstream summary: calls, errors, mean and bucketed p50/p95/p99"""
+    report = {}
+    for name, hist in list(_histograms.items()):
+        report[name] = {
+            'calls': hist.count,
+            'errors': dict(hist.errors),
+            'mean_s': round(hist.total / hist.count, 3) if hist.count else None,
+            'p50_s': hist.quantile(.5),
+            'p95_s': hist.quantile(.95),
+            'p99_s': hist.quantile(.99),
+            'breaker': get_breaker(name).state,
+            'buckets': dict(zip(map(str, LATENCY_BUCKETS), hist.buckets))
+        }
+    return report
+
+
+def guarded_call(name, fn, *args, timeout = 30., retries = 2, idempotent = True,
+                 backoff = 0.5, **kwargs):
+    """
+    Call `fn(*args, **kwargs)` against upstream `name`.
+
+    Each attempt gets `timeout` seconds on a thread of its own, so it never
+    waits behind other calls. Idempotent calls are retried up to `retries`
+    times with full-jitter exponential backoff. The breaker counts one
+    failure per call, not per attempt; while it is open the call fails
+    immediately with `CircuitOpenError`. A timed out attempt cannot be
+    cancelled: its thread is abandoned but keeps one of the upstream's
+    `MAX_IN_FLIGHT` slots until it returns. When no slot is free the call
+    fails fast with `UpstreamBusy`.
+    """
+    breaker = get_breaker(name)
+    hist = get_histogram(name)
+    slots = get_slots(name)
+    if not breaker.allow():
+        raise CircuitOpenError(f'{name} is unavailable, try again later')
+    attempts = retries + 1 if idempotent else 1
+    last_error = None
+    for attempt in range(attempts):
+        if not slots.acquire(blocking=False):
+            busy = UpstreamBusy(f'{name} has {MAX_IN_FLIGHT} calls in flight')
+            hist.observe(0., busy)
+            # A retry that finds no slot reports why the earlier attempt failed
+            last_error = last_error or busy
+            break
+        start = time.monotonic()
+        future = _start(name, fn, args, kwargs, slots)
+        try:
+            result = future.result(timeout=timeout)
+        except FutureTimeout:
+            last_error = UpstreamTimeout(f'{name} did not answer in {timeout} s')
+        except Exception as e:
+            last_error = e
+        else:
+            hist.observe(time.monotonic() - start)
+            breaker.record_success()
+            return result
+        hist.observe(time.monotonic() - start, last_error)
+        if attempt + 1 < attempts:
+            time.sleep(random.uniform(0, backoff * 2 ** attempt))
+    breaker.record_failure()
+    if isinstance(last_error, UpstreamError):
+        raise last_error
+    raise UpstreamError(f'{name} failed: {last_error!r}') from last_error
+
+
+class ResilientEmbeddings(Embeddings):
+    """
+    Wraps an embedder so that every request is guarded. Document lists are
+    sent in batches so a single deadline never has to cover a whole index
+    build; a batch gets `timeout` seconds per text, at most `batch_timeout`.
+    """
+    def __init__(self, embedder, name = 'yandex_embeddings', timeout = 20.,
+                 retries = 2, batch_size = 16, batch_timeout = 60.):
+        self.embedder = embedder
+        self.name = name
+        self.timeout = timeout
+        self.retries = retries
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = []
+        for i in range(0, len(texts), self.batch_size):
+            batch = texts[i:i + self.batch_size]
+            with span('embed', texts = len(batch), tokens = sum(len(_tokens(text)) for text in batch)):
+                vectors.extend(coalesce(
+                    ('embed', self.name) + tuple(batch),
+                    guarded_call, self.name, self.embedder.embed_documents, batch,
+                    timeout = min(self.timeout * len(batch), self.batch_timeout), retries = self.retries
+                ))
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        with span('embed', texts = 1, tokens = len(_tokens(text))):
+            return coalesce(
+                ('embed', self.name, text),
+                guarded_call, self.name, self.embedder.embed_query, text,
+                timeout = self.timeout, retries = self.retries
+            )
+
+
+def guard_llm(llm, name = 'yandexgpt', timeout = 60., retries = 1):
+    """
+    LLM runnable with a deadline, retries and a breaker.
+
+    Identical prompts to an identically configured model that arrive
+    while one of them is being answered share that answer. Token usage in
+    its `llm.generate` span is estimated by word count.
+    """
+    settings = json.dumps(getattr(llm, '_identifying_params', {}), sort_keys=True, default=str)
+
+    def generate(prompt):
+        text = prompt.to_string() if hasattr(prompt, 'to_string') else str(prompt)
+        with span('llm.generate', model = name) as s:
+            answer = coalesce(
+                ('llm', name, settings, text),
+                guarded_call, name, llm.invoke, prompt, timeout = timeout, retries = retries
+            )
+            s.set(tokens_in = len(_tokens(text)), tokens_out = len(_tokens(str(answer))))
+        return answer
+
+    return RunnableLambda(generate)
+
+
+def traced_prompt(prompt):
+    """Prompt runnable whose formatting, the context build, runs in a span"""
+    def build(inputs):
+        with span('context.build', docs = len(inputs.get('context') or [])) as s:
+            value = prompt.invoke(inputs)
+            s.set(chars = len(value.to_string()))
+        return value
+
+    return RunnableLambda(build)
+
+
+def _tokens(text):
+    return re.findall(r'\w+', text.lower())
+
+
+def lexical_search(vectorestore, query, k = 4, documents = None):
+    """
+    Token-overlap ranking over the docstore, used when embeddings are down.
+
+    `documents` limits the ranking to a subset of the stored documents.
+    """
+    terms = set(_tokens(query))
+    if not terms:
+        return []
+    if documents is None:
+        documents = vectorestore.docstore._dict.values()
+    scored = []
+    for doc in documents:
+        counts = Counter(_tokens(doc.page_content))
+        score = sum(counts[t] / (1 + counts[t]) for t in terms)
+        if score:
+            scored.append((score, doc))
+    scored.sort(key=lambda x: x[0], reverse=True)
+    return [doc for _, doc in scored[:k]]
+
+
+class FallbackRetriever(BaseRetriever):
+    """Similarity search that degrades to lexical search while embeddings are unavailable"""
+    vectorestore: Any
+    k: int = 4
+
+    def _get_relevant_documents(self, query, *, run_manager = None):
+        return list(coalesce(('retrieve', id(self.vectorestore), query, self.k), self._search, query))
+
+    def _search(self, query):
+        try:
+            query_vector = self.vectorestore.embeddings.embed_query(query)
+        except UpstreamError:
+            with span('lexical.search') as s:
+                documents = lexical_search(self.vectorestore, query, self.k)
+                s.set(hits = len(documents))
+            return documents
+        with span('faiss.search', k = self.k):
+            return self.vectorestore.similarity_search_by_vector(query_vector, k=self.k)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Process-wide coalescing of identical in-flight work.
+
+All sessions of the Streamlit server share this process. When several
+of them ask for the same thing at once (the same index after a restart,
+the same question's embedding or answer), only the first call runs. The
+others wait for it and get its result, or its exception. Nothing is
+cached: a call that starts after the shared one finished runs again.
+"""
+import threading
+from collections import Counter
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Concurrent calls with equal keys share one execution"""
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.executed = Counter()
+        self.shared = Counter()
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Result of `fn(*args, **kwargs)`, run once for all concurrent callers
+        with the same `key`. The first element of a tuple key names the kind
+        of work in the counters.
+        """
+        kind = key[0] if isinstance(key, tuple) else key
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.executed[kind] += 1
+            else:
+                self.shared[kind] += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def report(self):
+        """Per kind of work: executions and calls served by another call's execution"""
+        with self._lock:
+            return {
+                kind: {'executed': self.executed[kind], 'shared': self.shared[kind]}
+                for kind in sorted(set(self.executed) | set(self.shared), key=str)
+            }
+
+
+_flight = SingleFlight()
+
+
+def coalesce(key, fn, *args, **kwargs):
+    """`SingleFlight.do` on the process-wide group"""
+    return _flight.do(key, fn, *args, **kwargs)
+
+
+def coalesce_report():
+    return _flight.report()
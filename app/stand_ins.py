@@ -0,0 +1,415 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Local stand-ins for the remote services, for offline benchmarks.
+
+- `HashingEmbeddings` is a deterministic embedder: every word is hashed
+  into one of `dim` signed buckets.
+- `FakeModelServer` serves hashing embeddings and canned completions over
+  HTTP after a configurable latency. `ServerEmbeddings` and `ServerLLM`
+  are its clients. `indexing.get_embedder` and `indexing.get_llm` return
+  them when the credentials carry the server's `endpoint`.
+- `Cassette` records the HTTP exchanges of a harvest (NBER and SSRN JSON
+  APIs, abstract pages, arXiv Atom feeds) and replays them. Both
+  `requests` and `urllib` traffic are intercepted. `synthetic_response`
+  makes up plausible answers to the same URLs, so fixtures can be
+  recorded without network access.
+"""
+import io
+import re
+import json
+import time
+import random
+import hashlib
+import threading
+import http.client
+import urllib.error
+import urllib.request
+import urllib.response
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, List, Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.llms import LLM
+
+# Kept before `intercept` can patch it: stand-in clients always reach the server
+_urlopen = urllib.request.urlopen
+
+
+def _bucket(word):
+    return int.from_bytes(hashlib.blake2b(word.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def hashing_vector(text, dim = 256):
+    """L2-normalized signed bag of hashed words"""
+    vector = [0.] * dim
+    for word in re.findall(r'\w+', text.lower()):
+        h = _bucket(word)
+        vector[h % dim] += 1. if h >> 63 else -1.
+    norm = sum(x * x for x in vector) ** .5 or 1.
+    return [x / norm for x in vector]
+
+
+class HashingEmbeddings(Embeddings):
+    """Deterministic in-process embedder with an optional per-call latency"""
+    def __init__(self, dim = 256, latency = 0.):
+        self.dim = dim
+        self.latency = latency
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if self.latency:
+            time.sleep(self.latency)
+        return [hashing_vector(text, self.dim) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+def _answer(prompt, words = 60):
+    """Canned completion: the question and the start of the context"""
+    question = prompt.rsplit('Question:', 1)[-1].split('Answer:', 1)[0].strip()
+    context = ' '.join(prompt.split('Context:', 1)[-1].rsplit('Question:', 1)[0].split()[:words])
+    return f'Stand-in answer to "{question}". Based on: {context}'
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        with server.lock:
+            delay = server.latency + server.rng.uniform(0, server.jitter)
+        time.sleep(delay)
+        if self.path == '/embed':
+            texts = body.get('texts', [])
+            payload = {
+                'embeddings': [hashing_vector(text, server.dim) for text in texts],
+                'tokens': sum(len(text.split()) for text in texts)
+            }
+        elif self.path == '/complete':
+            prompt = body.get('prompt', '')
+            text = _answer(prompt)
+            payload = {
+                'text': text,
+                'usage': {'input_tokens': len(prompt.split()), 'output_tokens': len(text.split())}
+            }
+        else:
+            self.send_error(404)
+            return
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeModelServer:
+    """
+    Embedding and completion endpoints on localhost.
+
+    Args:
+      :latency: seconds every request waits before answering
+      :jitter: extra uniform random wait of up to this many seconds
+      :dim: embedding size
+      :port: 0 picks a free port
+    """
+    def __init__(self, latency = .05, jitter = 0., dim = 256, port = 0, seed = 0):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.latency = latency
+        self.httpd.jitter = jitter
+        self.httpd.dim = dim
+        self.httpd.rng = random.Random(seed)
+        self.httpd.lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='stand-in-server', daemon=True)
+        self._thread.start()
+        return self.url
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def _post(url, payload, timeout = 60):
+    req = urllib.request.Request(
+        url, data=json.dumps(payload).encode('utf-8'), headers={'Content-Type': 'application/json'}
+    )
+    with _urlopen(req, timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+class ServerEmbeddings(Embeddings):
+    """Embeddings client of a `FakeModelServer`"""
+    def __init__(self, endpoint):
+        self.endpoint = endpoint.rstrip('/')
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return _post(f'{self.endpoint}/embed', {'texts': texts})['embeddings']
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+class ServerLLM(LLM):
+    """Completion client of a `FakeModelServer`"""
+    endpoint: str
+    temperature: float = 0.
+
+    @property
+    def _llm_type(self):
+        return 'stand_in'
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs) -> str:
+        payload = {'prompt': prompt, 'temperature': self.temperature}
+        return _post(f"{self.endpoint.rstrip('/')}/complete", payload)['text']
+
+
+def normalize_url(url):
+    """URL with its query parameters sorted, the key of a recorded exchange"""
+    parts = urlsplit(url)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, query, ''))
+
+
+@contextmanager
+def intercept(respond):
+    """
+    Route `requests` and `urllib` traffic through `respond`.
+
+    `respond(method, url, live)` returns (status, content type, body bytes);
+    `live()` performs the real request and returns the same triple.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    from requests.structures import CaseInsensitiveDict
+
+    original_send = HTTPAdapter.send
+    original_urlopen = urllib.request.urlopen
+
+    def send(adapter, prepared, **kwargs):
+        def live():
+            resp = original_send(adapter, prepared, **kwargs)
+            return resp.status_code, resp.headers.get('Content-Type', ''), resp.content
+
+        status, content_type, body = respond(prepared.method, prepared.url, live)
+        resp = requests.Response()
+        resp.status_code = status
+        resp.reason = http.client.responses.get(status, '')
+        resp.headers = CaseInsensitiveDict({'Content-Type': content_type})
+        resp._content = body
+        resp.encoding = 'utf-8'
+        resp.url = prepared.url
+        resp.request = prepared
+        return resp
+
+    def urlopen(url, *args, **kwargs):
+        full_url = url if isinstance(url, str) else url.full_url
+
+        def live():
+            with original_urlopen(url, *args, **kwargs) as resp:
+                return resp.status, resp.headers.get('Content-Type', ''), resp.read()
+
+        status, content_type, body = respond('GET', full_url, live)
+        headers = http.client.HTTPMessage()
+        headers['Content-Type'] = content_type
+        if status >= 400:
+            raise urllib.error.HTTPError(full_url, status, http.client.responses.get(status, ''), headers,
+                                         io.BytesIO(body))
+        return urllib.response.addinfourl(io.BytesIO(body), headers, full_url, status)
+
+    HTTPAdapter.send = send
+    urllib.request.urlopen = urlopen
+    try:
+        yield
+    finally:
+        HTTPAdapter.send = original_send
+        urllib.request.urlopen = original_urlopen
+
+
+class Cassette:
+    """HTTP exchanges of a scenario, stored one JSON object per line"""
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.hits = 0
+        self.misses = []
+        self._lock = threading.Lock()
+        try:
+            with open(path, encoding='utf-8') as file:
+                for line in file:
+                    entry = json.loads(line)
+                    self.entries[(entry['method'], entry['url'])] = entry
+        except FileNotFoundError:
+            pass
+
+    def _store(self, method, url, status, content_type, body):
+        entry = {
+            'method': method,
+            'url': normalize_url(url),
+            'status': status,
+            'content_type': content_type,
+            'body': body.decode('utf-8', 'replace')
+        }
+        with self._lock:
+            self.entries[(method, entry['url'])] = entry
+
+    @contextmanager
+    def record(self, upstream = None):
+        """
+        Record every exchange. `upstream(method, url)` answers instead of
+        the network when given (e.g. `synthetic_response`).
+        """
+        def respond(method, url, live):
+            status, content_type, body = upstream(method, url) if upstream else live()
+            self._store(method, url, status, content_type, body)
+            return status, content_type, body
+
+        with intercept(respond):
+            yield self
+        self.save()
+
+    @contextmanager
+    def replay(self):
+        """Answer from the recorded exchanges; unknown URLs get a 404"""
+        def respond(method, url, live):
+            entry = self.entries.get((method, normalize_url(url)))
+            with self._lock:
+                if entry is None:
+                    self.misses.append(url)
+                    return 404, 'text/plain', b''
+                self.hits += 1
+            return entry['status'], entry['content_type'], entry['body'].encode('utf-8')
+
+        with intercept(respond):
+            yield self
+
+    def save(self):
+        with open(self.path, 'w', encoding='utf-8') as file:
+            for entry in self.entries.values():
+                file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+
+WORDS = (
+    'trade tariff policy growth inflation labor market wage capital productivity firm export import '
+    'monetary fiscal shock welfare household credit bank price demand supply equilibrium elasticity '
+    'investment innovation regional global chain exchange rate uncertainty evidence model data'
+).split()
+SEARCH_SIZE = 1000
+SSRN_PAGE_SIZE = 50
+# Results of different queries start at different papers and overlap
+QUERY_SHIFT = 300
+
+
+def _rng(url):
+    return random.Random(_bucket(normalize_url(url)))
+
+
+def _sentence(rng, n):
+    return ' '.join(rng.choice(WORDS) for _ in range(n)).capitalize() + '.'
+
+
+def _title(rng, number):
+    return f"{' '.join(rng.choice(WORDS) for _ in range(6)).title()} {number}"
+
+
+def _authors(rng):
+    return [f'{rng.choice("ABCDEFGH")}. {rng.choice(WORDS).title()}son' for _ in range(rng.randint(1, 4))]
+
+
+def _shift(text):
+    return _bucket(text or '') % QUERY_SHIFT
+
+
+def _nber_search(query):
+    page, per_page = int(query.get('page', 1)), int(query.get('perPage', 100))
+    shift = _shift(query.get('q'))
+    results = []
+    for number in range(shift + (page - 1) * per_page, shift + min(page * per_page, SEARCH_SIZE)):
+        rng = random.Random(number)
+        results.append({
+            'type': 'working_paper',
+            'title': _title(rng, number),
+            'authors': [f'<a href="/people/{i}">{name}</a>' for i, name in enumerate(_authors(rng))],
+            'url': f'/papers/w{30000 + number}',
+            'abstract': _sentence(rng, 40),
+            'displaydate': f'{rng.randint(1, 28)} May 2025'
+        })
+    return {'totalResults': SEARCH_SIZE, 'results': results}
+
+
+def _ssrn_search(query):
+    page = int(query.get('page', 1))
+    shift = _shift(query.get('text'))
+    papers = []
+    for number in range(shift + (page - 1) * SSRN_PAGE_SIZE, shift + min(page * SSRN_PAGE_SIZE, SEARCH_SIZE)):
+        rng = random.Random(-number - 1)
+        papers.append({
+            'id': 5000000 + number,
+            'title': _title(rng, number),
+            'authors': [{'full_name': name} for name in _authors(rng)],
+            'snippets': [_sentence(rng, 20), _sentence(rng, 20)],
+            'approved_date': f'2025-05-{rng.randint(1, 28):02d}'
+        })
+    return {'papers': papers}
+
+
+def _arxiv_feed(query):
+    ns = 'http://www.w3.org/2005/Atom'
+    entries = []
+    start = _shift(query.get('search_query')) + int(query.get('start', 0))
+    for number in range(start, start + int(query.get('max_results', 10))):
+        rng = random.Random(10 ** 6 + number)
+        authors = ''.join(f'<author><name>{name}</name></author>' for name in _authors(rng))
+        entries.append(
+            f'<entry><id>http://arxiv.org/abs/2505.{number:05d}v1</id>'
+            f'<title>{_title(rng, number)}</title><summary>{_sentence(rng, 120)}</summary>'
+            f'<published>2025-05-{rng.randint(1, 28):02d}T00:00:00Z</published>{authors}'
+            f'<category term="econ.GN"/><category term="q-fin.EC"/></entry>'
+        )
+    return f'<?xml version="1.0" encoding="UTF-8"?><feed xmlns="{ns}">{"".join(entries)}</feed>'
+
+
+def synthetic_response(method, url):
+    """Made-up but well-formed answer of NBER, SSRN or arXiv to `url`"""
+    parts = urlsplit(url)
+    query = dict(parse_qsl(parts.query))
+    rng = _rng(url)
+    if parts.netloc == 'www.nber.org' and parts.path == '/api/v1/search':
+        return 200, 'application/json', json.dumps(_nber_search(query)).encode('utf-8')
+    if parts.netloc == 'www.nber.org' and parts.path.startswith('/papers/'):
+        html = (
+            '<html><body><div class="page-header__intro-inner">'
+            f'<p>{" ".join(_sentence(rng, 25) for _ in range(8))}</p></div></body></html>'
+        )
+        return 200, 'text/html', html.encode('utf-8')
+    if parts.netloc == 'api.ssrn.com':
+        return 200, 'application/json', json.dumps(_ssrn_search(query)).encode('utf-8')
+    if parts.netloc == 'papers.ssrn.com' and parts.path.endswith('papers.cfm'):
+        html = (
+            f'<html><body><div class="abstract-text"><p>{" ".join(_sentence(rng, 25) for _ in range(6))}</p></div>'
+            f'<p>Keywords: {", ".join(rng.sample(WORDS, 4))}</p></body></html>'
+        )
+        return 200, 'text/html', html.encode('utf-8')
+    if parts.netloc == 'export.arxiv.org':
+        return 200, 'application/atom+xml', _arxiv_feed(query).encode('utf-8')
+    return 404, 'text/plain', b''
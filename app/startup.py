@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Process-wide startup work for the Streamlit pages.
+
+Heavy libraries are imported inside the functions that need them, so a
+rerun only pays for what it uses. `prewarm` moves the remaining one-off
+costs off the first request. Once per process and database, a
+background thread imports the LangChain modules the pages use, creates
+the embeddings client and loads the database's indexes into the
+registry LRU.
+
+`import_report` lists the heavy modules loaded in this process and the
+prewarm timings. Import times of the heavy modules, each measured in a
+fresh interpreter with `-X importtime`, are printed by:
+
+    python startup.py
+"""
+import os
+import sys
+import json
+import time
+import importlib
+import threading
+import subprocess
+
+from registry import get_index_path, load_index
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+HEAVY_MODULES = (
+    'langchain_community.vectorstores',
+    'langchain_community.llms',
+    'langchain_community.embeddings.yandex',
+    'faiss',
+    'numpy',
+    'fitz',
+    'PIL.Image',
+    'reportlab.platypus',
+    'bs4'
+)
+PREWARM_MODULES = (
+    'langchain_community.vectorstores',
+    'langchain_community.embeddings.yandex',
+    'langchain_community.llms'
+)
+
+_timings = {}
+_started = set()
+_lock = threading.Lock()
+
+
+def _timed(step, fn, *args):
+    start = time.perf_counter()
+    try:
+        result = fn(*args)
+    except Exception as e:
+        _timings[step] = {'seconds': round(time.perf_counter() - start, 3), 'error': repr(e)}
+        return None
+    _timings[step] = {'seconds': round(time.perf_counter() - start, 3)}
+    return result
+
+
+def _embedder():
+    from indexing import get_embedder
+
+    with open(os.path.join(APP_DIR, 'apicreds.json')) as file:
+        return get_embedder(json.load(file))
+
+
+def _prewarm(db_path):
+    for module in PREWARM_MODULES:
+        _timed(f'import {module}', importlib.import_module, module)
+    embedder = _timed('embeddings client', _embedder)
+    if embedder is None:
+        return
+    for kind in ('full', 'abstract'):
+        path = get_index_path(db_path, kind)
+        if os.path.exists(path):
+            _timed(f'load {kind} index of {db_path}', load_index, path, embedder)
+
+
+def prewarm(db_path):
+    """Start warming up imports, clients and indexes for `db_path`, once per process"""
+    with _lock:
+        if db_path in _started:
+            return
+        _started.add(db_path)
+    threading.Thread(target=_prewarm, args=(db_path,), name='prewarm', daemon=True).start()
+
+
+def import_report():
+    """Heavy modules loaded in this process and how long each prewarm step took"""
+    return {
+        'loaded': [module for module in HEAVY_MODULES if module in sys.modules],
+        'not_loaded': [module for module in HEAVY_MODULES if module not in sys.modules],
+        'prewarm': dict(_timings)
+    }
+
+
+def measure_import(module):
+    """Cumulative import time of `module` in seconds, in a fresh interpreter"""
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd = APP_DIR,
+        capture_output = True,
+        text = True
+    )
+    if proc.returncode != 0:
+        raise ImportError(proc.stderr.strip().splitlines()[-1])
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        parts = [part.strip() for part in line.split('|')]
+        if len(parts) == 3 and parts[2] == module:
+            return int(parts[1]) / 1e6
+    return 0.
+
+
+if __name__ == '__main__':
+    for module in HEAVY_MODULES:
+        try:
+            print(f'{module:42s} {measure_import(module):8.3f} s')
+        except ImportError as e:
+            print(f'{module:42s} not installed ({e})')
@@ -0,0 +1,17 @@
+from catalog import _match_record
+from downloader import TitleIndex
+
+PAPERS = [
+    {'id': 'w11645', 'title': 'Barriers To Entry'},
+    {'id': 'w17758', 'title': 'Time as a Trade Barrier'},
+]
+
+
+def test_one_word_file_name_stays_unlinked():
+    index = TitleIndex(PAPERS)
+    assert _match_record(index, 'data/rag/Barriers.pdf', None) == (None, None)
+
+
+def test_file_name_of_a_record():
+    index = TitleIndex(PAPERS)
+    assert _match_record(index, 'data/rag/Time_as_a_Trade_Barrier.pdf', None) == ('w17758', 'Time as a Trade Barrier')
@@ -0,0 +1,20 @@
+from downloader import TitleIndex
+
+PAPERS = [
+    {'id': 'w17758', 'title': 'Time as a Trade Barrier'},
+    {'id': 'w11645', 'title': 'Barriers To Entry'},
+    {'id': 'ssrn1', 'title': 'Anatomy of Non-Tariff Barriers in India-Lanka Free Trade Agreement'},
+]
+
+
+def test_exact_title():
+    assert TitleIndex(PAPERS).resolve('time as a trade barrier')['id'] == 'w17758'
+
+
+def test_single_common_word_is_not_a_match():
+    assert TitleIndex(PAPERS).resolve('trade') is None
+
+
+def test_fragment_of_long_title():
+    index = TitleIndex(PAPERS)
+    assert index.resolve('Non-Tariff Barriers in India-Lanka')['id'] == 'ssrn1'
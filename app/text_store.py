@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+On-disk store of extracted PDF text and chunks.
+
+Page texts are saved once per PDF content hash, chunks once per content
+hash and splitter settings, both as JSONL files in the database's
+`.text_store` directory. Plain splits keep only chunk boundaries into the
+page texts; section-aware chunks keep their text and chunking stats.
+Index rebuilds and chunking experiments read these files instead of
+parsing the PDFs again.
+"""
+import os
+import json
+import hashlib
+
+from catalog import list_pdfs, scan, set_index_status
+from chunking import ChunkStats, section_chunks
+
+STORE_DIR = '.text_store'
+# `sections` drops references and boilerplate and chunks within sections,
+# `recursive` is the plain fixed-size splitter over raw pages
+DEFAULT_SPLITTER = {'kind': 'sections', 'chunk_size': 1000, 'chunk_overlap': 200}
+
+
+def splitter_key(settings):
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+
+def _read_jsonl(path):
+    with open(path, encoding='utf-8') as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def _write_jsonl(path, rows):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        for row in rows:
+            file.write(json.dumps(row, ensure_ascii=False) + '\n')
+    os.replace(tmp_path, path)
+
+
+def get_pages(db_path, pdf):
+    """Page texts of a catalogued PDF, extracted on first use"""
+    import fitz
+
+    path = os.path.join(db_path, STORE_DIR, f"{pdf['content_hash']}.pages.jsonl")
+    if os.path.exists(path):
+        return [row['text'] for row in _read_jsonl(path)]
+    with fitz.open(pdf['file_path']) as pdf_document:
+        pages = [page.get_text() for page in pdf_document]
+    _write_jsonl(path, ({'page': i, 'text': text} for i, text in enumerate(pages)))
+    return pages
+
+
+def _split(pages, settings):
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+    if settings['kind'] != 'recursive':
+        raise ValueError(f"Unknown splitter: {settings['kind']}")
+    splitter = RecursiveCharacterTextSplitter(
+        chunk_size = settings['chunk_size'],
+        chunk_overlap = settings['chunk_overlap'],
+        add_start_index = True
+    )
+    bounds = []
+    for page_number, text in enumerate(pages):
+        for chunk in splitter.create_documents([text]):
+            start = chunk.metadata['start_index']
+            bounds.append({'page': page_number, 'start': start, 'end': start + len(chunk.page_content)})
+    return bounds
+
+
+def _chunk_rows(db_path, pdf, settings):
+    """Cached chunk rows of a PDF: {page, text, section?, start?}"""
+    base = os.path.join(db_path, STORE_DIR, f"{pdf['content_hash']}.{splitter_key(settings)}")
+    path = f'{base}.chunks.jsonl'
+    if settings['kind'] == 'sections':
+        if not os.path.exists(path):
+            rows, stats = section_chunks(
+                pdf['file_path'], settings['chunk_size'], settings['chunk_overlap']
+            )
+            _write_jsonl(f'{base}.stats.jsonl', [stats.as_dict()])
+            _write_jsonl(path, rows)
+        return _read_jsonl(path)
+    pages = get_pages(db_path, pdf)
+    if os.path.exists(path):
+        bounds = _read_jsonl(path)
+    else:
+        bounds = _split(pages, settings)
+        _write_jsonl(path, bounds)
+    return [
+        {'page': b['page'], 'start': b['start'], 'text': pages[b['page']][b['start']:b['end']]}
+        for b in bounds
+    ]
+
+
+def get_chunks(db_path, pdf, settings = DEFAULT_SPLITTER):
+    """Chunks of a catalogued PDF as Documents, computed once per splitter settings"""
+    from langchain_core.documents import Document
+
+    documents = []
+    for row in _chunk_rows(db_path, pdf, settings):
+        metadata = {
+            'source': pdf['file_path'],
+            'page': row['page'],
+            'total_pages': pdf['page_count'],
+            'title': pdf['title'],
+            'record_id': pdf['record_id'],
+            'content_hash': pdf['content_hash']
+        }
+        if 'start' in row:
+            metadata['start_index'] = row['start']
+        if 'section' in row:
+            metadata['section'] = row['section']
+        documents.append(Document(page_content = row['text'], metadata = metadata))
+    return documents
+
+
+def chunk_stats(db_path, pdfs, settings = DEFAULT_SPLITTER):
+    """Summed ChunkStats of section-aware chunking over `pdfs`"""
+    total = ChunkStats()
+    for pdf in pdfs:
+        path = os.path.join(
+            db_path, STORE_DIR, f"{pdf['content_hash']}.{splitter_key(settings)}.stats.jsonl"
+        )
+        if os.path.exists(path):
+            row = _read_jsonl(path)[0]
+            stats = ChunkStats(
+                blocks = row['blocks'],
+                chars_kept = row['chars_kept'],
+                chars_dropped = row['chars_dropped'],
+                chunks = row['chunks'],
+                baseline_chunks = row['baseline_chunks']
+            )
+            stats.dropped.update(row['dropped'])
+            total.add(stats)
+    return total
+
+
+def iter_chunked_pdfs(db_path, settings = DEFAULT_SPLITTER, pdfs = None):
+    """
+    Yield (pdf, chunks) for every catalogued PDF, one file in memory at a time.
+
+    A PDF that cannot be chunked is skipped and marked `index_status='error'`,
+    so it neither fails the whole index job nor gets queued again until
+    its text changes.
+    """
+    if pdfs is None:
+        scan(db_path)
+        pdfs = list_pdfs(db_path)
+    for pdf in pdfs:
+        try:
+            chunks = get_chunks(db_path, pdf, settings)
+        except Exception as e:
+            print(f"Skipping {pdf['path']}: {e!r}")
+            set_index_status(db_path, [pdf['path']], 'error')
+            continue
+        yield pdf, chunks
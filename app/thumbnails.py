@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+First-page thumbnails for the Articles Database gallery.
+
+Thumbnails are rendered at display resolution by a background process
+pool and stored as WebP files keyed by PDF path, size and mtime, so a
+PDF is rendered once and every rerun only reads small image files.
+"""
+import os
+import hashlib
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+THUMBNAIL_CACHE = os.path.join(APP_DIR, 'thumbnail_cache')
+THUMBNAIL_WIDTH = 480
+WORKERS = max(1, min(4, (os.cpu_count() or 2) - 1))
+
+_executor = None
+_pending = {}
+_failed = set()
+_lock = threading.RLock()
+
+
+def thumbnail_path(pdf_path, width = THUMBNAIL_WIDTH):
+    stat = os.stat(pdf_path)
+    key = f'{os.path.abspath(pdf_path)}|{stat.st_size}|{stat.st_mtime_ns}|{width}'
+    return os.path.join(THUMBNAIL_CACHE, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.webp')
+
+
+def render_thumbnail(pdf_path, out_path, width = THUMBNAIL_WIDTH):
+    """Render page 0 of `pdf_path` to a WebP file `width` pixels wide"""
+    import fitz
+    from PIL import Image
+
+    with fitz.open(pdf_path) as pdf_document:
+        page = pdf_document[0]
+        zoom = width / page.rect.width
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+        img = Image.frombytes('RGB', (pix.width, pix.height), pix.samples)
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    tmp_path = f'{out_path}.{os.getpid()}.tmp'
+    img.save(tmp_path, format='WEBP', quality=80, method=4)
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=WORKERS,
+            mp_context=multiprocessing.get_context('spawn')
+        )
+    return _executor
+
+
+def _done(out_path, future):
+    with _lock:
+        _pending.pop(out_path, None)
+        if future.exception() is not None:
+            _failed.add(out_path)
+
+
+def get_thumbnail(pdf_path, width = THUMBNAIL_WIDTH, schedule = True):
+    """
+    Path of the cached thumbnail, or None while it is not rendered yet.
+
+    A missing thumbnail is queued for background rendering unless
+    `schedule` is False.
+    """
+    out_path = thumbnail_path(pdf_path, width)
+    if os.path.exists(out_path):
+        return out_path
+    if schedule:
+        with _lock:
+            if out_path not in _pending and out_path not in _failed:
+                future = _get_executor().submit(render_thumbnail, pdf_path, out_path, width)
+                _pending[out_path] = future
+                future.add_done_callback(lambda f, out_path=out_path: _done(out_path, f))
+    return None
+
+
+def pending_count():
+    with _lock:
+        return len(_pending)
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Lightweight timing spans around the stages of harvesting and answering.
+
+    with span('http.fetch', source = 'nber') as s:
+        resp = requests.get(url)
+        s.set(bytes = len(resp.content))
+
+Spans nest. Each span keeps its wall time, its self time (without child
+spans), its attributes (counts, token usage) and the error type if it
+failed. Finished spans are tagged with the session bound by `bind` in the
+current context (a Streamlit session, a job, a CLI run) and go to a
+bounded in-process buffer of that session, so a busy session never
+evicts the spans of the others. Jobs hand their spans back with their
+result. `summarize` aggregates them per stage. `export_jsonl` and
+`export_openmetrics` serialize them for offline analysis or a scraper.
+"""
+import json
+import time
+import itertools
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+MAX_SPANS = 5000
+# Buffers of the least recently active sessions are dropped beyond this
+MAX_SESSIONS = 100
+# Upper bounds in seconds, finer at the low end than the upstream latency
+# buckets: parsing and FAISS searches take milliseconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+_buffers = OrderedDict()
+_lock = threading.Lock()
+_ids = itertools.count(1)
+_session = ContextVar('trace_session', default=None)
+_current = ContextVar('trace_span', default=None)
+
+
+class Span:
+    __slots__ = ('id', 'parent', 'name', 'session', 'start', 'seconds', 'child_seconds', 'attrs', 'error')
+
+    def __init__(self, name, parent, attrs):
+        self.id = next(_ids)
+        self.parent = parent
+        self.name = name
+        self.session = _session.get()
+        self.start = time.time()
+        self.seconds = 0.
+        self.child_seconds = 0.
+        self.attrs = attrs
+        self.error = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'parent': self.parent.id if self.parent else None,
+            'name': self.name,
+            'session': self.session,
+            'start': self.start,
+            'seconds': round(self.seconds, 6),
+            'self_seconds': round(self.seconds - self.child_seconds, 6),
+            'attrs': self.attrs,
+            'error': self.error
+        }
+
+
+def bind(session):
+    """Tag spans started in the current context with `session`"""
+    _session.set(session)
+
+
+@contextmanager
+def span(name, **attrs):
+    parent = _current.get()
+    record = Span(name, parent, attrs)
+    token = _current.set(record)
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException as e:
+        record.error = type(e).__name__
+        raise
+    finally:
+        record.seconds = time.perf_counter() - start
+        _current.reset(token)
+        if parent is not None:
+            parent.child_seconds += record.seconds
+        _store([record.as_dict()])
+
+
+def traced(name, fn, **attrs):
+    """`fn` wrapped so that every call runs in a span"""
+    def wrapper(*args, **kwargs):
+        with span(name, **attrs):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+def _store(spans):
+    with _lock:
+        for s in spans:
+            buffer = _buffers.get(s['session'])
+            if buffer is None:
+                buffer = _buffers[s['session']] = deque(maxlen=MAX_SPANS)
+                while len(_buffers) > MAX_SESSIONS:
+                    _buffers.popitem(last=False)
+            else:
+                _buffers.move_to_end(s['session'])
+            buffer.append(s)
+
+
+def get_spans(session = None):
+    """Finished spans as dicts, oldest first; of one session when `session` is given"""
+    with _lock:
+        if session is not None:
+            return [dict(s) for s in _buffers.get(session, ())]
+        spans = [dict(s) for buffer in _buffers.values() for s in buffer]
+    return sorted(spans, key=lambda s: s['start'])
+
+
+def add_spans(spans):
+    """Take over spans finished elsewhere, e.g. by a job in the worker process"""
+    _store(spans)
+
+
+def clear(session = None):
+    with _lock:
+        if session is None:
+            _buffers.clear()
+        else:
+            _buffers.pop(session, None)
+
+
+def _quantile(values, q):
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, int(round(q * len(ordered))) - 1))]
+
+
+def summarize(spans):
+    """Per stage: calls, errors, total and self time, p50/p95 and summed numeric attributes"""
+    groups = {}
+    for s in spans:
+        groups.setdefault(s['name'], []).append(s)
+    rows = []
+    for name, group in groups.items():
+        seconds = [s['seconds'] for s in group]
+        row = {
+            'stage': name,
+            'calls': len(group),
+            'errors': sum(1 for s in group if s['error']),
+            'total_s': round(sum(seconds), 3),
+            'self_s': round(sum(s['self_seconds'] for s in group), 3),
+            'p50_s': round(_quantile(seconds, .5), 4),
+            'p95_s': round(_quantile(seconds, .95), 4)
+        }
+        for s in group:
+            for key, value in s['attrs'].items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    row[key] = row.get(key, 0) + value
+        rows.append(row)
+    return sorted(rows, key=lambda row: -row['self_s'])
+
+
+def export_jsonl(spans):
+    return ''.join(json.dumps(s, ensure_ascii=False, default=str) + '\n' for s in spans)
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def export_openmetrics(spans, prefix = 'app_span'):
+    """Histogram of span durations per stage, plus error and numeric attribute counters"""
+    lines = [f'# TYPE {prefix}_seconds histogram', f'# UNIT {prefix}_seconds seconds']
+    errors, counters = [], []
+    for row in summarize(spans):
+        stage = _label(row['stage'])
+        seconds = [s['seconds'] for s in spans if s['name'] == row['stage']]
+        for bound in BUCKETS:
+            le = '+Inf' if bound == float('inf') else repr(float(bound))
+            count = sum(1 for value in seconds if value <= bound)
+            lines.append(f'{prefix}_seconds_bucket{{stage="{stage}",le="{le}"}} {count}')
+        lines.append(f'{prefix}_seconds_count{{stage="{stage}"}} {row["calls"]}')
+        lines.append(f'{prefix}_seconds_sum{{stage="{stage}"}} {row["total_s"]}')
+        errors.append(f'{prefix}_errors_total{{stage="{stage}"}} {row["errors"]}')
+        for key in row:
+            if key not in ('stage', 'calls', 'errors', 'total_s', 'self_s', 'p50_s', 'p95_s'):
+                counters.append(f'{prefix}_attr_total{{stage="{stage}",attr="{_label(key)}"}} {row[key]}')
+    lines += [f'# TYPE {prefix}_errors counter'] + errors
+    lines += [f'# TYPE {prefix}_attr counter'] + counters
+    lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Background watcher that keeps the full-text index in step with a database.
+
+A daemon thread rescans the database folder through the catalog every
+`interval` seconds. Only files whose size or mtime changed are opened.
+When PDFs were added, changed or removed, or catalogued PDFs are not
+indexed yet, it queues an `index_update` job. PDFs that fail to chunk
+are marked `error` by the job and don't make the folder dirty again.
+The extract, chunk and embed work then runs in the job worker, and the
+pages only reload the saved index.
+"""
+import os
+import threading
+import traceback
+
+from catalog import scan, list_pdfs
+from registry import get_index_path
+from jobs import submit_job, latest_job
+
+WATCH_INTERVAL = 30
+
+_watchers = {}
+_lock = threading.Lock()
+
+
+def _busy(db_path):
+    return any(
+        latest_job(kind, db_path = db_path) is not None
+        for kind in ('index_update', 'index_build')
+    )
+
+
+def _watch(db_path, index_path, interval, stop):
+    # Changes made while nobody was watching are caught by the first update
+    dirty = True
+    while True:
+        try:
+            diff = scan(db_path)
+            # PDFs catalogued by someone else's scan (e.g. after a download) are still `new`
+            dirty = dirty or any(diff.values()) or bool(list_pdfs(db_path, limit = 1, status = 'new'))
+            # The first full build is started from the analysis page
+            if dirty and os.path.exists(index_path) and not _busy(db_path):
+                submit_job('index_update', {'db_path': db_path, 'index_path': index_path})
+                dirty = False
+        except Exception:
+            traceback.print_exc()
+        if stop.wait(interval):
+            return
+
+
+def start_watcher(db_path, index_path = None, interval = WATCH_INTERVAL):
+    """
+    Watch `db_path` in a daemon thread, once per database and index.
+
+    Returns:
+      threading.Event that stops the watcher when set
+    """
+    index_path = index_path or get_index_path(db_path, 'full')
+    with _lock:
+        key = (db_path, index_path)
+        if key not in _watchers:
+            stop = threading.Event()
+            threading.Thread(
+                target = _watch,
+                args = (db_path, index_path, interval, stop),
+                name = f'watcher:{db_path}',
+                daemon = True
+            ).start()
+            _watchers[key] = stop
+        return _watchers[key]